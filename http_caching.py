@@ -0,0 +1,93 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import hashlib
+import logging
+import os
+
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from . import settings
+from .slides_manager.paths_cache import get_image_path
+
+logger = logging.getLogger(__name__)
+
+
+class HttpValidators(object):
+    """
+    ETag and Last-Modified values of a response, the ETag is derived from the identity of the
+    source file, its modification time and the parameters used to render the response.
+    """
+
+    def __init__(self, source_id, mtime, *render_params):
+        self.last_modified = int(mtime)
+        etag_source = '|'.join(str(p) for p in (source_id, mtime) + render_params)
+        self.etag = '"%s"' % hashlib.sha1(etag_source.encode('utf-8')).hexdigest()
+
+
+def get_file_validators(path, *render_params):
+    if not settings.HTTP_CACHE_ENABLED or path is None:
+        return None
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError as ose:
+        logger.debug('Unable to stat %s: %s', path, ose)
+        return None
+    return HttpValidators(os.path.realpath(path), mtime, *render_params)
+
+
+def get_image_validators(connection, image_id, original_file_source=False, file_mimetype=None, *render_params):
+    if not settings.HTTP_CACHE_ENABLED:
+        return None
+    try:
+        path = get_image_path(connection, image_id, original_file_source, file_mimetype)
+    except Exception as e:
+        logger.debug('Unable to resolve path for image %s: %s', image_id, e)
+        return None
+    return get_file_validators(path, image_id, original_file_source, file_mimetype, *render_params)
+
+
+# returns a 304 (or 412) response if the client already holds the current version of the resource,
+# None if the response must be built; a 304 carries the same validators and freshness information of
+# the 200 response it stands for (RFC 7232, section 4.1)
+def get_not_modified_response(request, validators, max_age):
+    if validators is None:
+        return None
+    response = get_conditional_response(request, etag=validators.etag, last_modified=validators.last_modified)
+    if response is not None and response.status_code == 304:
+        _patch_cache_headers(response, validators, max_age)
+    return response
+
+
+def add_cache_headers(response, validators, max_age):
+    if validators is None or response.status_code != 200:
+        return response
+    return _patch_cache_headers(response, validators, max_age)
+
+
+def _patch_cache_headers(response, validators, max_age):
+    response['ETag'] = validators.etag
+    response['Last-Modified'] = http_date(validators.last_modified)
+    if settings.HTTP_CACHE_PUBLIC:
+        patch_cache_control(response, public=True, max_age=max_age)
+    else:
+        patch_cache_control(response, private=True, max_age=max_age)
+    return response
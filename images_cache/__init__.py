@@ -0,0 +1,87 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import logging
+import threading
+
+from .errors import UnknownCacheDriver
+from .. import settings
+
+logger = logging.getLogger(__name__)
+
+
+class CacheDriverFactory(object):
+
+    def __init__(self, cache_driver):
+        self.cache_driver = cache_driver
+
+    def _get_redis_cache(self, host, port, db, expire_time, socket_timeout, max_connections):
+        from .redis_cache import RedisCache
+        return RedisCache(host, port, db, expire_time, socket_timeout, max_connections)
+
+    def _get_disk_cache(self, path, max_bytes, expire_time):
+        from .disk_cache import DiskCache
+        return DiskCache(path, max_bytes, expire_time)
+
+    def get_cache(self, host=None, port=None, db=None, expire_time=None, socket_timeout=None, max_connections=None,
+                  path=None, max_bytes=None):
+        if self.cache_driver == 'redis':
+            return self._get_redis_cache(host, port, db, expire_time, socket_timeout, max_connections)
+        elif self.cache_driver == 'disk':
+            return self._get_disk_cache(path, max_bytes, expire_time)
+        else:
+            logger.warning('There is no images cache driver called %s', self.cache_driver)
+            raise UnknownCacheDriver('%s is not a valid images cache driver' % self.cache_driver)
+
+
+_images_cache = None
+_images_cache_lock = threading.Lock()
+
+
+def get_images_cache():
+    """
+    Process-wide images cache client, created on first use; returns None if the images cache is disabled.
+    If a local cache size is configured, the driver is wrapped by an in-process TieredCache.
+    """
+    global _images_cache
+    if not settings.IMAGES_CACHE_ENABLED:
+        return None
+    if _images_cache is None:
+        with _images_cache_lock:
+            if _images_cache is None:
+                images_cache = CacheDriverFactory(settings.IMAGES_CACHE_DRIVER).get_cache(
+                    settings.CACHE_HOST, settings.CACHE_PORT, settings.CACHE_DB, settings.CACHE_EXPIRE_TIME,
+                    (settings.CACHE_SOCKET_TIMEOUT / 1000.0) or None, settings.CACHE_MAX_CONNECTIONS or None,
+                    settings.CACHE_DISK_PATH, settings.CACHE_DISK_MAX_BYTES or None
+                )
+                if settings.IMAGES_CACHE_LOCAL_MAX_BYTES > 0:
+                    from .tiered_cache import TieredCache
+                    images_cache = TieredCache(images_cache, settings.IMAGES_CACHE_LOCAL_MAX_BYTES,
+                                               settings.IMAGES_CACHE_LOCAL_TTL)
+                _images_cache = images_cache
+    return _images_cache
+
+
+def invalidate_cached_images(image_id):
+    """
+    Make tiles and thumbnails cached for the image unreachable, to be called when the image is replaced or removed.
+    """
+    cache = get_images_cache()
+    if cache is not None:
+        cache.bump_generation(image_id)
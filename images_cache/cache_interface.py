@@ -0,0 +1,207 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from abc import ABCMeta, abstractmethod
+from datetime import timedelta
+import logging
+
+from ..lru_cache import LRUCache
+from ..server_timing import timed_stage
+from .. import settings
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+_GENERATIONS_MAX_ENTRIES = 4096
+
+
+class CacheInterface(object):
+    """
+    Images cache storing already encoded tiles and thumbnails, values are returned as bytes
+    exactly as they were saved so that they can be sent to the client as they are.
+
+    Keys of tiles and thumbnails include a generation number of the image, bumping it makes
+    all the images previously cached for that image unreachable.
+
+    If a stale time is configured, values are kept for stale_time seconds after they have expired
+    and can still be read, flagged as stale, while they are rendered again.
+    """
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self, expire_time=None):
+        self.logger = logging.getLogger(__name__)
+        # expire time is a dictionary with (optional) keys days, hours, minutes and seconds
+        if expire_time:
+            self.expire_time = int(timedelta(**expire_time).total_seconds())
+        else:
+            self.expire_time = None
+        if self.expire_time:
+            self.stale_time = settings.IMAGES_CACHE_STALE_TIME
+            # how long drivers must actually keep values
+            self.storage_time = self.expire_time + self.stale_time
+        else:
+            self.stale_time = 0
+            self.storage_time = None
+        # generations are read from the cache at most once every generation_ttl seconds by each process
+        self._generations = LRUCache(_GENERATIONS_MAX_ENTRIES, ttl=settings.IMAGES_CACHE_GENERATION_TTL or None)
+
+    def _get_tile_key(self, image_id, level, column, row, tile_size, image_format, rendering_engine,
+                      limit_bounds, image_quality=None):
+        return 'TILE::IMG_%s|G_%s|L_%s|C_%s-R_%s|S_%spx|F_%s|Q_%s|E_%s|LB_%s' % (
+            image_id, self.get_generation(image_id), level, column, row, tile_size, image_format.lower(),
+            image_quality, rendering_engine, limit_bounds
+        )
+
+    def _get_thumbnail_key(self, image_id, size, image_format, rendering_engine, image_quality=None):
+        return 'THUMB::IMG_%s|G_%s|S_%spx|F_%s|Q_%s|E_%s' % (image_id, self.get_generation(image_id), size,
+                                                            image_format.lower(), image_quality, rendering_engine)
+
+    def _get_generation_key(self, image_id):
+        return 'GEN::IMG_%s' % image_id
+
+    @abstractmethod
+    def _get(self, key):
+        pass
+
+    @abstractmethod
+    def _set(self, key, value):
+        pass
+
+    # returns a (value, stale) tuple, drivers that keep values after they expired must override it
+    def _get_with_staleness(self, key):
+        return self._get(key), False
+
+    # drivers that support it should override these to get and set several keys with a single round trip
+    def _get_many(self, keys):
+        return [self._get(k) for k in keys]
+
+    def _set_many(self, items):
+        for key, value in items:
+            self._set(key, value)
+
+    # counters must never expire, drivers that expire values stored with _set must override these
+    def _get_counter(self, key):
+        return self._get(key)
+
+    def _get_counters(self, keys):
+        return [self._get_counter(k) for k in keys]
+
+    def _increase_counter(self, key):
+        value = int(self._get_counter(key) or 0) + 1
+        self._set(key, value)
+        return value
+
+    def _load_generations(self, images_ids):
+        images_ids = [str(i) for i in images_ids if self._generations.get(str(i)) is None]
+        if images_ids:
+            generations = self._get_counters([self._get_generation_key(i) for i in images_ids])
+            for image_id, generation in zip(images_ids, generations):
+                self._generations.set(image_id, int(generation or 0))
+
+    def get_generation(self, image_id):
+        generation = self._generations.get(str(image_id))
+        if generation is None:
+            generation = int(self._get_counter(self._get_generation_key(image_id)) or 0)
+            self._generations.set(str(image_id), generation)
+        return generation
+
+    def bump_generation(self, image_id):
+        self.logger.debug('Bumping cache generation for image %s', image_id)
+        self._generations.pop(str(image_id))
+        return self._increase_counter(self._get_generation_key(image_id))
+
+    # locks used to avoid rendering the same image in more than one worker at the same time,
+    # drivers that can't share locks among processes simply always grant them
+    def acquire_lock(self, key, timeout):
+        return True
+
+    def release_lock(self, key, lock_token):
+        pass
+
+    # resolved filesystem paths are grouped by image so that they can be invalidated together
+    @abstractmethod
+    def path_to_cache(self, image_id, path_key, path, ttl=None):
+        pass
+
+    @abstractmethod
+    def path_from_cache(self, image_id, path_key):
+        pass
+
+    @abstractmethod
+    def paths_delete(self, image_id):
+        pass
+
+    def tile_to_cache(self, image_id, image_data, level, column, row, tile_size, image_format,
+                      rendering_engine, limit_bounds, image_quality=None):
+        with timed_stage('cache'):
+            key = self._get_tile_key(image_id, level, column, row, tile_size, image_format, rendering_engine,
+                                     limit_bounds, image_quality)
+            self.logger.debug('Saving tile %s to cache', key)
+            self._set(key, image_data)
+
+    def tile_from_cache(self, image_id, level, column, row, tile_size, image_format, rendering_engine,
+                        limit_bounds, image_quality=None):
+        with timed_stage('cache'):
+            key = self._get_tile_key(image_id, level, column, row, tile_size, image_format, rendering_engine,
+                                     limit_bounds, image_quality)
+            return self._get(key)
+
+    # returns a (tile, stale) tuple
+    def tile_and_staleness_from_cache(self, image_id, level, column, row, tile_size, image_format, rendering_engine,
+                                      limit_bounds, image_quality=None):
+        with timed_stage('cache'):
+            key = self._get_tile_key(image_id, level, column, row, tile_size, image_format, rendering_engine,
+                                     limit_bounds, image_quality)
+            return self._get_with_staleness(key)
+
+    # tiles is a list of (image_data, tile_params) tuples, where tile_params are the keyword arguments
+    # of tile_to_cache
+    def tiles_to_cache(self, tiles):
+        with timed_stage('cache'):
+            self._set_many([(self._get_tile_key(**tile_params), image_data) for image_data, tile_params in tiles])
+
+    def thumbnail_to_cache(self, image_id, image_data, size, image_format, rendering_engine, image_quality=None):
+        with timed_stage('cache'):
+            key = self._get_thumbnail_key(image_id, size, image_format, rendering_engine, image_quality)
+            self.logger.debug('Saving thumbnail %s to cache', key)
+            self._set(key, image_data)
+
+    def thumbnail_from_cache(self, image_id, size, image_format, rendering_engine, image_quality=None):
+        with timed_stage('cache'):
+            return self._get(self._get_thumbnail_key(image_id, size, image_format, rendering_engine, image_quality))
+
+    def thumbnails_from_cache(self, images_ids, size, image_format, rendering_engine, image_quality=None):
+        with timed_stage('cache'):
+            self._load_generations(images_ids)
+            return self._get_many([self._get_thumbnail_key(image_id, size, image_format, rendering_engine,
+                                                           image_quality)
+                                   for image_id in images_ids])
+
+    # JSON serializable metadata (e.g. slides descriptors)
+    def metadata_to_cache(self, key, metadata):
+        self._set('META::%s' % key, json.dumps(metadata))
+
+    def metadata_from_cache(self, key):
+        metadata = self._get('META::%s' % key)
+        if metadata is not None:
+            return json.loads(metadata)
+        return None
@@ -0,0 +1,299 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from .cache_interface import CacheInterface
+from ..metrics import count_cache_lookups
+
+logger = logging.getLogger(__name__)
+
+_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key_hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE TABLE IF NOT EXISTS counters (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS paths (
+    image_id TEXT NOT NULL,
+    path_key TEXT NOT NULL,
+    path TEXT NOT NULL,
+    expires REAL,
+    PRIMARY KEY (image_id, path_key)
+);
+"""
+
+# seconds between two runs of the eviction thread
+_EVICTION_INTERVAL = 30
+# once the cache is over the limit, evict entries until it is this much full
+_EVICTION_LOW_WATERMARK = 0.9
+_EVICTION_BATCH = 500
+
+
+class DiskCache(CacheInterface):
+    """
+    Images cache stored on the local filesystem: values are saved in a directory tree sharded by the
+    hash of their keys, written atomically (temporary file and rename) so that readers never see partial
+    files, and indexed by a SQLite database in the same directory that survives restarts and can be
+    shared by several worker processes.
+
+    Total size is bounded by max_bytes (unbounded if None): a background thread evicts the least recently
+    used entries; access times are updated in batches, so eviction order is approximated.
+    """
+
+    def __init__(self, path, max_bytes, expire_time=None):
+        super(DiskCache, self).__init__(expire_time)
+        if not path:
+            raise ValueError('A path is required by the disk images cache')
+        if max_bytes is not None and max_bytes <= 0:
+            raise ValueError('max_bytes must be a positive number or None, got %r' % (max_bytes,))
+        self.path = path
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.index_path = os.path.join(self.path, 'index.sqlite')
+        self._local = threading.local()
+        self._accesses = {}
+        self._accesses_lock = threading.Lock()
+        # bytes written since the last eviction, updated by all the threads saving values
+        self._written = 0
+        self._written_lock = threading.Lock()
+        self._eviction_needed = threading.Event()
+        with self._get_index() as index:
+            index.executescript(_INDEX_SCHEMA)
+        self._eviction_thread = threading.Thread(target=self._eviction_loop, name='ome_seadragon-disk-cache')
+        self._eviction_thread.daemon = True
+        self._eviction_thread.start()
+
+    def _get_index(self):
+        # SQLite connections can't be shared among threads
+        index = getattr(self._local, 'index', None)
+        if index is None:
+            index = sqlite3.connect(self.index_path, timeout=30)
+            index.execute('PRAGMA journal_mode=WAL')
+            self._local.index = index
+        return index
+
+    def _get_key_hash(self, key):
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _get_file_path(self, key_hash):
+        return os.path.join(self.path, key_hash[:2], key_hash[2:4], key_hash)
+
+    # returns a (value, age) tuple
+    def _read(self, key_hash):
+        file_path = self._get_file_path(key_hash)
+        try:
+            age = time.time() - os.path.getmtime(file_path)
+            if self.storage_time is not None and age > self.storage_time:
+                return None, None
+            with open(file_path, 'rb') as f:
+                value = f.read()
+        except (IOError, OSError):
+            return None, None
+        with self._accesses_lock:
+            self._accesses[key_hash] = time.time()
+        return value, age
+
+    def _write(self, key_hash, value):
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        file_path = self._get_file_path(key_hash)
+        dir_path = os.path.dirname(file_path)
+        try:
+            if not os.path.isdir(dir_path):
+                os.makedirs(dir_path, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(value)
+                os.replace(tmp_path, file_path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+        except (IOError, OSError) as e:
+            logger.warning('Unable to save %s to the disk cache: %s', key_hash, e)
+            return None
+        return len(value)
+
+    def _index_entries(self, entries):
+        now = time.time()
+        try:
+            with self._get_index() as index:
+                index.executemany('INSERT OR REPLACE INTO entries (key_hash, size, created, accessed) '
+                                  'VALUES (?, ?, ?, ?)', [(h, s, now, now) for h, s in entries])
+        except sqlite3.Error as e:
+            logger.warning('Unable to update the disk cache index: %s', e)
+        if self.max_bytes is None:
+            return
+        with self._written_lock:
+            self._written += sum(s for _, s in entries)
+            eviction_needed = self._written > self.max_bytes * (1 - _EVICTION_LOW_WATERMARK)
+        if eviction_needed:
+            self._eviction_needed.set()
+
+    def _get(self, key):
+        return self._get_with_staleness(key)[0]
+
+    def _get_with_staleness(self, key):
+        value, age = self._read(self._get_key_hash(key))
+        count_cache_lookups('disk', int(value is not None), int(value is None))
+        return value, value is not None and self.expire_time is not None and age > self.expire_time
+
+    def _set(self, key, value):
+        self._set_many([(key, value)])
+
+    def _set_many(self, items):
+        entries = []
+        for key, value in items:
+            key_hash = self._get_key_hash(key)
+            size = self._write(key_hash, value)
+            if size is not None:
+                entries.append((key_hash, size))
+        if entries:
+            self._index_entries(entries)
+
+    def _get_counter(self, key):
+        try:
+            row = self._get_index().execute('SELECT value FROM counters WHERE key = ?', (key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning('Unable to read %s from the disk cache: %s', key, e)
+            return None
+        return row[0] if row is not None else None
+
+    def _increase_counter(self, key):
+        try:
+            with self._get_index() as index:
+                index.execute('INSERT OR IGNORE INTO counters (key, value) VALUES (?, 0)', (key,))
+                index.execute('UPDATE counters SET value = value + 1 WHERE key = ?', (key,))
+                return index.execute('SELECT value FROM counters WHERE key = ?', (key,)).fetchone()[0]
+        except sqlite3.Error as e:
+            logger.warning('Unable to increase %s on the disk cache: %s', key, e)
+            return None
+
+    def _flush_accesses(self, index):
+        with self._accesses_lock:
+            accesses, self._accesses = self._accesses, {}
+        if accesses:
+            index.executemany('UPDATE entries SET accessed = ? WHERE key_hash = ?',
+                              [(t, h) for h, t in accesses.items()])
+
+    def _delete_entries(self, index, key_hashes):
+        for key_hash in key_hashes:
+            try:
+                os.unlink(self._get_file_path(key_hash))
+            except OSError:
+                pass
+        index.executemany('DELETE FROM entries WHERE key_hash = ?', [(h,) for h in key_hashes])
+
+    def evict(self):
+        """
+        Remove expired entries and, if the cache is bigger than max_bytes, the least recently used ones.
+        """
+        # values written from now on are counted towards the next eviction
+        with self._written_lock:
+            self._written = 0
+        with self._get_index() as index:
+            self._flush_accesses(index)
+            if self.storage_time is not None:
+                now = time.time()
+                expired = [r[0] for r in index.execute('SELECT key_hash FROM entries WHERE created < ?',
+                                                       (now - self.storage_time,))]
+                self._delete_entries(index, expired)
+                index.execute('DELETE FROM paths WHERE expires IS NOT NULL AND expires < ?', (now,))
+            if self.max_bytes is None:
+                return
+            total_size = index.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            target_size = self.max_bytes * _EVICTION_LOW_WATERMARK
+            while total_size > self.max_bytes:
+                oldest = index.execute('SELECT key_hash, size FROM entries ORDER BY accessed LIMIT ?',
+                                       (_EVICTION_BATCH,)).fetchall()
+                if not oldest:
+                    break
+                evicted = []
+                for key_hash, size in oldest:
+                    if total_size <= target_size:
+                        break
+                    evicted.append(key_hash)
+                    total_size -= size
+                logger.debug('Evicting %d entries from the disk cache', len(evicted))
+                self._delete_entries(index, evicted)
+                if total_size <= target_size:
+                    break
+
+    def _eviction_loop(self):
+        while True:
+            self._eviction_needed.wait(_EVICTION_INTERVAL)
+            self._eviction_needed.clear()
+            try:
+                self.evict()
+            except Exception as e:
+                logger.exception('Error while evicting entries from the disk cache: %s', e)
+
+    def path_to_cache(self, image_id, path_key, path, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        try:
+            with self._get_index() as index:
+                index.execute('INSERT OR REPLACE INTO paths (image_id, path_key, path, expires) VALUES (?, ?, ?, ?)',
+                              (str(image_id), path_key, path, expires))
+        except sqlite3.Error as e:
+            logger.warning('Unable to save path for image %s to the disk cache: %s', image_id, e)
+
+    def path_from_cache(self, image_id, path_key):
+        try:
+            row = self._get_index().execute('SELECT path, expires FROM paths WHERE image_id = ? AND path_key = ?',
+                                            (str(image_id), path_key)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning('Unable to get path for image %s from the disk cache: %s', image_id, e)
+            return None
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return row[0]
+
+    def paths_delete(self, image_id):
+        try:
+            with self._get_index() as index:
+                index.execute('DELETE FROM paths WHERE image_id = ?', (str(image_id),))
+        except sqlite3.Error as e:
+            logger.warning('Unable to delete paths for image %s from the disk cache: %s', image_id, e)
+
+    def stats(self):
+        try:
+            entries, size = self._get_index().execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries'
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning('Unable to read stats from the disk cache: %s', e)
+            entries, size = None, None
+        return {
+            'entries': entries,
+            'bytes': size
+        }
@@ -0,0 +1,181 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import logging
+import uuid
+
+import redis
+
+from .cache_interface import CacheInterface
+from ..metrics import count_cache_lookups
+
+
+# delete the lock only if it is still owned by the caller
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+else
+    return 0
+end
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class RedisCache(CacheInterface):
+    """
+    Redis images cache, connections are taken from a pool shared by all the threads using the cache.
+    Errors and timeouts while talking to Redis are logged and treated as cache misses.
+    """
+
+    def __init__(self, host, port, db, expire_time=None, socket_timeout=None, max_connections=None):
+        super(RedisCache, self).__init__(expire_time)
+        pool_params = {
+            'host': host,
+            'port': int(port or 6379),
+            'db': int(db or 0),
+            'socket_timeout': socket_timeout,
+            'socket_connect_timeout': socket_timeout
+        }
+        if max_connections:
+            # wait for a free connection instead of failing when all of them are in use
+            self.pool = redis.BlockingConnectionPool(max_connections=max_connections, timeout=socket_timeout,
+                                                     **pool_params)
+        else:
+            self.pool = redis.ConnectionPool(**pool_params)
+        self.client = redis.StrictRedis(connection_pool=self.pool)
+
+    def _get(self, key):
+        try:
+            value = self.client.get(key)
+        except redis.RedisError as re:
+            logger.warning('Unable to get %s from Redis: %s', key, re)
+            value = None
+        count_cache_lookups('redis', int(value is not None), int(value is None))
+        return value
+
+    def _set(self, key, value):
+        try:
+            self.client.set(key, value, ex=self.storage_time)
+        except redis.RedisError as re:
+            logger.warning('Unable to save %s to Redis: %s', key, re)
+
+    def _get_with_staleness(self, key):
+        if not self.stale_time:
+            return self._get(key), False
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.get(key)
+            pipe.ttl(key)
+            value, ttl = pipe.execute()
+        except redis.RedisError as re:
+            logger.warning('Unable to get %s from Redis: %s', key, re)
+            value = None
+        count_cache_lookups('redis', int(value is not None), int(value is None))
+        if value is None:
+            return None, False
+        # values are stored for expire_time + stale_time seconds
+        return value, 0 <= ttl < self.stale_time
+
+    def _mget(self, keys):
+        if len(keys) == 0:
+            return []
+        try:
+            return self.client.mget(keys)
+        except redis.RedisError as re:
+            logger.warning('Unable to get %d keys from Redis: %s', len(keys), re)
+            return [None] * len(keys)
+
+    def _get_many(self, keys):
+        values = self._mget(keys)
+        hits = len([v for v in values if v is not None])
+        count_cache_lookups('redis', hits, len(values) - hits)
+        return values
+
+    def _set_many(self, items):
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for key, value in items:
+                pipe.set(key, value, ex=self.storage_time)
+            pipe.execute()
+        except redis.RedisError as re:
+            logger.warning('Unable to save %d keys to Redis: %s', len(items), re)
+
+    def _get_counter(self, key):
+        return self._mget([key])[0]
+
+    def _get_counters(self, keys):
+        return self._mget(keys)
+
+    def _increase_counter(self, key):
+        try:
+            return self.client.incr(key)
+        except redis.RedisError as re:
+            logger.warning('Unable to increase %s on Redis: %s', key, re)
+            return None
+
+    def _get_lock_key(self, key):
+        return 'LOCK::%s' % key
+
+    def acquire_lock(self, key, timeout):
+        lock_token = uuid.uuid4().hex
+        try:
+            if self.client.set(self._get_lock_key(key), lock_token, nx=True, px=int(timeout * 1000)):
+                return lock_token
+        except redis.RedisError as re:
+            # render anyway, the lock is only an optimization
+            logger.warning('Unable to acquire lock for %s: %s', key, re)
+            return lock_token
+        return None
+
+    def release_lock(self, key, lock_token):
+        try:
+            self.client.eval(_RELEASE_LOCK_SCRIPT, 1, self._get_lock_key(key), lock_token)
+        except redis.RedisError as re:
+            logger.warning('Unable to release lock for %s: %s', key, re)
+
+    def _get_paths_key(self, image_id):
+        return 'PATHS::IMG_%s' % image_id
+
+    def path_to_cache(self, image_id, path_key, path, ttl=None):
+        key = self._get_paths_key(image_id)
+        try:
+            pipe = self.client.pipeline()
+            pipe.hset(key, path_key, path)
+            if ttl:
+                pipe.expire(key, ttl)
+            pipe.execute()
+        except redis.RedisError as re:
+            logger.warning('Unable to save path for image %s to Redis: %s', image_id, re)
+
+    def path_from_cache(self, image_id, path_key):
+        try:
+            path = self.client.hget(self._get_paths_key(image_id), path_key)
+        except redis.RedisError as re:
+            logger.warning('Unable to get path for image %s from Redis: %s', image_id, re)
+            return None
+        if path is not None:
+            return path.decode('utf-8')
+        return None
+
+    def paths_delete(self, image_id):
+        try:
+            self.client.delete(self._get_paths_key(image_id))
+        except redis.RedisError as re:
+            logger.warning('Unable to delete paths for image %s from Redis: %s', image_id, re)
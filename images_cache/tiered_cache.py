@@ -0,0 +1,137 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import threading
+
+from .cache_interface import CacheInterface
+from ..lru_cache import LRUCache
+from ..metrics import count_cache_lookups
+
+
+class TieredCache(CacheInterface):
+    """
+    In-process, byte bounded LRU cache (L1) in front of a shared images cache driver (L2).
+    Reads look into L1 first and store L2 hits into it, writes go to both tiers. Entries are kept in L1
+    for local_ttl seconds, and at most a tenth of the expire time of the images cache, since L1 doesn't
+    know how long an entry has already been in L2: this bounds how long L1 serves entries after they
+    expired or became stale in L2. Paths, counters and locks are handled by L2 only.
+    """
+
+    def __init__(self, remote_cache, max_bytes, local_ttl):
+        super(TieredCache, self).__init__()
+        self.remote_cache = remote_cache
+        self.expire_time = remote_cache.expire_time
+        self.stale_time = remote_cache.stale_time
+        self.storage_time = remote_cache.storage_time
+        if self.expire_time:
+            local_ttl = min(local_ttl, max(self.expire_time // 10, 1))
+        self.local_cache = LRUCache(None, ttl=local_ttl, max_bytes=max_bytes)
+        self.remote_hits = 0
+        self.remote_misses = 0
+        self._counters_lock = threading.Lock()
+
+    def _count_remote(self, hits, misses):
+        with self._counters_lock:
+            self.remote_hits += hits
+            self.remote_misses += misses
+
+    def _get(self, key):
+        value = self.local_cache.get(key)
+        count_cache_lookups('local', int(value is not None), int(value is None))
+        if value is None:
+            value = self.remote_cache._get(key)
+            if value is not None:
+                self._count_remote(1, 0)
+                self.local_cache.set(key, value)
+            else:
+                self._count_remote(0, 1)
+        return value
+
+    def _get_with_staleness(self, key):
+        value = self.local_cache.get(key)
+        count_cache_lookups('local', int(value is not None), int(value is None))
+        if value is not None:
+            return value, False
+        value, stale = self.remote_cache._get_with_staleness(key)
+        if value is not None:
+            self._count_remote(1, 0)
+            # stale values are going to be replaced soon
+            if not stale:
+                self.local_cache.set(key, value)
+        else:
+            self._count_remote(0, 1)
+        return value, stale
+
+    def _set(self, key, value):
+        self.local_cache.set(key, value)
+        self.remote_cache._set(key, value)
+
+    def _get_many(self, keys):
+        values = [self.local_cache.get(k) for k in keys]
+        missing = [i for i, v in enumerate(values) if v is None]
+        count_cache_lookups('local', len(keys) - len(missing), len(missing))
+        if missing:
+            remote_values = self.remote_cache._get_many([keys[i] for i in missing])
+            for i, value in zip(missing, remote_values):
+                if value is not None:
+                    self.local_cache.set(keys[i], value)
+                    values[i] = value
+            found = len([v for v in remote_values if v is not None])
+            self._count_remote(found, len(missing) - found)
+        return values
+
+    def _set_many(self, items):
+        for key, value in items:
+            self.local_cache.set(key, value)
+        self.remote_cache._set_many(items)
+
+    def _get_counter(self, key):
+        return self.remote_cache._get_counter(key)
+
+    def _get_counters(self, keys):
+        return self.remote_cache._get_counters(keys)
+
+    def _increase_counter(self, key):
+        return self.remote_cache._increase_counter(key)
+
+    def acquire_lock(self, key, timeout):
+        return self.remote_cache.acquire_lock(key, timeout)
+
+    def release_lock(self, key, lock_token):
+        self.remote_cache.release_lock(key, lock_token)
+
+    def path_to_cache(self, image_id, path_key, path, ttl=None):
+        self.remote_cache.path_to_cache(image_id, path_key, path, ttl)
+
+    def path_from_cache(self, image_id, path_key):
+        return self.remote_cache.path_from_cache(image_id, path_key)
+
+    def paths_delete(self, image_id):
+        self.remote_cache.paths_delete(image_id)
+
+    def stats(self):
+        local_stats = self.local_cache.stats()
+        with self._counters_lock:
+            return {
+                'l1': local_stats,
+                'l2': {
+                    'hits': self.remote_hits,
+                    'misses': self.remote_misses
+                }
+            }
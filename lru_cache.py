@@ -0,0 +1,150 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread-safe, bounded LRU map used to keep process-wide objects (open slides, resolved paths...)
+    across requests.
+
+    Entries older than ttl seconds (counted from insertion) or not accessed for idle_timeout
+    seconds are treated as missing; on_evict, if given, is called with (key, value) for every
+    entry dropped because of size limits or expiration.
+
+    If max_bytes is given the cache is also bounded by the total size of its values, as measured
+    by sizeof (len by default); max_entries can then be None to bound the cache by size only.
+    """
+
+    def __init__(self, max_entries, ttl=None, idle_timeout=None, on_evict=None, max_bytes=None, sizeof=len):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.idle_timeout = idle_timeout
+        self.on_evict = on_evict
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.size = 0
+        # key -> [value, creation time, last access time, size]
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _is_expired(self, entry, now):
+        if self.ttl is not None and now - entry[1] > self.ttl:
+            return True
+        if self.idle_timeout is not None and now - entry[2] > self.idle_timeout:
+            return True
+        return False
+
+    def _pop_entry(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[3]
+        return entry
+
+    def _is_full(self):
+        if self.max_entries is not None and len(self._entries) > self.max_entries:
+            return True
+        return self.max_bytes is not None and self.size > self.max_bytes
+
+    def _evict(self, key):
+        value = self._pop_entry(key)[0]
+        self.evictions += 1
+        if self.on_evict:
+            self.on_evict(key, value)
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            if self._is_expired(entry, now):
+                self._evict(key)
+                self.misses += 1
+                return default
+            entry[2] = now
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        if self.max_entries is not None and self.max_entries <= 0:
+            return
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        now = time.time()
+        with self._lock:
+            self._pop_entry(key)
+            # values that would flush the whole cache are not worth keeping
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._entries[key] = [value, now, now, size]
+            self.size += size
+            while self._is_full():
+                self._evict(next(iter(self._entries)))
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._pop_entry(key)
+        return default if entry is None else entry[0]
+
+    def pop_matching(self, match):
+        with self._lock:
+            keys = [k for k in self._entries if match(k)]
+            for k in keys:
+                self._pop_entry(k)
+        return len(keys)
+
+    def items(self):
+        with self._lock:
+            return [(k, e[0]) for k, e in self._entries.items()]
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [k for k, e in self._entries.items() if self._is_expired(e, now)]
+            for k in expired:
+                self._evict(k)
+        return len(expired)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+            if self.max_bytes is not None:
+                stats['bytes'] = self.size
+            return stats
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,149 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import logging
+import os
+import threading
+
+from . import settings
+
+logger = logging.getLogger(__name__)
+
+_TILE_SIZE_BUCKETS = (1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072, 262144, 524288, 1048576)
+
+
+class _Metrics(object):
+
+    def __init__(self):
+        from prometheus_client import Counter, Histogram
+
+        self.tiles_served = Counter('ome_seadragon_tiles_served_total',
+                                    'DeepZoom tiles served, by rendering engine', ['engine'])
+        self.cache_lookups = Counter('ome_seadragon_images_cache_lookups_total',
+                                     'Images cache lookups, by cache tier and result', ['tier', 'result'])
+        self.engine_fallbacks = Counter('ome_seadragon_engine_fallbacks_total',
+                                        'Requests moved to the next rendering engine after a failure',
+                                        ['kind', 'engine'])
+        self.slide_handles = Counter('ome_seadragon_slide_handles_total',
+                                     'OpenSlide handles opened and evicted by the slides cache', ['event'])
+        self.raw_pixels_fallbacks = Counter('ome_seadragon_raw_pixels_fallbacks_total',
+                                            'OMERO regions rendered as JPEG because the raw pixels backend '
+                                            'can\'t apply the rendering settings of the image', ['reason'])
+        self.array_requests = Counter('ome_seadragon_array_requests_total',
+                                      'Requests to the arrays datasets views', ['kind'])
+        self.render_latency = Histogram('ome_seadragon_tile_render_seconds',
+                                        'Time spent rendering tiles, by rendering engine and DeepZoom level',
+                                        ['engine', 'level'])
+        self.tile_size = Histogram('ome_seadragon_encoded_tile_bytes', 'Size of the encoded tiles',
+                                   ['engine'], buckets=_TILE_SIZE_BUCKETS)
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+_metrics_unavailable = False
+
+
+# metrics are only used by OMERO.web, other tools importing the app modules don't have its settings
+def _get_metrics():
+    global _metrics, _metrics_unavailable
+    if _metrics is None and not _metrics_unavailable and getattr(settings, 'METRICS_ENABLED', False):
+        with _metrics_lock:
+            if _metrics is None and not _metrics_unavailable:
+                # in multiprocess mode prometheus_client stores the metrics of every worker in files under
+                # this folder, the variable has to be set before the library is imported
+                if settings.METRICS_MULTIPROC_DIR:
+                    os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', settings.METRICS_MULTIPROC_DIR)
+                try:
+                    _metrics = _Metrics()
+                except ImportError:
+                    logger.warning('prometheus_client is not installed, metrics are disabled')
+                    _metrics_unavailable = True
+    return _metrics
+
+
+def is_metrics_enabled():
+    return _get_metrics() is not None
+
+
+def count_tile_served(engine):
+    metrics = _get_metrics()
+    if metrics is not None:
+        metrics.tiles_served.labels(engine).inc()
+
+
+def count_cache_lookups(tier, hits, misses):
+    metrics = _get_metrics()
+    if metrics is not None:
+        if hits:
+            metrics.cache_lookups.labels(tier, 'hit').inc(hits)
+        if misses:
+            metrics.cache_lookups.labels(tier, 'miss').inc(misses)
+
+
+def count_engine_fallback(kind, engine):
+    metrics = _get_metrics()
+    if metrics is not None:
+        metrics.engine_fallbacks.labels(kind, engine).inc()
+
+
+def count_slide_handle(event):
+    metrics = _get_metrics()
+    if metrics is not None:
+        metrics.slide_handles.labels(event).inc()
+
+
+def count_raw_pixels_fallback(reason):
+    metrics = _get_metrics()
+    if metrics is not None:
+        metrics.raw_pixels_fallbacks.labels(reason).inc()
+
+
+def count_array_request(kind):
+    metrics = _get_metrics()
+    if metrics is not None:
+        metrics.array_requests.labels(kind).inc()
+
+
+def observe_tiles_render(engine, level, duration, tiles):
+    """
+    Record the time spent rendering the given encoded tiles of a DeepZoom level with a single read
+    (one tile, or all the tiles of an OMERO super tile) and their size.
+    """
+    metrics = _get_metrics()
+    if metrics is not None:
+        metrics.render_latency.labels(engine, level).observe(duration)
+        for tile in tiles:
+            if tile is not None:
+                metrics.tile_size.labels(engine).observe(len(tile))
+
+
+def export_metrics():
+    """
+    Return a tuple with the metrics in the Prometheus text format and their content type; in multiprocess
+    mode the metrics of all the workers sharing the same folder are aggregated.
+    """
+    from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest, multiprocess
+
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ or 'prometheus_multiproc_dir' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,142 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from . import settings
+
+logger = logging.getLogger(__name__)
+
+# timings of the request served by the current thread
+_current = threading.local()
+
+
+class RequestTimings(object):
+    """
+    Time spent by a request in each stage (OMERO session check, path resolution, rendering...), in
+    milliseconds; stages entered more than once, or by more than one thread, are summed up.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self._stages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, stage, duration):
+        with self._lock:
+            self._stages[stage] = self._stages.get(stage, 0) + duration * 1000
+
+    def elapsed(self):
+        return (time.time() - self.start) * 1000
+
+    def stages(self):
+        with self._lock:
+            return list(self._stages.items())
+
+
+def get_current_timings():
+    return getattr(_current, 'timings', None)
+
+
+@contextmanager
+def bind_timings(timings):
+    """
+    Record the stages of the current thread in timings, used by worker threads serving part of a request.
+    """
+    previous = get_current_timings()
+    _current.timings = timings
+    try:
+        yield
+    finally:
+        _current.timings = previous
+
+
+@contextmanager
+def timed_stage(stage):
+    timings = get_current_timings()
+    if timings is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings.add(stage, time.time() - start)
+
+
+def _get_server_timing_header(stages, total):
+    return ', '.join(['%s;dur=%.1f' % (s, d) for s, d in stages] + ['total;dur=%.1f' % total])
+
+
+def _report_timings(request, response, timings):
+    total = timings.elapsed()
+    stages = timings.stages()
+    if settings.SERVER_TIMING_ENABLED and response is not None:
+        response['Server-Timing'] = _get_server_timing_header(stages, total)
+    if settings.SLOW_REQUEST_THRESHOLD and total >= settings.SLOW_REQUEST_THRESHOLD:
+        logger.warning('Slow request %s (%.1fms): %s', request.get_full_path(), total,
+                       ', '.join('%s %.1fms' % (s, d) for s, d in stages))
+    elif logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Request timings %s', json.dumps({
+            'path': request.path,
+            'total': round(total, 1),
+            'stages': OrderedDict((s, round(d, 1)) for s, d in stages)
+        }))
+
+
+def session_checked(view):
+    """
+    Decorator recording the time passed since the request started as the 'session' stage, to be applied
+    under the login_required decorator.
+    """
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        timings = get_current_timings()
+        if timings is not None:
+            timings.add('session', time.time() - timings.start)
+        return view(request, *args, **kwargs)
+    return wrapped
+
+
+def timed_view(view):
+    """
+    Decorator collecting the stages timings of the requests served by view, reported as a Server-Timing
+    header (if enabled) and in the logs.
+    """
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        timings = RequestTimings()
+        response = None
+        with bind_timings(timings):
+            try:
+                response = view(request, *args, **kwargs)
+            finally:
+                _report_timings(request, response, timings)
+        return response
+    return wrapped
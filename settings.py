@@ -60,12 +60,115 @@ CUSTOM_SETTINGS_MAPPINGS = {
                                                                  'omero', identity, None],
     'omero.web.ome_seadragon.thumbnails.secondary_rendering_engine': ['SECONDARY_THUMBNAILS_RENDERING_ENGINE',
                                                                       'openslide', identity, None],
+    # rendering engine that worked for each image, remembered for ttl seconds to skip failing primary engines
+    'omero.web.ome_seadragon.rendering_engines.memo_max_entries': ['ENGINES_MEMO_MAX_ENTRIES', 4096,
+                                                                   int_identity, None],
+    'omero.web.ome_seadragon.rendering_engines.memo_ttl': ['ENGINES_MEMO_TTL', 3600, int_identity, None],
     # deepzoom properties
     'omero.web.ome_seadragon.deepzoom.overlap': ['DEEPZOOM_OVERLAP', 1, int_identity, None],
     'omero.web.ome_seadragon.deepzoom.format': ['DEEPZOOM_FORMAT', 'jpeg', identity, None],
     'omero.web.ome_seadragon.deepzoom.limit_bounds': ['DEEPZOOM_LIMIT_BOUNDS', True, bool_identity, None],
     'omero.web.ome_seadragon.deepzoom.jpeg_tile_quality': ['DEEPZOOM_JPEG_QUALITY', 90, int_identity, None],
+    # other formats that can be requested for tiles and thumbnails, using the URL suffix or the Accept header
+    'omero.web.ome_seadragon.deepzoom.enabled_formats': ['DEEPZOOM_ENABLED_FORMATS', 'jpeg,png,webp,avif',
+                                                         identity, None],
+    'omero.web.ome_seadragon.deepzoom.negotiate_format': ['DEEPZOOM_NEGOTIATE_FORMAT', False, bool_identity, None],
+    'omero.web.ome_seadragon.deepzoom.webp_tile_quality': ['DEEPZOOM_WEBP_QUALITY', 80, int_identity, None],
+    'omero.web.ome_seadragon.deepzoom.avif_tile_quality': ['DEEPZOOM_AVIF_QUALITY', 60, int_identity, None],
+    'omero.web.ome_seadragon.deepzoom.png_compress_level': ['DEEPZOOM_PNG_COMPRESS_LEVEL', 6, int_identity, None],
+    # Pillow resampling filters (nearest, box, bilinear, hamming, bicubic, lanczos) used to resize tiles,
+    # the fast one is used when the image must be shrunk by a small factor
+    'omero.web.ome_seadragon.deepzoom.resampling': ['DEEPZOOM_RESAMPLING', 'lanczos', identity, None],
+    'omero.web.ome_seadragon.deepzoom.fast_resampling': ['DEEPZOOM_FAST_RESAMPLING', 'bilinear', identity, None],
     'omero.web.ome_seadragon.deepzoom.tile_size': ['DEEPZOOM_TILE_SIZE', 256, int_identity, None],
+    # folder containing the tiles packs built with tools/dzi_pyramid_builder.py, tiles found in a pack
+    # are served without rendering them; a pack is ignored once its slide is replaced
+    'omero.web.ome_seadragon.deepzoom.tiles_packs_folder': ['TILES_PACKS_FOLDER', None, identity, None],
+    # tiles batch requests
+    'omero.web.ome_seadragon.deepzoom.batch.max_tiles': ['TILES_BATCH_MAX_TILES', 64, int_identity, None],
+    'omero.web.ome_seadragon.deepzoom.batch.workers': ['TILES_BATCH_WORKERS', 4, int_identity, None],
+    # thumbnails batch requests
+    'omero.web.ome_seadragon.thumbnails.batch.max_images': ['THUMBNAILS_BATCH_MAX_IMAGES', 100, int_identity, None],
+    # background prefetch of the tiles around (ring) and below (depth) the requested ones, tiles
+    # are rendered into the images cache so this has no effect if the cache is disabled
+    'omero.web.ome_seadragon.deepzoom.prefetch.enabled': ['TILES_PREFETCH_ENABLED', False, bool_identity, None],
+    'omero.web.ome_seadragon.deepzoom.prefetch.ring': ['TILES_PREFETCH_RING', 1, int_identity, None],
+    'omero.web.ome_seadragon.deepzoom.prefetch.depth': ['TILES_PREFETCH_DEPTH', 1, int_identity, None],
+    'omero.web.ome_seadragon.deepzoom.prefetch.workers': ['TILES_PREFETCH_WORKERS', 2, int_identity, None],
+    'omero.web.ome_seadragon.deepzoom.prefetch.queue_size': ['TILES_PREFETCH_QUEUE_SIZE', 256, int_identity, None],
+    'omero.web.ome_seadragon.deepzoom.prefetch.max_per_image': ['TILES_PREFETCH_MAX_PER_IMAGE', 32,
+                                                                int_identity, None],
+    # milliseconds a tile request waits for the tile to be rendered, after that an upscaled crop of the parent
+    # tile is returned if it is in the images cache and the rendering goes on in background; 0 disables it
+    'omero.web.ome_seadragon.deepzoom.render_deadline': ['TILES_RENDER_DEADLINE', 0, int_identity, None],
+    # renders that go on after the request that started them ended: workers refresh the tiles served stale
+    # (see images_cache.stale_time), queue_size also bounds the renders detached after the render_deadline;
+    # tiles with a render_deadline are rendered by up to deadline_workers threads, then by the requests
+    'omero.web.ome_seadragon.deepzoom.background_renders.workers': ['BACKGROUND_RENDERS_WORKERS', 2,
+                                                                    int_identity, None],
+    'omero.web.ome_seadragon.deepzoom.background_renders.queue_size': ['BACKGROUND_RENDERS_QUEUE_SIZE', 64,
+                                                                       int_identity, None],
+    'omero.web.ome_seadragon.deepzoom.background_renders.deadline_workers': ['BACKGROUND_RENDERS_DEADLINE_WORKERS',
+                                                                             16, int_identity, None],
+    # OpenSlide handles cache, set max_open_files to 0 to disable it
+    'omero.web.ome_seadragon.slides_cache.max_open_files': ['SLIDES_CACHE_MAX_OPEN', 32, int_identity, None],
+    # seconds after which an unused slide is closed, 0 means never
+    'omero.web.ome_seadragon.slides_cache.idle_timeout': ['SLIDES_CACHE_IDLE_TIMEOUT', 600, int_identity, None],
+    # slides geometry and metadata, computed once for each slide
+    'omero.web.ome_seadragon.slide_descriptors.max_entries': ['SLIDE_DESCRIPTORS_MAX_ENTRIES', 1024,
+                                                              int_identity, None],
+    # geometry of the images rendered by the OMERO engine, TTL is expressed in seconds, 0 means never
+    'omero.web.ome_seadragon.ome_geometry.max_entries': ['OME_GEOMETRY_MAX_ENTRIES', 1024, int_identity, None],
+    'omero.web.ome_seadragon.ome_geometry.ttl': ['OME_GEOMETRY_TTL', 3600, int_identity, None],
+    # backend used by the OMERO engine to build tiles: 'jpeg' renders JPEG regions on the server, 'raw' reads
+    # raw pixels and applies channels windows and colors locally; lookup tables and non linear mappings are
+    # not supported, images using them (or an unsupported pixels type) fall back to 'jpeg', counted by the
+    # ome_seadragon_raw_pixels_fallbacks_total metric; rendering settings used by 'raw' are cached for
+    # raw_settings_ttl seconds
+    'omero.web.ome_seadragon.ome_engine.tiles_backend': ['OME_TILES_BACKEND', 'jpeg', identity, None],
+    'omero.web.ome_seadragon.ome_engine.raw_settings_max_entries': ['OME_RAW_SETTINGS_MAX_ENTRIES', 1024,
+                                                                    int_identity, None],
+    'omero.web.ome_seadragon.ome_engine.raw_settings_ttl': ['OME_RAW_SETTINGS_TTL', 60, int_identity, None],
+    # render OMERO tiles in blocks of super_tile_size x super_tile_size DZI tiles with a single region
+    # request, the other tiles of the block are stored into the images cache; 1 disables super tiles
+    'omero.web.ome_seadragon.ome_engine.super_tile_size': ['OME_SUPERTILE_SIZE', 1, int_identity, None],
+    # pool of OMERO images with a prepared rendering engine, used by the OMERO rendering engine;
+    # idle timeout is expressed in seconds
+    'omero.web.ome_seadragon.ome_re_pool.enabled': ['OME_RE_POOL_ENABLED', False, bool_identity, None],
+    'omero.web.ome_seadragon.ome_re_pool.max_images': ['OME_RE_POOL_MAX_IMAGES', 64, int_identity, None],
+    'omero.web.ome_seadragon.ome_re_pool.max_per_image': ['OME_RE_POOL_MAX_PER_IMAGE', 2, int_identity, None],
+    'omero.web.ome_seadragon.ome_re_pool.idle_timeout': ['OME_RE_POOL_IDLE_TIMEOUT', 120, int_identity, None],
+    # connections joining the OMERO sessions of the requests, used by the rendering engines pool, tiles prefetching
+    # and background renders; idle timeout is expressed in seconds
+    'omero.web.ome_seadragon.session_connections.max_sessions': ['SESSION_CONNECTIONS_MAX_SESSIONS', 64,
+                                                                 int_identity, None],
+    'omero.web.ome_seadragon.session_connections.idle_timeout': ['SESSION_CONNECTIONS_IDLE_TIMEOUT', 120,
+                                                                 int_identity, None],
+    # cache of the filesystem paths resolved for images and original files, TTL is expressed in seconds
+    'omero.web.ome_seadragon.paths_cache.max_entries': ['PATHS_CACHE_MAX_ENTRIES', 4096, int_identity, None],
+    'omero.web.ome_seadragon.paths_cache.ttl': ['PATHS_CACHE_TTL', 300, int_identity, None],
+    # share resolved paths among workers using the images cache
+    'omero.web.ome_seadragon.paths_cache.shared': ['PATHS_CACHE_SHARED', False, bool_identity, None],
+    # HTTP validators (ETag, Last-Modified) and Cache-Control headers, max age values are expressed in seconds;
+    # responses are marked as private unless public is enabled
+    'omero.web.ome_seadragon.http_cache.enabled': ['HTTP_CACHE_ENABLED', False, bool_identity, None],
+    'omero.web.ome_seadragon.http_cache.public': ['HTTP_CACHE_PUBLIC', False, bool_identity, None],
+    'omero.web.ome_seadragon.http_cache.tiles_max_age': ['HTTP_CACHE_TILES_MAX_AGE', 86400, int_identity, None],
+    'omero.web.ome_seadragon.http_cache.thumbnails_max_age': ['HTTP_CACHE_THUMBNAILS_MAX_AGE', 3600,
+                                                              int_identity, None],
+    'omero.web.ome_seadragon.http_cache.descriptors_max_age': ['HTTP_CACHE_DESCRIPTORS_MAX_AGE', 300,
+                                                               int_identity, None],
+    'omero.web.ome_seadragon.http_cache.arrays_max_age': ['HTTP_CACHE_ARRAYS_MAX_AGE', 86400, int_identity, None],
+    # add a Server-Timing header with the time spent in each stage to DeepZoom and arrays responses,
+    # requests slower than slow_request_threshold milliseconds are logged with the same details (0 disables it)
+    'omero.web.ome_seadragon.server_timing.enabled': ['SERVER_TIMING_ENABLED', False, bool_identity, None],
+    'omero.web.ome_seadragon.server_timing.slow_request_threshold': ['SLOW_REQUEST_THRESHOLD', 0,
+                                                                     int_identity, None],
+    # export Prometheus metrics (requires prometheus_client) with the metrics/ view, which doesn't require
+    # a login; when OMERO.web runs more than one worker process, multiproc_dir must point to a folder shared
+    # by all of them (emptied before OMERO.web starts) so that metrics are aggregated
+    'omero.web.ome_seadragon.metrics.enabled': ['METRICS_ENABLED', False, bool_identity, None],
+    'omero.web.ome_seadragon.metrics.multiproc_dir': ['METRICS_MULTIPROC_DIR', None, identity, None],
     # images cache
     'omero.web.ome_seadragon.images_cache.cache_enabled': ['IMAGES_CACHE_ENABLED', False, bool_identity, None],
     'omero.web.ome_seadragon.images_cache.driver': ['IMAGES_CACHE_DRIVER', None, identity, None],
@@ -73,10 +176,35 @@ CUSTOM_SETTINGS_MAPPINGS = {
     # days, hours, minutes, seconds
     # missing keys will be set to 0 by default
     'omero.web.ome_seadragon.images_cache.expire_time': ['CACHE_EXPIRE_TIME', None, identity, None],
+    # use the images cache to prevent different workers from rendering the same image at the same time,
+    # timeout is expressed in seconds
+    'omero.web.ome_seadragon.images_cache.render_locks': ['IMAGES_CACHE_RENDER_LOCKS', False, bool_identity, None],
+    'omero.web.ome_seadragon.images_cache.render_lock_timeout': ['IMAGES_CACHE_RENDER_LOCK_TIMEOUT', 10,
+                                                                 int_identity, None],
+    # seconds expired tiles are still served, while they are rendered again in background; 0 disables it
+    'omero.web.ome_seadragon.images_cache.stale_time': ['IMAGES_CACHE_STALE_TIME', 0, int_identity, None],
+    # seconds a process can keep using the cache generation of an image after it has been changed by another
+    # process (images are replaced or removed by the original files registration and deletion views)
+    'omero.web.ome_seadragon.images_cache.generation_ttl': ['IMAGES_CACHE_GENERATION_TTL', 5, int_identity, None],
+    # size (in bytes) of the in-process cache kept by each worker in front of the images cache driver,
+    # 0 disables it
+    'omero.web.ome_seadragon.images_cache.local_max_bytes': ['IMAGES_CACHE_LOCAL_MAX_BYTES', 67108864,
+                                                             int_identity, None],
+    # seconds entries are kept by the in-process cache, capped to a tenth of the images cache expire time
+    'omero.web.ome_seadragon.images_cache.local_ttl': ['IMAGES_CACHE_LOCAL_TTL', 60, int_identity, None],
     # redis config
     'omero.web.ome_seadragon.images_cache.host': ['CACHE_HOST', None, identity, None],
     'omero.web.ome_seadragon.images_cache.port': ['CACHE_PORT', None, identity, None],
     'omero.web.ome_seadragon.images_cache.database': ['CACHE_DB', None, identity, None],
+    # timeout (in milliseconds) of the redis socket operations, a slow or unreachable server is treated
+    # as a cache miss instead of blocking the request; 0 means no timeout
+    'omero.web.ome_seadragon.images_cache.socket_timeout': ['CACHE_SOCKET_TIMEOUT', 500, int_identity, None],
+    # maximum number of connections kept by each process, 0 means no limit
+    'omero.web.ome_seadragon.images_cache.max_connections': ['CACHE_MAX_CONNECTIONS', 0, int_identity, None],
+    # disk config
+    'omero.web.ome_seadragon.images_cache.disk.path': ['CACHE_DISK_PATH', None, identity, None],
+    # maximum size of the disk cache, 0 means no limit (entries are only removed when they expire)
+    'omero.web.ome_seadragon.images_cache.disk.max_bytes': ['CACHE_DISK_MAX_BYTES', 10737418240, int_identity, None],
     # arrays datasets config
     'omero.web.ome_seadragon.dzi_adapter.datasets.repository': ['DATASETS_REPOSITORY', None, identity, None]
 }
@@ -17,8 +17,15 @@
 #  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 #  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import logging
+import threading
+
+from ..lru_cache import LRUCache
+from ..metrics import count_engine_fallback
 from .. import settings
 
+logger = logging.getLogger(__name__)
+
 
 class UnknownRenderingEngine(Exception):
     pass
@@ -54,7 +61,7 @@ class RenderingEngineFactory(object):
         if engine == 'omero':
             return self._get_omero_engine(image_id, connection)
         else:
-            raise UnknownRenderingEngine('%s is not a valid rendering engine' % self.primary_thumbnails_rendering_engine)
+            raise UnknownRenderingEngine('%s is not a valid rendering engine' % engine)
 
     def get_primary_tiles_rendering_engine(self, image_id, connection):
         return self._get_engine(self.primary_tiles_rendering_engine, image_id, connection)
@@ -73,3 +80,72 @@ class RenderingEngineFactory(object):
             return self._get_engine(self.secondary_thumbnails_rendering_engine, image_id, connection)
         else:
             return None
+
+    def _call_engines(self, engines_kind, engines, image_id, connection, call, original_file_source,
+                      file_mimetype):
+        memo_key = (engines_kind, str(image_id), bool(original_file_source), file_mimetype)
+        engines = [e for e in engines if e]
+        # start from the engine that worked the last time for this image, if any
+        working_engine = get_engines_memo().get(memo_key)
+        if working_engine in engines:
+            engines.remove(working_engine)
+            engines.insert(0, working_engine)
+            _increase_engines_counter('memo_hits')
+        for index, engine in enumerate(engines):
+            try:
+                result = call(self._get_engine(engine, image_id, connection))
+            except Exception as e:
+                if index == len(engines) - 1:
+                    raise
+                logger.warning('%s engine failed for image %s, trying the next one: %s', engine, image_id, e)
+                _increase_engines_counter('fallbacks')
+                count_engine_fallback(engines_kind, engine)
+                continue
+            get_engines_memo().set(memo_key, engine)
+            return result
+
+    def call_tiles_engine(self, image_id, connection, call, original_file_source=False, file_mimetype=None):
+        """
+        Return call(engine), where engine is the tiles rendering engine that works for the image: the primary
+        one, or the secondary one if the primary raises an exception. The working engine is remembered, so
+        following requests for the same image go straight to it.
+        """
+        return self._call_engines('tiles',
+                                  [self.primary_tiles_rendering_engine, self.secondary_tiles_rendering_engine],
+                                  image_id, connection, call, original_file_source, file_mimetype)
+
+    def call_thumbnails_engine(self, image_id, connection, call, original_file_source=False, file_mimetype=None):
+        """
+        Same as call_tiles_engine, using the thumbnails rendering engines.
+        """
+        return self._call_engines('thumbnails',
+                                  [self.primary_thumbnails_rendering_engine,
+                                   self.secondary_thumbnails_rendering_engine],
+                                  image_id, connection, call, original_file_source, file_mimetype)
+
+
+_engines_memo = None
+_engines_memo_lock = threading.Lock()
+_engines_counters = {'memo_hits': 0, 'fallbacks': 0}
+_engines_counters_lock = threading.Lock()
+
+
+def get_engines_memo():
+    global _engines_memo
+    if _engines_memo is None:
+        with _engines_memo_lock:
+            if _engines_memo is None:
+                _engines_memo = LRUCache(settings.ENGINES_MEMO_MAX_ENTRIES, ttl=settings.ENGINES_MEMO_TTL or None)
+    return _engines_memo
+
+
+def _increase_engines_counter(counter):
+    with _engines_counters_lock:
+        _engines_counters[counter] += 1
+
+
+def get_engines_stats():
+    stats = get_engines_memo().stats()
+    with _engines_counters_lock:
+        stats.update(_engines_counters)
+    return stats
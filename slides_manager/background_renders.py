@@ -0,0 +1,147 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .. import settings
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundRenders(object):
+    """
+    Run renders that can outlive the request that started them: tiles refreshed after being served
+    stale from the images cache are queued to a pool of workers, renders with a deadline run on a pool of
+    deadline_workers and are detached from the request if they miss it. Renders submitted with the same key
+    while one is running share it; when too many renders are queued or detached, new ones are rejected.
+    """
+
+    def __init__(self, workers, max_queue_size, deadline_workers):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ome_seadragon_render')
+        self._deadline_executor = ThreadPoolExecutor(max_workers=deadline_workers,
+                                                     thread_name_prefix='ome_seadragon_deadline_render')
+        self.max_queue_size = max_queue_size
+        self.deadline_workers = deadline_workers
+        self._lock = threading.Lock()
+        self._running = {}
+        self._queued = 0
+        self._deadline_renders = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.failed = 0
+        self.saturated = 0
+
+    def _run(self, key, render):
+        try:
+            return render()
+        except Exception as e:
+            logger.debug('Background render %r failed: %s', key, e)
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self._queued -= 1
+                if key is not None:
+                    self._running.pop(key, None)
+
+    def _detached_done(self, future):
+        with self._lock:
+            self._queued -= 1
+            if future.exception() is not None:
+                self.failed += 1
+
+    def _run_deadline_render(self, render):
+        try:
+            return render()
+        finally:
+            with self._lock:
+                self._deadline_renders -= 1
+
+    def start(self, render):
+        """
+        Run render on one of the deadline workers, returning its future; the caller waits for it and can
+        detach it. Returns None if all the deadline workers are busy, the caller must then run render itself.
+        """
+        with self._lock:
+            if self._deadline_renders >= self.deadline_workers:
+                self.saturated += 1
+                return None
+            self._deadline_renders += 1
+        return self._deadline_executor.submit(self._run_deadline_render, render)
+
+    def detach(self, future):
+        """
+        Let a render returned by start go on after its request has ended. Returns False if there is no
+        room for it, the caller must then wait for the render to complete.
+        """
+        with self._lock:
+            if self._queued >= self.max_queue_size:
+                self.rejected += 1
+                return False
+            self._queued += 1
+            self.submitted += 1
+        future.add_done_callback(self._detached_done)
+        return True
+
+    def submit(self, key, render):
+        """
+        Schedule render, returning its future or None if the queue is full. If key is not None and a render
+        with the same key is still running, its future is returned instead.
+        """
+        with self._lock:
+            if key is not None and key in self._running:
+                return self._running[key]
+            if self._queued >= self.max_queue_size:
+                self.rejected += 1
+                return None
+            future = self._executor.submit(self._run, key, render)
+            self._queued += 1
+            self.submitted += 1
+            if key is not None:
+                self._running[key] = future
+        return future
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': self._queued,
+                'deadline_renders': self._deadline_renders,
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'failed': self.failed,
+                'saturated': self.saturated
+            }
+
+
+_background_renders = None
+_background_renders_lock = threading.Lock()
+
+
+def get_background_renders():
+    global _background_renders
+    if _background_renders is None:
+        with _background_renders_lock:
+            if _background_renders is None:
+                _background_renders = BackgroundRenders(settings.BACKGROUND_RENDERS_WORKERS,
+                                                        settings.BACKGROUND_RENDERS_QUEUE_SIZE,
+                                                        settings.BACKGROUND_RENDERS_DEADLINE_WORKERS)
+    return _background_renders
@@ -20,3 +20,10 @@
 
 class UnsupportedSource(Exception):
     pass
+
+
+class UnsupportedRenderingSettings(Exception):
+
+    def __init__(self, message, reason):
+        super(UnsupportedRenderingSettings, self).__init__(message)
+        self.reason = reason
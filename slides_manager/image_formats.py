@@ -0,0 +1,105 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from io import BytesIO
+
+from PIL import Image, features
+
+from .. import settings
+
+# formats the server can encode tiles to, in order of preference when negotiated using the Accept header
+_FORMATS_PREFERENCE = ('avif', 'webp', 'jpeg', 'png')
+
+_FORMATS_ALIASES = {
+    'jpg': 'jpeg'
+}
+
+
+class UnsupportedImageFormat(Exception):
+    pass
+
+
+def _is_encoder_available(image_format):
+    if image_format == 'webp':
+        return features.check('webp')
+    if image_format == 'avif':
+        Image.init()
+        return 'AVIF' in Image.SAVE
+    return True
+
+
+def get_supported_formats():
+    enabled_formats = [f.strip().lower() for f in settings.DEEPZOOM_ENABLED_FORMATS.split(',')]
+    return [f for f in _FORMATS_PREFERENCE if f in enabled_formats and _is_encoder_available(f)]
+
+
+def normalize_format(image_format):
+    image_format = image_format.lower()
+    return _FORMATS_ALIASES.get(image_format, image_format)
+
+
+def get_image_format(requested_format=None, accept_header=None):
+    """
+    Pick the format used to encode an image. An explicit format different from the default one always
+    wins, otherwise, if format negotiation is enabled, the best format accepted by the client is used.
+    Raises UnsupportedImageFormat if the requested format can't be produced.
+    """
+    default_format = normalize_format(settings.DEEPZOOM_FORMAT)
+    if requested_format is not None:
+        requested_format = normalize_format(requested_format)
+        if requested_format != default_format:
+            if requested_format not in get_supported_formats():
+                raise UnsupportedImageFormat('Format %s not supported by the server' % requested_format)
+            return requested_format
+    if settings.DEEPZOOM_NEGOTIATE_FORMAT and accept_header:
+        accepted = [a.split(';')[0].strip().lower() for a in accept_header.split(',')]
+        for image_format in get_supported_formats():
+            if 'image/%s' % image_format in accepted:
+                return image_format
+    return default_format
+
+
+def get_content_type(image_format):
+    return 'image/%s' % normalize_format(image_format)
+
+
+def get_image_quality(image_format):
+    image_format = normalize_format(image_format)
+    if image_format == 'jpeg':
+        return settings.DEEPZOOM_JPEG_QUALITY
+    if image_format == 'webp':
+        return settings.DEEPZOOM_WEBP_QUALITY
+    if image_format == 'avif':
+        return settings.DEEPZOOM_AVIF_QUALITY
+    return None
+
+
+# image_quality and png_compress_level default to the DeepZoom settings of the server
+def encode_image(image, image_format, image_quality=None, png_compress_level=None):
+    image_format = normalize_format(image_format)
+    save_params = {'format': image_format}
+    quality = image_quality if image_quality is not None else get_image_quality(image_format)
+    if quality is not None:
+        save_params['quality'] = quality
+    if image_format == 'png':
+        save_params['compress_level'] = png_compress_level if png_compress_level is not None \
+            else settings.DEEPZOOM_PNG_COMPRESS_LEVEL
+    image_buffer = BytesIO()
+    image.save(image_buffer, **save_params)
+    return image_buffer.getvalue()
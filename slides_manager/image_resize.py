@@ -0,0 +1,76 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+from PIL import Image
+
+from .. import settings
+
+# when, after the integer reduction, an image must be shrunk by less than this factor the fast
+# resampling filter is used, the difference with the default one is barely visible
+_FAST_RESAMPLING_MAX_FACTOR = 1.5
+
+
+class UnknownResamplingFilter(Exception):
+    pass
+
+
+def get_resampling_filter(name):
+    try:
+        return getattr(Image, name.upper())
+    except AttributeError:
+        raise UnknownResamplingFilter('%s is not a valid resampling filter' % name)
+
+
+def crop_child_tile(parent_tile, column, row, tile_size):
+    """
+    Crop the region of parent_tile, a tile of the previous DeepZoom level, covered by tile (column, row)
+    and scale it to the size of the tile; returns None if the tile is not inside the parent one.
+    Overlap between tiles is ignored, the result is meant to be a temporary replacement of the tile.
+    """
+    half_size = tile_size // 2
+    x, y = (column % 2) * half_size, (row % 2) * half_size
+    width, height = min(half_size, parent_tile.width - x), min(half_size, parent_tile.height - y)
+    if width <= 0 or height <= 0:
+        return None
+    return parent_tile.crop((x, y, x + width, y + height)).resize(
+        (width * 2, height * 2), get_resampling_filter(settings.DEEPZOOM_FAST_RESAMPLING)
+    )
+
+
+def resize_image(image, size):
+    """
+    Resize image to size, shrinking it as much as possible with cheap operations first: DCT scaling
+    while decoding (for JPEG images that have not been loaded yet) and Image.reduce for integer factors.
+    """
+    width, height = size
+    if image.size == (width, height):
+        return image
+    # no-op for images that aren't JPEGs or that have already been decoded
+    image.draft(None, (width, height))
+    factor = min(image.width // width, image.height // height)
+    if factor >= 2:
+        image = image.reduce(factor)
+    if image.size == (width, height):
+        return image
+    if image.width < width * _FAST_RESAMPLING_MAX_FACTOR and image.width >= width:
+        resampling = settings.DEEPZOOM_FAST_RESAMPLING
+    else:
+        resampling = settings.DEEPZOOM_RESAMPLING
+    return image.resize((width, height), get_resampling_filter(resampling))
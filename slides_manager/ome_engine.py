@@ -17,118 +17,149 @@
 #  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 #  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import math
+from contextlib import contextmanager
+import time
+
 from lxml import etree
 from PIL import Image
 from io import BytesIO
 
-from .errors import UnsupportedSource
+from .errors import UnsupportedRenderingSettings, UnsupportedSource
+from .image_formats import encode_image, get_image_quality, normalize_format
+from .image_resize import resize_image
+from .ome_geometry import get_ome_geometries
+from .ome_raw_pixels import RawPixelsRenderer, get_channels_settings
+from .rendering_engines_pool import get_rendering_engines_pool
 
 from .rendering_engine_interface import RenderingEngineInterface
+from ..metrics import count_raw_pixels_fallback
+from ..server_timing import timed_stage
 from .. import settings
-from ome_seadragon_cache import CacheDriverFactory
+from ..images_cache import get_images_cache
 
 
 class OmeEngine(RenderingEngineInterface):
 
+    rendering_engine_name = 'omero'
+
     def __init__(self, image_id, connection):
         super(OmeEngine, self).__init__(image_id, connection)
+        # raw pixels renderer shared by the tiles of a batch
+        self._raw_pixels_renderer = None
 
-    def _get_dzi_max_level(self, img=None):
-        if img is None:
-            img = self._get_image_object(get_biggest_in_fileset=True)
-        x = img.getSizeX()
-        y = img.getSizeY()
-        return int(math.ceil(math.log(max(x, y), 2)))
+    def _get_geometry(self):
+        with timed_stage('geometry'):
+            return get_ome_geometries().get_geometry(self.connection, self.image_id)
 
-    def _get_dzi_scale_factor(self, level, img=None):
-        max_level = self._get_dzi_max_level(img)
-        if level > max_level:
-            raise ValueError('Level %d is higher than max DZI level for the image' % level)
-        return math.pow(0.5, max_level - level)
-
-    def _get_ome_scale_map(self, img=None, swap_keys=False):
-        if img is None:
-            img = self._get_image_object(get_biggest_in_fileset=True)
-        tmp_map = img.getZoomLevelScaling()
-        ome_scale_map = dict((len(tmp_map) - k - 1, v) for k, v in tmp_map.items())
-        if not swap_keys:
-            return ome_scale_map
+    # if the rendering engines pool is enabled, images come from the pool and their rendering engine
+    # is reused by the following requests
+    @contextmanager
+    def _get_ome_image(self, image_id):
+        if settings.OME_RE_POOL_ENABLED:
+            with get_rendering_engines_pool().image(self.connection, image_id) as ome_img:
+                yield ome_img
         else:
-            return dict((v, k) for k, v in ome_scale_map.items())
-
-    def _get_ome_scale_factor(self, level, img=None):
-        return self._get_ome_scale_map(img)[level]
-
-    def _get_best_downscale_level(self, level, img_obj=None):
-        ome_scale_map = self._get_ome_scale_map(img_obj, swap_keys=True)
-        dzi_scale_factor = self._get_dzi_scale_factor(level, img_obj)
-        for ome_scale_factor, ome_level in sorted(ome_scale_map.items(), reverse=True):
-            if ome_scale_factor < dzi_scale_factor:
-                return ome_level + 1
-        return ome_level
-
-    def _get_scale_factor(self, original_x, original_y, ome_scale_factor, dzi_scale_factor):
-        ome_w = original_x * ome_scale_factor
-        ome_h = original_y * ome_scale_factor
-        ome_diag = math.sqrt(math.pow(ome_w, 2) + math.pow(ome_h, 2))
-        dzi_w = original_x * dzi_scale_factor
-        dzi_h = original_y * dzi_scale_factor
-        dzi_diag = math.sqrt(math.pow(dzi_w, 2) + math.pow(dzi_h, 2))
-        return ome_diag / dzi_diag
-
-    def _get_ome_tile(self, ome_img, ome_level, dzi_level, column, row, tile_size=None):
-        tile_size = tile_size if tile_size is not None else settings.DEEPZOOM_TILE_SIZE
-        scale_factor = self._get_scale_factor(ome_img.getSizeX(), ome_img.getSizeY(),
-                                              self._get_ome_scale_factor(ome_level, ome_img),
-                                              self._get_dzi_scale_factor(dzi_level, ome_img))
+            with timed_stage('get_object'):
+                ome_img = self.connection.getObject('Image', image_id)
+            yield ome_img
+
+    def _use_raw_pixels(self):
+        return settings.OME_TILES_BACKEND == 'raw'
+
+    @contextmanager
+    def _get_raw_pixels_renderer(self, ome_img):
+        renderer = self._raw_pixels_renderer
+        if renderer is not None and renderer.image_id == ome_img.getId():
+            yield renderer
+        else:
+            renderer = RawPixelsRenderer(self.connection, ome_img,
+                                         get_channels_settings(self.connection, ome_img))
+            try:
+                yield renderer
+            finally:
+                renderer.close()
+
+    # render a region of an OMERO level from raw pixels, returns None if the rendering settings of the
+    # image can't be applied by the raw pixels backend
+    def _render_raw_region(self, ome_img, ome_level, x, y, width, height):
+        try:
+            with self._get_raw_pixels_renderer(ome_img) as renderer, timed_stage('render'):
+                return renderer.render_region(ome_level, x, y, width, height)
+        except UnsupportedRenderingSettings as urs:
+            self.logger.debug('%s, using JPEG regions for image %s', urs, ome_img.getId())
+            count_raw_pixels_fallback(urs.reason)
+            return None
+
+    # returns the OMERO level, the scale factor and the (x, y, width, height) region of the OMERO level
+    # that must be rendered to build the required DZI tile; the region is rounded to whole pixels and
+    # clipped to the level, so that a tile cut from a super tile is the same as the tile rendered alone
+    def _get_ome_tile_region(self, geometry, dzi_level, column, row, tile_size):
+        if dzi_level > geometry['dzi_max_level']:
+            raise ValueError('Level %d is higher than max DZI level for the image' % dzi_level)
+        ome_level = geometry['dzi_levels'][dzi_level]['ome_level']
+        scale_factor = geometry['dzi_levels'][dzi_level]['scale_factor']
         ome_tile_size = (tile_size + 2 * settings.DEEPZOOM_OVERLAP) * scale_factor
         ome_x = row * (tile_size * scale_factor)
         if ome_x != 0:
             ome_x -= settings.DEEPZOOM_OVERLAP * scale_factor
-        ome_y = column * (settings.DEEPZOOM_TILE_SIZE * scale_factor)
+        ome_y = column * (tile_size * scale_factor)
         if ome_y != 0:
             ome_y -= settings.DEEPZOOM_OVERLAP * scale_factor
-        if ome_x == 0 or (ome_x + ome_tile_size >= ome_img.getSizeX()):
+        if ome_x == 0 or (ome_x + ome_tile_size >= geometry['size_x']):
             ome_tile_size_x = ome_tile_size - (settings.DEEPZOOM_OVERLAP * scale_factor)
         else:
             ome_tile_size_x = ome_tile_size
-        if ome_y == 0 or (ome_y + ome_tile_size >= ome_img.getSizeY()):
+        if ome_y == 0 or (ome_y + ome_tile_size >= geometry['size_y']):
             ome_tile_size_y = ome_tile_size - (settings.DEEPZOOM_OVERLAP * scale_factor)
         else:
             ome_tile_size_y = ome_tile_size
+        level_w = int(geometry['size_x'] * geometry['ome_scales'][ome_level])
+        level_h = int(geometry['size_y'] * geometry['ome_scales'][ome_level])
+        x, y = int(round(ome_x)), int(round(ome_y))
+        width = min(int(round(ome_x + ome_tile_size_x)), level_w) - x
+        height = min(int(round(ome_y + ome_tile_size_y)), level_h) - y
+        return ome_level, scale_factor, (x, y, width, height)
+
+    def _resize_ome_tile(self, ome_tile, scale_factor):
+        if scale_factor != 1:
+            self.logger.debug('Scale factor is %s resize tile', scale_factor)
+            tile_w, tile_h = ome_tile.size
+            return resize_image(ome_tile, (int(round(tile_w / scale_factor)), int(round(tile_h / scale_factor))))
+        return ome_tile
+
+    def _get_ome_tile(self, ome_img, geometry, dzi_level, column, row, tile_size=None, image_format=None):
+        tile_size = tile_size if tile_size is not None else settings.DEEPZOOM_TILE_SIZE
+        image_format = self._get_image_format(image_format)
+        ome_level, scale_factor, (ome_x, ome_y, ome_tile_size_x, ome_tile_size_y) = \
+            self._get_ome_tile_region(geometry, dzi_level, column, row, tile_size)
         # right now, we don't handle Z and T levels
         self.logger.debug('Getting tile with settings: X %s Y %s W %s H %s L %s', ome_x, ome_y,
                           ome_tile_size_x, ome_tile_size_y, ome_level)
         try:
-            tile_buffer = BytesIO(ome_img.renderJpegRegion(0, 0, ome_x, ome_y, ome_tile_size_x,
-                                                           ome_tile_size_y, level=ome_level,
-                                                           compression=settings.DEEPZOOM_JPEG_QUALITY/100.0))
-            ome_tile = Image.open(tile_buffer)
-            tile_w, tile_h = ome_tile.size
-            if scale_factor != 1:
-                self.logger.debug('Scale factor is %s resize tile', scale_factor)
-                tile = ome_tile.resize((int(round(tile_w / scale_factor)),
-                                        int(round(tile_h / scale_factor))),
-                                       Image.ANTIALIAS)
-            else:
-                tile = ome_tile
-            return tile
+            if self._use_raw_pixels():
+                ome_tile = self._render_raw_region(ome_img, ome_level, ome_x, ome_y,
+                                                   ome_tile_size_x, ome_tile_size_y)
+                if ome_tile is not None:
+                    return self._encode_image(self._resize_ome_tile(ome_tile, scale_factor), image_format)
+            with timed_stage('render'):
+                jpeg_tile = ome_img.renderJpegRegion(0, 0, ome_x, ome_y, ome_tile_size_x,
+                                                     ome_tile_size_y, level=ome_level,
+                                                     compression=settings.DEEPZOOM_JPEG_QUALITY/100.0)
+            if scale_factor == 1 and image_format == 'jpeg':
+                # OMERO already encoded the tile as we need it, no need to decode it
+                return jpeg_tile
+            ome_tile = Image.open(BytesIO(jpeg_tile))
+            return self._encode_image(self._resize_ome_tile(ome_tile, scale_factor), image_format)
         except TypeError:
             # return a white tile
-            return Image.new('RGB', (tile_size, tile_size), 'white')
+            return self._encode_image(Image.new('RGB', (tile_size, tile_size), 'white'), image_format)
 
     def _get_image_mpp(self, original_file_source=False, file_mimetype=None):
         self._check_source_type(original_file_source)
-        img = self._get_image_object(get_biggest_in_fileset=True)
-        if img:
-            try:
-                mpp = (img.getPixelSizeX() + img.getPixelSizeY()) / 2.0
-            except TypeError:
-                mpp = 0
-        else:
-            mpp = 0
-        return mpp
+        geometry = self._get_geometry()
+        if geometry:
+            return geometry['mpp']
+        return 0
 
     def _check_source_type(self, original_file_source):
         if original_file_source:
@@ -148,14 +179,22 @@ class OmeEngine(RenderingEngineInterface):
                 'bounds_width': 0
             }
 
+    def get_json_description(self, resource_path, original_file_source=False, file_mimetype=None, tile_size=None):
+        self._check_source_type(original_file_source)
+        geometry = self._get_geometry()
+        if geometry:
+            return self._get_json_description(resource_path, geometry['size_y'], geometry['size_x'], tile_size)
+        else:
+            return None
+
     def _get_original_file_json_description(self, resource_path, file_mimetype=None, tile_size=None, limit_bounds=None):
         raise NotImplemented()
 
     def get_dzi_description(self, original_file_source=False, file_mimetype=None, tile_size=None, limit_bounds=None):
         tile_size = tile_size if tile_size is not None else settings.DEEPZOOM_TILE_SIZE
         self._check_source_type(original_file_source)
-        img = self._get_image_object(get_biggest_in_fileset=True)
-        if img:
+        geometry = self._get_geometry()
+        if geometry:
             dzi_root = etree.Element(
                 'Image',
                 attrib={
@@ -166,65 +205,201 @@ class OmeEngine(RenderingEngineInterface):
                 nsmap={None: 'http://schemas.microsoft.com/deepzoom/2008'}
             )
             etree.SubElement(dzi_root, 'Size',
-                             attrib={'Height': str(img.getSizeY()), 'Width': str(img.getSizeX())})
+                             attrib={'Height': str(geometry['size_y']), 'Width': str(geometry['size_x'])})
             return etree.tostring(dzi_root)
         else:
             return None
 
-    def get_thumbnail(self, size, original_file_source=False, file_mimeype=None):
+    def _render_thumbnail(self, size, image_format, cache=None):
+        self.logger.debug('No thumbnail loaded from cache, building it')
+        # we want the thumbnail of the image, not the one of the highest resolution image in fileset
+        with self._get_ome_image(self.image_id) as ome_img:
+            if ome_img is None:
+                return None
+            if ome_img.getSizeX() >= ome_img.getSizeY():
+                th_size = (size, )
+            else:
+                th_w = size * (float(ome_img.getSizeX()) / ome_img.getSizeY())
+                th_size = (th_w, size)
+            with timed_stage('render'):
+                thumbnail = ome_img.getThumbnail(size=th_size)
+            # OMERO thumbnails are JPEG images
+        if image_format != 'jpeg':
+            thumbnail = self._encode_image(Image.open(BytesIO(thumbnail)), image_format)
+        if cache is not None:
+            cache.thumbnail_to_cache(self.image_id, thumbnail, size, image_format, 'omero',
+                                     self._get_image_quality(image_format))
+        return thumbnail
+
+    def get_thumbnail(self, size, original_file_source=False, file_mimeype=None, image_format=None):
         self._check_source_type(original_file_source)
-        if settings.IMAGES_CACHE_ENABLED:
-            cache = CacheDriverFactory(settings.IMAGES_CACHE_DRIVER). \
-                get_cache(settings.CACHE_HOST, settings.CACHE_PORT, settings.CACHE_DB, settings.CACHE_EXPIRE_TIME)
-            thumbnail = cache.thumbnail_from_cache(self.image_id, size, settings.DEEPZOOM_FORMAT, 'omero')
+        image_format = self._get_image_format(image_format)
+        cache = get_images_cache()
+        if cache is not None:
+            cache_lookup = lambda: cache.thumbnail_from_cache(self.image_id, size, image_format, 'omero',
+                                                              self._get_image_quality(image_format))
+            thumbnail = cache_lookup()
         else:
+            cache_lookup = None
             thumbnail = None
         if thumbnail is None:
-            self.logger.debug('No thumbnail loaded from cache, building it')
-            # we want the thumbnail of the image, not the one of the highest resolution image in fileset
-            ome_img = self._get_image_object()
-            if ome_img:
-                if ome_img.getSizeX() >= ome_img.getSizeY():
-                    th_size = (size, )
-                else:
-                    th_w = size * (float(ome_img.getSizeX()) / ome_img.getSizeY())
-                    th_size = (th_w, size)
-                thumbnail_buffer = BytesIO(ome_img.getThumbnail(size=th_size))
-                thumbnail = Image.open(thumbnail_buffer)
-                if settings.IMAGES_CACHE_ENABLED:
-                    cache.thumbnail_to_cache(self.image_id, thumbnail, size, settings.DEEPZOOM_FORMAT, 'omero')
+            thumbnail = self._coalesced_render(self._get_thumbnail_render_key('omero', size, image_format),
+                                               lambda: self._render_thumbnail(size, image_format, cache),
+                                               cache, cache_lookup)
         else:
             self.logger.debug('Thumbnail loaded from cache')
-        return thumbnail, settings.DEEPZOOM_FORMAT
+        return thumbnail, self._get_content_type(image_format)
+
+    def _render_tile(self, level, column, row, tile_size, image_format, cache=None, cache_params=None):
+        geometry = self._get_geometry()
+        if geometry is None:
+            return None
+        start = time.time()
+        # load the highest resolution image directly, its ID is part of the geometry
+        with self._get_ome_image(geometry['image_id']) as ome_img:
+            if ome_img is None:
+                return None
+            tile = self._get_ome_tile(ome_img, geometry, level, row=column, column=row, tile_size=tile_size,
+                                      image_format=image_format)
+        self._observe_tiles_render(level, start, [tile])
+        if cache is not None:
+            cache.tile_to_cache(image_data=tile, **cache_params)
+        return tile
+
+    def _prepare_tiles_batch(self, original_file_source, file_mimetype, tile_size, limit_bounds):
+        if self._use_raw_pixels():
+            geometry = self._get_geometry()
+            ome_img = self.connection.getObject('Image', geometry['image_id']) if geometry else None
+            if ome_img is not None:
+                try:
+                    self._raw_pixels_renderer = RawPixelsRenderer(self.connection, ome_img,
+                                                                  get_channels_settings(self.connection, ome_img))
+                except UnsupportedRenderingSettings as urs:
+                    self.logger.debug('%s, using JPEG regions for image %s', urs, ome_img.getId())
+
+    def _finish_tiles_batch(self):
+        renderer, self._raw_pixels_renderer = self._raw_pixels_renderer, None
+        if renderer is not None:
+            renderer.close()
+
+    def _use_supertiles(self, cache):
+        # tiles of a super tile other than the requested one are only useful if they can be cached
+        return cache is not None and settings.OME_SUPERTILE_SIZE > 1
+
+    def _get_supertile_render_key(self, level, column, row, tile_size, limit_bounds, image_format):
+        block_size = settings.OME_SUPERTILE_SIZE
+        return 'SUPERTILE|omero|%s|%s|%s|%s|%s|%s|%s|%s' % (self.image_id, level, column // block_size,
+                                                            row // block_size, block_size, tile_size,
+                                                            limit_bounds, image_format)
+
+    # render the block of OME_SUPERTILE_SIZE x OME_SUPERTILE_SIZE DZI tiles containing the required one
+    # with a single OMERO region and split it, all the tiles are saved to the cache; returns a dictionary
+    # with (column, row) keys, tiles out of the image boundaries are not included
+    def _render_supertile(self, level, column, row, tile_size, image_format, cache, cache_params):
+        geometry = self._get_geometry()
+        if geometry is None:
+            return {}
+        if level > geometry['dzi_max_level']:
+            raise ValueError('Level %d is higher than max DZI level for the image' % level)
+        block_size = settings.OME_SUPERTILE_SIZE
+        ome_level = geometry['dzi_levels'][level]['ome_level']
+        level_w = int(geometry['size_x'] * geometry['ome_scales'][ome_level])
+        level_h = int(geometry['size_y'] * geometry['ome_scales'][ome_level])
+        regions = {}
+        for t_column in range((column // block_size) * block_size, (column // block_size + 1) * block_size):
+            for t_row in range((row // block_size) * block_size, (row // block_size + 1) * block_size):
+                _, scale_factor, region = self._get_ome_tile_region(geometry, level, row=t_column,
+                                                                    column=t_row, tile_size=tile_size)
+                if region[0] < level_w and region[1] < level_h:
+                    regions[(t_column, t_row)] = region
+        if len(regions) == 0:
+            return {}
+        block_x = min(r[0] for r in regions.values())
+        block_y = min(r[1] for r in regions.values())
+        block_w = max(r[0] + r[2] for r in regions.values()) - block_x
+        block_h = max(r[1] + r[3] for r in regions.values()) - block_y
+        self.logger.debug('Getting super tile with settings: X %s Y %s W %s H %s L %s', block_x, block_y,
+                          block_w, block_h, ome_level)
+        start = time.time()
+        with self._get_ome_image(geometry['image_id']) as ome_img:
+            if ome_img is None:
+                return {}
+            block = None
+            if self._use_raw_pixels():
+                block = self._render_raw_region(ome_img, ome_level, block_x, block_y, block_w, block_h)
+            if block is None:
+                with timed_stage('render'):
+                    jpeg_block = ome_img.renderJpegRegion(0, 0, block_x, block_y, block_w, block_h,
+                                                          level=ome_level,
+                                                          compression=settings.DEEPZOOM_JPEG_QUALITY/100.0)
+                if jpeg_block is None:
+                    return {}
+                block = Image.open(BytesIO(jpeg_block))
+        tiles = {}
+        for (t_column, t_row), (x, y, w, h) in regions.items():
+            ome_tile = block.crop((x - block_x, y - block_y, x - block_x + w, y - block_y + h))
+            tiles[(t_column, t_row)] = self._encode_image(self._resize_ome_tile(ome_tile, scale_factor), image_format)
+        self._observe_tiles_render(level, start, list(tiles.values()))
+        if cache is not None:
+            cache.tiles_to_cache([(tile, dict(cache_params, column=t_column, row=t_row))
+                                  for (t_column, t_row), tile in tiles.items()])
+        return tiles
 
     def get_tile(self, level, column, row, original_file_source=False, file_mimetype=None,
-                 tile_size=None, limit_bounds=None):
+                 tile_size=None, limit_bounds=None, image_format=None):
         tile_size = tile_size if tile_size is not None else settings.DEEPZOOM_TILE_SIZE
         limit_bounds = limit_bounds if limit_bounds is not None else settings.DEEPZOOM_LIMIT_BOUNDS
+        image_format = self._get_image_format(image_format)
         self._check_source_type(original_file_source)
-        if settings.IMAGES_CACHE_ENABLED:
-            cache = CacheDriverFactory(settings.IMAGES_CACHE_DRIVER). \
-                get_cache(settings.CACHE_HOST, settings.CACHE_PORT, settings.CACHE_DB, settings.CACHE_EXPIRE_TIME)
-            cache_params = {
-                'image_id': self.image_id,
-                'level': level,
-                'column': column,
-                'row': row,
-                'tile_size': tile_size,
-                'image_format': settings.DEEPZOOM_FORMAT,
-                'rendering_engine': 'omero',
-                'limit_bounds': limit_bounds
-            }
-            if cache_params['image_format'].lower() == 'jpeg':
-                cache_params['image_quality'] = settings.DEEPZOOM_JPEG_QUALITY
-            tile = cache.tile_from_cache(**cache_params)
+        cache = get_images_cache()
+        if cache is not None:
+            cache_params = self._get_tile_cache_params(level, column, row, tile_size, limit_bounds, image_format)
+            cache_lookup = lambda: cache.tile_from_cache(**cache_params)
         else:
-            tile = None
+            cache_lookup = cache_params = None
+        render_key = self._get_tile_render_key('omero', level, column, row, tile_size, limit_bounds, image_format)
+        render = lambda engine: engine._render_tile(level, column, row, tile_size, image_format, cache, cache_params)
+        tile = self._get_cached_tile(cache, cache_params, render_key, render) if cache is not None else None
+        if tile is None and self._use_supertiles(cache):
+            tile = self._coalesced_render(
+                self._get_supertile_render_key(level, column, row, tile_size, limit_bounds, image_format),
+                lambda: self._render_supertile(level, column, row, tile_size, image_format, cache, cache_params)
+            ).get((column, row))
         if tile is None:
-            ome_img = self._get_image_object(get_biggest_in_fileset=True)
-            ome_level = self._get_best_downscale_level(level, ome_img)
-            tile = self._get_ome_tile(ome_img, ome_level, level, row=column, column=row, tile_size=tile_size)
-            if settings.IMAGES_CACHE_ENABLED:
-                cache_params['image_obj'] = tile
-                cache.tile_to_cache(**cache_params)
-        return tile, settings.DEEPZOOM_FORMAT
+            tile = self._coalesced_render(render_key, lambda: render(self), cache, cache_lookup)
+        if tile is not None:
+            self._count_tile_served()
+            self._prefetch_tiles(level, column, row, original_file_source, file_mimetype, tile_size, limit_bounds,
+                                 image_format)
+        return tile, self._get_content_type(image_format)
+
+
+def get_thumbnails_set(connection, image_ids, size, image_format=None):
+    """
+    Thumbnails of several images, with longest side equal to size, as a dictionary with image IDs as
+    keys. Thumbnails found in the images cache are served without OMERO calls, the others are retrieved
+    with a single thumbnails set request; images that can't be found are not included.
+    """
+    image_format = normalize_format(image_format if image_format is not None else settings.DEEPZOOM_FORMAT)
+    image_quality = get_image_quality(image_format)
+    thumbnails = {}
+    cache = get_images_cache()
+    if cache is not None:
+        cached_thumbnails = cache.thumbnails_from_cache(image_ids, size, image_format, 'omero', image_quality)
+        for image_id, thumbnail in zip(image_ids, cached_thumbnails):
+            if thumbnail is not None:
+                thumbnails[image_id] = thumbnail
+    missing_ids = [i for i in image_ids if i not in thumbnails]
+    if missing_ids:
+        with timed_stage('render'):
+            ome_thumbnails = connection.getThumbnailSet(missing_ids, max_size=size)
+        for image_id, thumbnail in ome_thumbnails.items():
+            if thumbnail is None:
+                continue
+            # OMERO thumbnails are JPEG images
+            if image_format != 'jpeg':
+                thumbnail = encode_image(Image.open(BytesIO(thumbnail)), image_format)
+            if cache is not None:
+                cache.thumbnail_to_cache(image_id, thumbnail, size, image_format, 'omero', image_quality)
+            thumbnails[image_id] = thumbnail
+    return thumbnails
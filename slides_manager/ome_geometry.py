@@ -0,0 +1,131 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import logging
+import math
+import threading
+
+from ..images_cache import get_images_cache
+from ..lru_cache import LRUCache
+from ..ome_data.projects_datasets import get_fileset_highest_resolution
+from .. import settings
+
+logger = logging.getLogger(__name__)
+
+
+def get_dzi_max_level(size_x, size_y):
+    return int(math.ceil(math.log(max(size_x, size_y), 2)))
+
+
+def get_scale_factor(original_x, original_y, ome_scale_factor, dzi_scale_factor):
+    ome_w = original_x * ome_scale_factor
+    ome_h = original_y * ome_scale_factor
+    ome_diag = math.sqrt(math.pow(ome_w, 2) + math.pow(ome_h, 2))
+    dzi_w = original_x * dzi_scale_factor
+    dzi_h = original_y * dzi_scale_factor
+    dzi_diag = math.sqrt(math.pow(dzi_w, 2) + math.pow(dzi_h, 2))
+    return ome_diag / dzi_diag
+
+
+def _get_best_downscale_level(ome_scales, dzi_scale_factor):
+    ome_level = None
+    for ome_scale_factor, ome_level in sorted(((s, l) for l, s in enumerate(ome_scales)), reverse=True):
+        if ome_scale_factor < dzi_scale_factor:
+            return ome_level + 1
+    return ome_level
+
+
+def build_ome_geometry(img):
+    size_x, size_y = img.getSizeX(), img.getSizeY()
+    # OMERO zoom levels are indexed from the smallest resolution, images without a pyramid have a single level
+    zoom_scaling = img.getZoomLevelScaling() or {0: 1.0}
+    ome_scales = [zoom_scaling[len(zoom_scaling) - level - 1] for level in range(len(zoom_scaling))]
+    dzi_max_level = get_dzi_max_level(size_x, size_y)
+    dzi_levels = []
+    for dzi_level in range(dzi_max_level + 1):
+        dzi_scale_factor = math.pow(0.5, dzi_max_level - dzi_level)
+        ome_level = _get_best_downscale_level(ome_scales, dzi_scale_factor)
+        dzi_levels.append({
+            'ome_level': ome_level,
+            'scale_factor': get_scale_factor(size_x, size_y, ome_scales[ome_level], dzi_scale_factor)
+        })
+    try:
+        mpp = (img.getPixelSizeX() + img.getPixelSizeY()) / 2.0
+    except TypeError:
+        mpp = 0
+    return {
+        'image_id': img.getId(),
+        'size_x': size_x,
+        'size_y': size_y,
+        'mpp': mpp,
+        'ome_scales': ome_scales,
+        'dzi_max_level': dzi_max_level,
+        # OMERO level and tile scale factor used for each DZI level
+        'dzi_levels': dzi_levels
+    }
+
+
+class OmeGeometries(object):
+    """
+    Geometry of the highest resolution image in the fileset of an OMERO image (ID, size, zoom levels
+    and the DZI to OMERO levels table), computed once and then served from memory (and from the
+    images cache, if a shared cache is given).
+
+    Geometries are keyed by user, for the same reason as the paths in PathsCache.
+    """
+
+    def __init__(self, max_entries, ttl=None, shared_cache=None):
+        self._geometries = LRUCache(max_entries, ttl=ttl)
+        self.shared_cache = shared_cache
+
+    def get_geometry(self, connection, image_id):
+        key = '%s|%s' % (image_id, connection.getUserId())
+        geometry = self._geometries.get(key)
+        if geometry is None and self.shared_cache:
+            geometry = self.shared_cache.metadata_from_cache('OMEGEOM::%s' % key)
+            if geometry is not None:
+                self._geometries.set(key, geometry)
+        if geometry is None:
+            img = connection.getObject('Image', image_id)
+            if img is None:
+                return None
+            logger.debug('Building geometry for OMERO image %s', image_id)
+            geometry = build_ome_geometry(get_fileset_highest_resolution(img, connection))
+            self._geometries.set(key, geometry)
+            if self.shared_cache:
+                self.shared_cache.metadata_to_cache('OMEGEOM::%s' % key, geometry)
+        return geometry
+
+    def stats(self):
+        return self._geometries.stats()
+
+
+_ome_geometries = None
+_ome_geometries_lock = threading.Lock()
+
+
+def get_ome_geometries():
+    global _ome_geometries
+    if _ome_geometries is None:
+        with _ome_geometries_lock:
+            if _ome_geometries is None:
+                _ome_geometries = OmeGeometries(settings.OME_GEOMETRY_MAX_ENTRIES,
+                                                settings.OME_GEOMETRY_TTL or None, get_images_cache())
+    return _ome_geometries
@@ -0,0 +1,144 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import logging
+import threading
+
+import numpy as np
+from PIL import Image
+
+from ..lru_cache import LRUCache
+from .errors import UnsupportedRenderingSettings
+from .. import settings
+
+logger = logging.getLogger(__name__)
+
+
+# OMERO pixels types to NumPy data types, raw pixels are big endian
+_PIXELS_TYPES = {
+    'int8': '>i1',
+    'uint8': '>u1',
+    'int16': '>i2',
+    'uint16': '>u2',
+    'int32': '>i4',
+    'uint32': '>u4',
+    'float': '>f4',
+    'double': '>f8'
+}
+
+
+def _read_channels_settings(ome_img):
+    channels = []
+    greyscale = ome_img.isGreyscaleRenderingModel()
+    for index, ch in enumerate(ome_img.getChannels()):
+        if not ch.isActive():
+            continue
+        if ch.getLut():
+            raise UnsupportedRenderingSettings('Lookup tables are not supported by the raw pixels backend',
+                                               'lut')
+        if ch.getFamily().getValue() != 'linear':
+            raise UnsupportedRenderingSettings('Only linear mapping is supported by the raw pixels backend',
+                                               'mapping')
+        channels.append({
+            'index': index,
+            'start': ch.getWindowStart(),
+            'end': ch.getWindowEnd(),
+            'color': [255, 255, 255] if greyscale else list(ch.getColor().getRGB())
+        })
+        # the greyscale model only renders the first active channel
+        if greyscale:
+            break
+    return channels
+
+
+_channels_settings = None
+_channels_settings_lock = threading.Lock()
+
+
+def get_channels_settings(connection, ome_img):
+    """
+    Windows and colors of the active channels of ome_img, as defined by the rendering settings of the
+    current user. Settings are cached for omero.web.ome_seadragon.ome_engine.raw_settings_ttl seconds.
+    Raises UnsupportedRenderingSettings if they can't be applied by the raw pixels backend.
+    """
+    global _channels_settings
+    if _channels_settings is None:
+        with _channels_settings_lock:
+            if _channels_settings is None:
+                _channels_settings = LRUCache(settings.OME_RAW_SETTINGS_MAX_ENTRIES,
+                                              ttl=settings.OME_RAW_SETTINGS_TTL or None)
+    key = (str(ome_img.getId()), connection.getUserId())
+    channels = _channels_settings.get(key)
+    if channels is None:
+        channels = _read_channels_settings(ome_img)
+        _channels_settings.set(key, channels)
+    return channels
+
+
+class RawPixelsRenderer(object):
+    """
+    Render regions of an OMERO image reading its raw planes with a RawPixelsStore and applying the
+    channels settings with NumPy. The store is opened once, so a renderer can be used for several
+    regions, one at a time; close() must be called when the renderer is no longer needed.
+    """
+
+    def __init__(self, connection, ome_img, channels):
+        pixels_type = ome_img.getPixelsType()
+        if pixels_type not in _PIXELS_TYPES:
+            raise UnsupportedRenderingSettings('Pixels type %s is not supported by the raw pixels backend'
+                                               % pixels_type, 'pixels_type')
+        self.image_id = ome_img.getId()
+        self.dtype = np.dtype(_PIXELS_TYPES[pixels_type])
+        self.channels = channels
+        self.windows = np.array([[c['start'], c['end']] for c in channels], dtype=np.float32).reshape(-1, 2)
+        self.colors = np.array([c['color'] for c in channels], dtype=np.float32).reshape(-1, 3)
+        self._store = connection.createRawPixelsStore()
+        self._store.setPixelsId(ome_img.getPixelsId(), True, connection.SERVICE_OPTS)
+        # resolution descriptions go from the biggest level to the smallest one, while resolution
+        # levels are indexed starting from the smallest one
+        self._levels_sizes = [(d.sizeX, d.sizeY) for d in reversed(self._store.getResolutionDescriptions())]
+        self._lock = threading.Lock()
+
+    def _read_planes(self, level, x, y, width, height, z, t):
+        with self._lock:
+            self._store.setResolutionLevel(level)
+            return [np.frombuffer(self._store.getTile(z, c['index'], t, x, y, width, height),
+                                  dtype=self.dtype).reshape(height, width)
+                    for c in self.channels]
+
+    def render_region(self, level, x, y, width, height, z=0, t=0):
+        level_w, level_h = self._levels_sizes[level]
+        x, y = int(x), int(y)
+        width, height = min(int(width), level_w - x), min(int(height), level_h - y)
+        if len(self.channels) == 0 or width <= 0 or height <= 0:
+            return Image.new('RGB', (max(width, 1), max(height, 1)), 'black')
+        planes = np.stack(self._read_planes(level, x, y, width, height, z, t)).astype(np.float32)
+        # map each channel to [0, 1] using its window, then mix channels colors additively
+        starts = self.windows[:, 0].reshape(-1, 1, 1)
+        ranges = np.maximum(self.windows[:, 1] - self.windows[:, 0], 1e-6).reshape(-1, 1, 1)
+        planes = np.clip((planes - starts) / ranges, 0, 1)
+        rgb = np.tensordot(planes, self.colors, axes=([0], [0]))
+        return Image.fromarray(np.clip(rgb, 0, 255).astype(np.uint8), 'RGB')
+
+    def close(self):
+        try:
+            self._store.close()
+        except Exception as e:
+            logger.debug('Error while closing raw pixels store for image %s: %s', self.image_id, e)
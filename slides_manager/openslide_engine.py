@@ -17,28 +17,36 @@
 #  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 #  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import openslide
-from openslide import OpenSlide
-from openslide.deepzoom import DeepZoomGenerator
-from io import BytesIO
-from PIL import Image
+import time
+from contextlib import ExitStack, contextmanager
+
+from lxml import etree
 
 from .rendering_engine_interface import RenderingEngineInterface
+from ..server_timing import timed_stage
+from .slide_descriptor import get_slide_descriptors
+from .slides_cache import get_slides_cache
 from .. import settings
-from ome_seadragon_cache import CacheDriverFactory
+from ..images_cache import get_images_cache
 
 
 class OpenSlideEngine(RenderingEngineInterface):
 
+    rendering_engine_name = 'openslide'
+
     def __init__(self, image_id, connection):
         super(OpenSlideEngine, self).__init__(image_id, connection)
 
+    @contextmanager
     def _get_openslide_wrapper(self, original_file_source, file_mimetype):
         img_path = self._get_image_path(original_file_source, file_mimetype)
         if img_path:
-            return OpenSlide(img_path)
+            with ExitStack() as stack:
+                with timed_stage('slide_open'):
+                    slide = stack.enter_context(get_slides_cache().slide(img_path))
+                yield slide
         else:
-            return None
+            yield None
 
     def _get_deepzoom_config(self, tile_size=None, limit_bounds=None):
         cfg = {
@@ -50,22 +58,30 @@ class OpenSlideEngine(RenderingEngineInterface):
         self.logger.debug(cfg)
         return cfg
 
+    @contextmanager
     def _get_deepzoom_wrapper(self, original_file_source, file_mimetype, tile_size=None, limit_bounds=None):
-        os_wrapper = self._get_openslide_wrapper(original_file_source, file_mimetype)
-        if os_wrapper:
-            return DeepZoomGenerator(os_wrapper, **self._get_deepzoom_config(tile_size, limit_bounds))
+        img_path = self._get_image_path(original_file_source, file_mimetype)
+        if img_path:
+            with ExitStack() as stack:
+                with timed_stage('slide_open'):
+                    dzg = stack.enter_context(
+                        get_slides_cache().deepzoom(img_path, **self._get_deepzoom_config(tile_size, limit_bounds))
+                    )
+                yield dzg
+        else:
+            yield None
+
+    def _get_slide_descriptor(self, original_file_source, file_mimetype):
+        img_path = self._get_image_path(original_file_source, file_mimetype)
+        if img_path:
+            return get_slide_descriptors().get_descriptor(img_path)
         else:
             return None
 
     def _get_image_mpp(self, original_file_source=False, file_mimetype=None):
-        slide = self._get_openslide_wrapper(original_file_source, file_mimetype)
-        if slide:
-            try:
-                mpp_x = slide.properties[openslide.PROPERTY_NAME_MPP_X]
-                mpp_y = slide.properties[openslide.PROPERTY_NAME_MPP_Y]
-                return (float(mpp_x) + float(mpp_y)) / 2
-            except (KeyError, ValueError):
-                return 0
+        descriptor = self._get_slide_descriptor(original_file_source, file_mimetype)
+        if descriptor:
+            return descriptor['mpp']
         else:
             return 0
 
@@ -75,14 +91,9 @@ class OpenSlideEngine(RenderingEngineInterface):
         }
 
     def _get_slide_bounds(self, original_file_source=False, file_mimetype=None):
-        slide = self._get_openslide_wrapper(original_file_source, file_mimetype)
-        if slide:
-            return (
-                int(slide.properties.get('openslide.bounds-x', 0)),
-                int(slide.properties.get('openslide.bounds-y', 0)),
-                int(slide.properties.get('openslide.bounds-height', 0)),
-                int(slide.properties.get('openslide.bounds-width', 0))
-            )
+        descriptor = self._get_slide_descriptor(original_file_source, file_mimetype)
+        if descriptor:
+            return tuple(descriptor['bounds'])
         else:
             return None
 
@@ -99,82 +110,115 @@ class OpenSlideEngine(RenderingEngineInterface):
             return bounds
 
     def _get_original_file_json_description(self, resource_path, file_mimetype=None, tile_size=None, limit_bounds=True):
-        slide = self._get_openslide_wrapper(original_file_source=True,
-                                            file_mimetype=file_mimetype)
-        if slide:
+        descriptor = self._get_slide_descriptor(original_file_source=True, file_mimetype=file_mimetype)
+        if descriptor:
             if limit_bounds:
-                _, _, height, width = self._get_slide_bounds(True, file_mimetype)
+                _, _, height, width = descriptor['bounds']
                 return self._get_json_description(resource_path, height, width, tile_size)
-            return self._get_json_description(resource_path, slide.dimensions[1], slide.dimensions[0], tile_size)
+            return self._get_json_description(resource_path, descriptor['dimensions'][1],
+                                              descriptor['dimensions'][0], tile_size)
         return None
 
     def get_dzi_description(self, original_file_source=False, file_mimetype=None, tile_size=None, limit_bounds=None):
-        dzi_slide = self._get_deepzoom_wrapper(original_file_source, file_mimetype, tile_size, limit_bounds)
-        if dzi_slide:
-            return dzi_slide.get_dzi(settings.DEEPZOOM_FORMAT)
+        img_path = self._get_image_path(original_file_source, file_mimetype)
+        if img_path:
+            dz_config = self._get_deepzoom_config(tile_size, limit_bounds)
+            dz_geometry = get_slide_descriptors().get_deepzoom_geometry(img_path, **dz_config)
+            dzi_root = etree.Element(
+                'Image',
+                attrib={
+                    'Format': str(settings.DEEPZOOM_FORMAT),
+                    'Overlap': str(dz_config['overlap']),
+                    'TileSize': str(dz_config['tile_size'])
+                },
+                nsmap={None: 'http://schemas.microsoft.com/deepzoom/2008'}
+            )
+            etree.SubElement(dzi_root, 'Size',
+                             attrib={'Height': str(dz_geometry['height']), 'Width': str(dz_geometry['width'])})
+            return etree.tostring(dzi_root)
         else:
             return None
 
-    def get_thumbnail(self, size, original_file_source=False, file_mimeype=None):
-        if settings.IMAGES_CACHE_ENABLED:
-            cache = CacheDriverFactory(settings.IMAGES_CACHE_DRIVER).\
-                get_cache(settings.CACHE_HOST, settings.CACHE_PORT, settings.CACHE_DB, settings.CACHE_EXPIRE_TIME)
+    def _render_thumbnail(self, size, original_file_source, file_mimetype, image_format, cache=None):
+        self.logger.debug('No thumbnail loaded from cache, building it')
+        with self._get_openslide_wrapper(original_file_source, file_mimetype) as slide:
+            if slide:
+                with timed_stage('read_region'):
+                    thumb = slide.get_thumbnail((size, size))
+            else:
+                return None
+        thumb = self._encode_image(thumb, image_format)
+        # ... and store it into the cache
+        if cache is not None:
+            cache.thumbnail_to_cache(self.image_id, thumb, size, image_format, 'openslide',
+                                     self._get_image_quality(image_format))
+        return thumb
+
+    def get_thumbnail(self, size, original_file_source=False, file_mimeype=None, image_format=None):
+        image_format = self._get_image_format(image_format)
+        cache = get_images_cache()
+        if cache is not None:
             # get thumbnail from cache
-            thumb = cache.thumbnail_from_cache(self.image_id, size, settings.DEEPZOOM_FORMAT, 'openslide')
+            cache_lookup = lambda: cache.thumbnail_from_cache(self.image_id, size, image_format, 'openslide',
+                                                              self._get_image_quality(image_format))
+            thumb = cache_lookup()
         else:
+            cache_lookup = None
             thumb = None
         # if thumbnail is not in cache build it ....
         if thumb is None:
-            self.logger.debug('No thumbnail loaded from cache, building it')
-            slide = self._get_openslide_wrapper(original_file_source, file_mimeype)
-            if slide:
-                thumb = slide.get_thumbnail((size, size))
-                # ... and store it into the cache
-                if settings.IMAGES_CACHE_ENABLED:
-                    cache.thumbnail_to_cache(self.image_id, thumb, size, settings.DEEPZOOM_FORMAT, 'openslide')
+            thumb = self._coalesced_render(
+                self._get_thumbnail_render_key('openslide', size, image_format),
+                lambda: self._render_thumbnail(size, original_file_source, file_mimeype, image_format, cache),
+                cache, cache_lookup
+            )
         else:
             self.logger.debug('Thumbnail loaded from cache')
-        return thumb, settings.DEEPZOOM_FORMAT
+        return thumb, self._get_content_type(image_format)
+
+    def _prepare_tiles_batch(self, original_file_source, file_mimetype, tile_size, limit_bounds):
+        with self._get_deepzoom_wrapper(original_file_source, file_mimetype, tile_size, limit_bounds):
+            pass
+
+    def _render_tile(self, level, column, row, original_file_source, file_mimetype, tile_size, limit_bounds,
+                     image_format, cache=None, cache_params=None):
+        with self._get_deepzoom_wrapper(original_file_source, file_mimetype, tile_size, limit_bounds) as slide:
+            if slide:
+                start = time.time()
+                with timed_stage('read_region'):
+                    tile = slide.get_tile(level, (column, row))
+            else:
+                return None
+        tile = self._encode_image(tile, image_format)
+        self._observe_tiles_render(level, start, [tile])
+        # ... and store it into the cache
+        if cache is not None:
+            cache.tile_to_cache(image_data=tile, **cache_params)
+        return tile
 
     def get_tile(self, level, column, row, original_file_source=False, file_mimetype=None,
-                 tile_size=None, limit_bounds=None):
-        if settings.IMAGES_CACHE_ENABLED:
-            cache = CacheDriverFactory(settings.IMAGES_CACHE_DRIVER).\
-                get_cache(settings.CACHE_HOST, settings.CACHE_PORT, settings.CACHE_DB, settings.CACHE_EXPIRE_TIME)
-            tile_size = tile_size if tile_size is not None else settings.DEEPZOOM_TILE_SIZE
-            limit_bounds = limit_bounds if limit_bounds is not None else settings.DEEPZOOM_LIMIT_BOUNDS
-            self.logger.debug('TILE SIZE IS: %s', tile_size)
-            cache_params = {
-                'image_id': self.image_id,
-                'level': level,
-                'column': column,
-                'row': row,
-                'tile_size': tile_size,
-                'image_format': settings.DEEPZOOM_FORMAT,
-                'rendering_engine': 'openslide',
-                'limit_bounds': limit_bounds
-            }
-            if cache_params['image_format'].lower() == 'jpeg':
-                cache_params['image_quality'] = settings.DEEPZOOM_JPEG_QUALITY
-            # get tile from cache
-            tile = cache.tile_from_cache(**cache_params)
+                 tile_size=None, limit_bounds=None, image_format=None):
+        tile_size = tile_size if tile_size is not None else settings.DEEPZOOM_TILE_SIZE
+        limit_bounds = limit_bounds if limit_bounds is not None else settings.DEEPZOOM_LIMIT_BOUNDS
+        image_format = self._get_image_format(image_format)
+        self.logger.debug('TILE SIZE IS: %s', tile_size)
+        cache = get_images_cache()
+        if cache is not None:
+            cache_params = self._get_tile_cache_params(level, column, row, tile_size, limit_bounds, image_format)
+            cache_lookup = lambda: cache.tile_from_cache(**cache_params)
         else:
-            tile = None
+            cache_lookup = cache_params = None
+        render_key = self._get_tile_render_key('openslide', level, column, row, tile_size, limit_bounds,
+                                               image_format)
+        render = lambda engine: engine._render_tile(level, column, row, original_file_source, file_mimetype,
+                                                    tile_size, limit_bounds, image_format, cache, cache_params)
+        # get tile from cache
+        tile = self._get_cached_tile(cache, cache_params, render_key, render) if cache is not None else None
         # if tile is not in cache build it ...
         if tile is None:
-            slide = self._get_deepzoom_wrapper(original_file_source, file_mimetype, tile_size, limit_bounds)
-            if slide:
-                dzi_tile = slide.get_tile(level, (column, row))
-                tile_buffer = BytesIO()
-                tile_conf = {
-                    'format': settings.DEEPZOOM_FORMAT
-                }
-                if tile_conf['format'].lower() == 'jpeg':
-                    tile_conf['quality'] = settings.DEEPZOOM_JPEG_QUALITY
-                dzi_tile.save(tile_buffer, **tile_conf)
-                tile = Image.open(tile_buffer)
-                # ... and store it into the cache
-                if settings.IMAGES_CACHE_ENABLED:
-                    cache_params['image_obj'] = tile
-                    cache.tile_to_cache(**cache_params)
-        return tile, settings.DEEPZOOM_FORMAT
+            tile = self._coalesced_render(render_key, lambda: render(self), cache, cache_lookup)
+        if tile is not None:
+            self._count_tile_served()
+            self._prefetch_tiles(level, column, row, original_file_source, file_mimetype, tile_size, limit_bounds,
+                                 image_format)
+        return tile, self._get_content_type(image_format)
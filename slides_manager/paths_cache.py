@@ -0,0 +1,130 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import logging
+import os
+import threading
+
+from ..images_cache import get_images_cache
+from ..ome_data.original_files import get_original_file
+from ..lru_cache import LRUCache
+from .. import settings
+
+logger = logging.getLogger(__name__)
+
+
+class PathsCache(object):
+    """
+    Cache of the filesystem paths resolved for images and original files, kept in process and,
+    optionally, shared among workers using the images cache.
+
+    Paths resolved from OMERO Image objects are also keyed by user, since resolving them
+    is what checks that the user can actually access the image.
+    """
+
+    def __init__(self, max_entries, ttl=None, shared_cache=None):
+        self._paths = LRUCache(max_entries, ttl=ttl)
+        self.ttl = ttl
+        self.shared_cache = shared_cache
+
+    def _get_path_key(self, original_file_source, file_mimetype, user_id):
+        if original_file_source:
+            return 'OF|%s' % file_mimetype
+        else:
+            return 'IMG|%s' % user_id
+
+    def get_path(self, image_id, original_file_source, file_mimetype, user_id=None):
+        path_key = self._get_path_key(original_file_source, file_mimetype, user_id)
+        path = self._paths.get((str(image_id), path_key))
+        if path is None and self.shared_cache:
+            path = self.shared_cache.path_from_cache(image_id, path_key)
+            if path is not None:
+                self._paths.set((str(image_id), path_key), path)
+        return path
+
+    def set_path(self, image_id, original_file_source, file_mimetype, path, user_id=None):
+        path_key = self._get_path_key(original_file_source, file_mimetype, user_id)
+        self._paths.set((str(image_id), path_key), path)
+        if self.shared_cache:
+            self.shared_cache.path_to_cache(image_id, path_key, path, self.ttl)
+
+    def invalidate(self, image_id):
+        logger.debug('Invalidating cached paths for image %s', image_id)
+        self._paths.pop_matching(lambda k: k[0] == str(image_id))
+        if self.shared_cache:
+            self.shared_cache.paths_delete(image_id)
+
+    def stats(self):
+        return self._paths.stats()
+
+
+_paths_cache = None
+_paths_cache_lock = threading.Lock()
+
+
+def get_paths_cache():
+    global _paths_cache
+    if _paths_cache is None:
+        with _paths_cache_lock:
+            if _paths_cache is None:
+                if settings.PATHS_CACHE_SHARED:
+                    shared_cache = get_images_cache()
+                else:
+                    shared_cache = None
+                _paths_cache = PathsCache(settings.PATHS_CACHE_MAX_ENTRIES,
+                                          settings.PATHS_CACHE_TTL or None, shared_cache)
+    return _paths_cache
+
+
+def _get_path_from_image_obj(connection, image_id):
+    img = connection.getObject('Image', image_id)
+    if img is None:
+        return None
+    else:
+        return os.path.join(
+            settings.IMGS_REPOSITORY,
+            settings.IMGS_FOLDER,
+            img.getImportedImageFilePaths()['server_paths'][0]
+        )
+
+
+def _get_path_from_original_file_obj(connection, image_id, file_mimetype):
+    ofile = get_original_file(connection, image_id, file_mimetype)
+    if ofile is None:
+        return None
+    else:
+        return ofile.getPath()
+
+
+def get_image_path(connection, image_id, original_file_source=False, file_mimetype=None):
+    paths_cache = get_paths_cache()
+    user_id = None if original_file_source else connection.getUserId()
+    img_path = paths_cache.get_path(image_id, original_file_source, file_mimetype, user_id)
+    if img_path is None:
+        if original_file_source:
+            img_path = _get_path_from_original_file_obj(connection, image_id, file_mimetype)
+        else:
+            img_path = _get_path_from_image_obj(connection, image_id)
+        if img_path:
+            paths_cache.set_path(image_id, original_file_source, file_mimetype, img_path, user_id)
+    return img_path
+
+
+def invalidate_image_paths(image_id):
+    get_paths_cache().invalidate(image_id)
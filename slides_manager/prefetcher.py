@@ -0,0 +1,162 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from ..lru_cache import LRUCache
+from .. import settings
+
+logger = logging.getLogger(__name__)
+
+# set in prefetching threads, tiles rendered by the prefetcher don't trigger new prefetches
+_prefetch_context = threading.local()
+
+
+def is_prefetching():
+    return getattr(_prefetch_context, 'active', False)
+
+
+def get_tiles_to_prefetch(level, column, row, ring=1, depth=1):
+    """
+    Return the tiles that are likely to be requested after tile (level, column, row): the ones
+    in the given ring around it at the same level and its children in the following depth levels.
+    """
+    tiles = []
+    for dc in range(-ring, ring + 1):
+        for dr in range(-ring, ring + 1):
+            if (dc, dr) != (0, 0) and column + dc >= 0 and row + dr >= 0:
+                tiles.append((level, column + dc, row + dr))
+    parents = [(column, row)]
+    for d in range(1, depth + 1):
+        children = []
+        for c, r in parents:
+            children.extend([(2 * c, 2 * r), (2 * c + 1, 2 * r), (2 * c, 2 * r + 1), (2 * c + 1, 2 * r + 1)])
+        tiles.extend((level + d, c, r) for c, r in children)
+        parents = children
+    return tiles
+
+
+class TilesPrefetcher(object):
+    """
+    Render tiles in background threads so that they are found in the images cache when the client
+    asks for them. The number of queued tiles is bounded, both globally and for each image, tiles
+    that don't fit are simply skipped. Tiles are rendered by a background engine, since the connection
+    of the request that triggered the prefetch is closed as soon as the request ends.
+    """
+
+    def __init__(self, workers, max_queue_size, max_per_image, ring=1, depth=1):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ome_seadragon_prefetch')
+        self.max_queue_size = max_queue_size
+        self.max_per_image = max_per_image
+        self.ring = ring
+        self.depth = depth
+        self._lock = threading.Lock()
+        self._queued = set()
+        self._queued_per_image = Counter()
+        # tiles prefetched recently, not worth checking the cache for them again
+        self._recent = LRUCache(max_queue_size * 16, ttl=60)
+        self.scheduled = 0
+        self.skipped = 0
+        self.failed = 0
+
+    # returns False if the tile is already queued or there is no room for it
+    def _reserve(self, image_key, tile_key):
+        with self._lock:
+            if tile_key in self._queued:
+                return False
+            if len(self._queued) >= self.max_queue_size or self._queued_per_image[image_key] >= self.max_per_image:
+                self.skipped += 1
+                return False
+            self._queued.add(tile_key)
+            self._queued_per_image[image_key] += 1
+            return True
+
+    def _release(self, image_key, tile_key):
+        with self._lock:
+            self._queued.discard(tile_key)
+            self._queued_per_image[image_key] -= 1
+            if self._queued_per_image[image_key] <= 0:
+                del self._queued_per_image[image_key]
+
+    def _render(self, engine, tile_key, level, column, row, original_file_source, file_mimetype,
+                tile_size, limit_bounds, image_format):
+        _prefetch_context.active = True
+        try:
+            engine.get_tile(level, column, row, original_file_source, file_mimetype, tile_size, limit_bounds,
+                            image_format)
+        except ValueError as ve:
+            # tiles out of the image boundaries
+            logger.debug('Unable to prefetch tile %r: %s', tile_key, ve)
+        except Exception as e:
+            logger.warning('Unable to prefetch tile %r: %s', tile_key, e)
+            with self._lock:
+                self.failed += 1
+        finally:
+            _prefetch_context.active = False
+            self._recent.set(tile_key, True)
+            self._release(tile_key[0], tile_key)
+
+    def prefetch(self, engine, level, column, row, original_file_source=False, file_mimetype=None,
+                 tile_size=None, limit_bounds=None, image_format=None):
+        image_key = (engine.__class__.__name__, str(engine.image_id), file_mimetype)
+        background_engine = None
+        for t_level, t_column, t_row in get_tiles_to_prefetch(level, column, row, self.ring, self.depth):
+            tile_key = (image_key, t_level, t_column, t_row, tile_size, limit_bounds, image_format)
+            if self._recent.get(tile_key) or not self._reserve(image_key, tile_key):
+                continue
+            if background_engine is None:
+                try:
+                    background_engine = engine.get_background_engine()
+                except Exception as e:
+                    logger.warning('Unable to prefetch tiles of image %s: %s', engine.image_id, e)
+                    self._release(image_key, tile_key)
+                    return
+            with self._lock:
+                self.scheduled += 1
+            self._executor.submit(self._render, background_engine, tile_key, t_level, t_column, t_row,
+                                  original_file_source, file_mimetype, tile_size, limit_bounds, image_format)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': len(self._queued),
+                'scheduled': self.scheduled,
+                'skipped': self.skipped,
+                'failed': self.failed
+            }
+
+
+_tiles_prefetcher = None
+_tiles_prefetcher_lock = threading.Lock()
+
+
+def get_tiles_prefetcher():
+    global _tiles_prefetcher
+    if _tiles_prefetcher is None:
+        with _tiles_prefetcher_lock:
+            if _tiles_prefetcher is None:
+                _tiles_prefetcher = TilesPrefetcher(settings.TILES_PREFETCH_WORKERS,
+                                                    settings.TILES_PREFETCH_QUEUE_SIZE,
+                                                    settings.TILES_PREFETCH_MAX_PER_IMAGE,
+                                                    settings.TILES_PREFETCH_RING,
+                                                    settings.TILES_PREFETCH_DEPTH)
+    return _tiles_prefetcher
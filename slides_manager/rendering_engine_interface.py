@@ -18,11 +18,24 @@
 #  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 from abc import ABCMeta, abstractmethod
-import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 import logging
+import time
 
-from ..ome_data.original_files import get_original_file
+from PIL import Image
+
+from ..images_cache import get_images_cache
+from ..metrics import count_tile_served, observe_tiles_render
 from ..ome_data.projects_datasets import get_fileset_highest_resolution
+from ..server_timing import bind_timings, get_current_timings, timed_stage
+from .background_renders import get_background_renders
+from .image_formats import encode_image, get_content_type, get_image_quality, normalize_format
+from .image_resize import crop_child_tile
+from .paths_cache import get_image_path
+from .prefetcher import get_tiles_prefetcher, is_prefetching
+from .session_connections import get_session_connections
+from .single_flight import get_single_flight
 
 from .. import settings
 
@@ -31,49 +44,53 @@ class RenderingEngineInterface(object):
 
     __metaclass__ = ABCMeta
 
+    # name of the engine used in the images cache keys
+    rendering_engine_name = None
+
     def __init__(self, image_id, connection):
         self.connection = connection
         self.image_id = image_id
         self.logger = logging.getLogger(__name__)
 
+    def get_background_engine(self):
+        """
+        Return an engine for the same image whose connection joins the OMERO session of this one, to be used
+        by work that goes on after the request has ended, when the connection of the request is closed.
+        """
+        return self.__class__(self.image_id, get_session_connections().get_connection(self.connection))
+
     # if get_biggest_in_filest is True, return the image with the highest resolution in the fileset
     # of the image with ID image_id, if False simply return image with ID image_id
     def _get_image_object(self, get_biggest_in_fileset=False):
-        img = self.connection.getObject('Image', self.image_id)
-        if img is None:
-            return None
-        if get_biggest_in_fileset:
-            return get_fileset_highest_resolution(img, self.connection)
-        else:
-            return img
-
-    def _get_path_from_image_obj(self):
-        img = self._get_image_object()
-        if img is None:
-            return None
-        else:
-            return os.path.join(
-                settings.IMGS_REPOSITORY,
-                settings.IMGS_FOLDER,
-                img.getImportedImageFilePaths()['server_paths'][0]
-            )
-
-    def _get_path_from_original_file_obj(self, file_mimetype):
-        ofile = get_original_file(self.connection, self.image_id, file_mimetype)
-        if ofile is None:
-            return None
-        else:
-            return ofile.getPath()
+        with timed_stage('get_object'):
+            img = self.connection.getObject('Image', self.image_id)
+            if img is None:
+                return None
+            if get_biggest_in_fileset:
+                return get_fileset_highest_resolution(img, self.connection)
+            else:
+                return img
 
     def _get_image_path(self, original_file_source=False, file_mimetype=None):
-        if original_file_source:
-            return self._get_path_from_original_file_obj(file_mimetype)
-        else:
-            return self._get_path_from_image_obj()
+        with timed_stage('path'):
+            return get_image_path(self.connection, self.image_id, original_file_source, file_mimetype)
 
     def _check_source_type(self, original_file_source):
         pass
 
+    def _get_image_format(self, image_format=None):
+        return normalize_format(image_format if image_format is not None else settings.DEEPZOOM_FORMAT)
+
+    def _get_content_type(self, image_format=None):
+        return get_content_type(self._get_image_format(image_format))
+
+    def _get_image_quality(self, image_format=None):
+        return get_image_quality(self._get_image_format(image_format))
+
+    def _encode_image(self, image, image_format=None):
+        with timed_stage('encode'):
+            return encode_image(image, self._get_image_format(image_format))
+
     @abstractmethod
     def _get_image_mpp(self, original_file_source=False, file_mimetype=None):
         pass
@@ -130,11 +147,176 @@ class RenderingEngineInterface(object):
             'slide_bounds': self.get_slide_bounds(original_file_source, file_mimetype)
         }
 
+    def _get_tile_render_key(self, rendering_engine, level, column, row, tile_size, limit_bounds, image_format):
+        return 'TILE|%s|%s|%s|%s|%s|%s|%s|%s' % (rendering_engine, self.image_id, level, column, row,
+                                                 tile_size, limit_bounds, image_format)
+
+    def _get_tile_cache_params(self, level, column, row, tile_size, limit_bounds, image_format):
+        return {
+            'image_id': self.image_id,
+            'level': level,
+            'column': column,
+            'row': row,
+            'tile_size': tile_size,
+            'image_format': image_format,
+            'rendering_engine': self.rendering_engine_name,
+            'limit_bounds': limit_bounds,
+            'image_quality': self._get_image_quality(image_format)
+        }
+
+    # return the tile stored in the images cache, if it is stale it is served anyway and render(engine), which
+    # is expected to save its result to the cache, is run in background with a background engine
+    def _get_cached_tile(self, cache, cache_params, render_key, render):
+        tile, stale = cache.tile_and_staleness_from_cache(**cache_params)
+        if stale:
+            self.logger.debug('Tile %s is stale, refreshing it', render_key)
+            try:
+                engine = self.get_background_engine()
+            except Exception as e:
+                self.logger.warning('Unable to refresh tile %s: %s', render_key, e)
+                return tile
+            get_background_renders().submit(render_key,
+                                            lambda: engine._coalesced_render(render_key, lambda: render(engine)))
+        return tile
+
+    def get_cached_tile(self, level, column, row, original_file_source=False, file_mimetype=None,
+                        tile_size=None, limit_bounds=None, image_format=None):
+        """
+        Same as get_tile for tiles that are in the images cache and not stale, that are returned without
+        rendering anything. Returns None instead of the tile if it must be rendered.
+        """
+        tile_size = tile_size if tile_size is not None else settings.DEEPZOOM_TILE_SIZE
+        limit_bounds = limit_bounds if limit_bounds is not None else settings.DEEPZOOM_LIMIT_BOUNDS
+        image_format = self._get_image_format(image_format)
+        cache = get_images_cache()
+        if cache is None:
+            return None, self._get_content_type(image_format)
+        tile, stale = cache.tile_and_staleness_from_cache(**self._get_tile_cache_params(level, column, row,
+                                                                                        tile_size, limit_bounds,
+                                                                                        image_format))
+        if tile is None or stale:
+            return None, self._get_content_type(image_format)
+        self._count_tile_served()
+        self._prefetch_tiles(level, column, row, original_file_source, file_mimetype, tile_size, limit_bounds,
+                             image_format)
+        return tile, self._get_content_type(image_format)
+
+    def get_tile_preview(self, level, column, row, tile_size=None, limit_bounds=None, image_format=None):
+        """
+        Temporary replacement for a tile that is not available yet, built by upscaling the region of the
+        parent tile covered by the tile if the parent is in the images cache. Returns a tuple like get_tile,
+        with None instead of the tile if the preview can't be built.
+        """
+        tile_size = tile_size if tile_size is not None else settings.DEEPZOOM_TILE_SIZE
+        limit_bounds = limit_bounds if limit_bounds is not None else settings.DEEPZOOM_LIMIT_BOUNDS
+        image_format = self._get_image_format(image_format)
+        cache = get_images_cache()
+        if cache is None or level == 0:
+            return None, self._get_content_type(image_format)
+        parent_tile = cache.tile_from_cache(**self._get_tile_cache_params(level - 1, column // 2, row // 2,
+                                                                          tile_size, limit_bounds, image_format))
+        if parent_tile is None:
+            return None, self._get_content_type(image_format)
+        preview = crop_child_tile(Image.open(BytesIO(parent_tile)), column, row, tile_size)
+        if preview is None:
+            return None, self._get_content_type(image_format)
+        return self._encode_image(preview, image_format), self._get_content_type(image_format)
+
+    def _get_thumbnail_render_key(self, rendering_engine, size, image_format):
+        return 'THUMB|%s|%s|%s|%s' % (rendering_engine, self.image_id, size, image_format)
+
+    def _wait_for_cached_image(self, cache_lookup, timeout):
+        expire = time.time() + timeout
+        while time.time() < expire:
+            image = cache_lookup()
+            if image is not None:
+                return image
+            time.sleep(0.05)
+        return None
+
+    def _render_with_cache_lock(self, render_key, render, cache, cache_lookup):
+        lock_timeout = settings.IMAGES_CACHE_RENDER_LOCK_TIMEOUT
+        lock_token = cache.acquire_lock(render_key, lock_timeout)
+        if lock_token is None:
+            self.logger.debug('%s is being rendered by another worker, waiting for it', render_key)
+            image = self._wait_for_cached_image(cache_lookup, lock_timeout)
+            if image is not None:
+                return image
+            self.logger.warning('Timeout while waiting for %s, rendering it', render_key)
+            return render()
+        try:
+            # the image could have been stored while we were acquiring the lock
+            image = cache_lookup()
+            if image is None:
+                image = render()
+            return image
+        finally:
+            cache.release_lock(render_key, lock_token)
+
+    # run render (which is expected to also save its result to the cache) only once for concurrent
+    # requests of the same image; if cache is given and render locks are enabled the same applies
+    # to concurrent requests served by different workers
+    def _coalesced_render(self, render_key, render, cache=None, cache_lookup=None):
+        if cache is not None and settings.IMAGES_CACHE_RENDER_LOCKS:
+            return get_single_flight().do(
+                render_key, lambda: self._render_with_cache_lock(render_key, render, cache, cache_lookup)
+            )
+        return get_single_flight().do(render_key, render)
+
+    def _observe_tiles_render(self, level, start, tiles):
+        observe_tiles_render(self.rendering_engine_name, level, time.time() - start, tiles)
+
+    # tiles rendered by the prefetcher are not counted, they will be when they are actually requested
+    def _count_tile_served(self):
+        if not is_prefetching():
+            count_tile_served(self.rendering_engine_name)
+
+    # schedule the rendering of the tiles that will probably be requested after the given one
+    def _prefetch_tiles(self, level, column, row, original_file_source, file_mimetype, tile_size, limit_bounds,
+                        image_format):
+        if settings.TILES_PREFETCH_ENABLED and settings.IMAGES_CACHE_ENABLED and not is_prefetching():
+            get_tiles_prefetcher().prefetch(self, level, column, row, original_file_source, file_mimetype,
+                                            tile_size, limit_bounds, image_format)
+
+    # returns a tuple with the encoded thumbnail and its content type, if image_format is None
+    # the default DeepZoom format is used
     @abstractmethod
-    def get_thumbnail(self, size, original_file_source=False, file_mimeype=None):
+    def get_thumbnail(self, size, original_file_source=False, file_mimeype=None, image_format=None):
         pass
 
+    # returns a tuple with the encoded tile and its content type, if image_format is None
+    # the default DeepZoom format is used
     @abstractmethod
     def get_tile(self, level, column, row, original_file_source=False, file_mimetype=None,
-                 tile_size=None, limit_bounds=None):
+                 tile_size=None, limit_bounds=None, image_format=None):
+        pass
+
+    # called once before rendering a batch of tiles, engines can use it to resolve and open the image
+    # so that the single tiles don't have to
+    def _prepare_tiles_batch(self, original_file_source, file_mimetype, tile_size, limit_bounds):
         pass
+
+    # called once after a batch of tiles has been rendered, to release what _prepare_tiles_batch acquired
+    def _finish_tiles_batch(self):
+        pass
+
+    # tiles is a list of (level, column, row) tuples, returns a list of (tile, content type) tuples
+    # in the same order
+    def get_tiles(self, tiles, original_file_source=False, file_mimetype=None, tile_size=None, limit_bounds=None,
+                  image_format=None):
+        if len(tiles) == 0:
+            return []
+        self._prepare_tiles_batch(original_file_source, file_mimetype, tile_size, limit_bounds)
+        timings = get_current_timings()
+
+        def get_tile(t):
+            with bind_timings(timings):
+                return self.get_tile(t[0], t[1], t[2], original_file_source, file_mimetype, tile_size, limit_bounds,
+                                     image_format)
+
+        try:
+            workers = max(1, min(settings.TILES_BATCH_WORKERS, len(tiles)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                return list(executor.map(get_tile, tiles))
+        finally:
+            self._finish_tiles_batch()
@@ -0,0 +1,170 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+
+from ..lru_cache import LRUCache
+from .session_connections import get_session_connections
+from .. import settings
+
+logger = logging.getLogger(__name__)
+
+
+class RenderingEnginesPool(object):
+    """
+    Pool of OMERO images with a prepared rendering engine, keyed by image, session and group, so that
+    sequential tiles of the same image don't have to set up a new rendering engine on the server.
+
+    Rendering engines are stateful services bound to the client that created them, while the connections
+    of the requests are closed when the requests end: images are loaded through the session connections,
+    which are kept open as long as the pool holds their images.
+    Engines are used by a single thread at a time, up to max_per_image idle engines are kept for each key.
+    """
+
+    def __init__(self, max_images, max_per_image, idle_timeout=None):
+        self.max_per_image = max_per_image
+        # (image ID, session UUID, group ID) -> list of idle (image, session connection)
+        self._engines = LRUCache(max_images, idle_timeout=idle_timeout, on_evict=self._discard_engines)
+        self._lock = threading.Lock()
+        # engines dropped while holding the lock, closed after releasing it
+        self._discarded = []
+        self.created = 0
+        self.reused = 0
+        self.closed = 0
+
+    def _discard_engines(self, key, engines):
+        # called by self._engines, with self._lock held
+        self._discarded.extend(engines)
+
+    def _close_engine(self, image, session_connection):
+        try:
+            image._closeRE()
+        except Exception as e:
+            logger.debug('Error while closing rendering engine for image %s: %s', image.getId(), e)
+        get_session_connections().release(session_connection)
+        with self._lock:
+            self.closed += 1
+
+    def _close_discarded(self):
+        with self._lock:
+            discarded, self._discarded = self._discarded, []
+        for image, session_connection in discarded:
+            self._close_engine(image, session_connection)
+
+    def _checkout(self, key):
+        with self._lock:
+            idle_engines = self._engines.get(key)
+            if idle_engines:
+                self.reused += 1
+                engine = idle_engines.pop()
+            else:
+                self._engines.purge_expired()
+                engine = None
+        self._close_discarded()
+        return engine
+
+    def _checkin(self, key, engine):
+        with self._lock:
+            idle_engines = self._engines.get(key)
+            if idle_engines is None:
+                self._engines.set(key, [engine])
+            elif len(idle_engines) < self.max_per_image:
+                idle_engines.append(engine)
+            else:
+                self._discarded.append(engine)
+        self._close_discarded()
+
+    def _create(self, connection, image_id):
+        session_connections = get_session_connections()
+        session_connection = session_connections.acquire(connection)
+        try:
+            image = session_connection.getObject('Image', image_id)
+        except Exception:
+            session_connections.release(session_connection)
+            raise
+        if image is None:
+            session_connections.release(session_connection)
+            return None
+        with self._lock:
+            self.created += 1
+        return image, session_connection
+
+    @contextmanager
+    def image(self, connection, image_id):
+        """
+        Yields the image with ID image_id loaded through a pooled connection, its rendering engine is
+        prepared the first time it is used and kept when the image goes back to the pool. Yields None
+        if the image can't be loaded.
+        """
+        key = (str(image_id), ) + get_session_connections().get_session_key(connection)
+        engine = self._checkout(key) or self._create(connection, image_id)
+        if engine is None:
+            yield None
+            return
+        try:
+            yield engine[0]
+        except Exception:
+            # the rendering engine could be in an inconsistent state, don't reuse it
+            self._close_engine(*engine)
+            raise
+        self._checkin(key, engine)
+
+    def invalidate(self, image_id):
+        with self._lock:
+            for key, engines in self._engines.items():
+                if key[0] == str(image_id):
+                    self._engines.pop(key)
+                    self._discarded.extend(engines)
+        self._close_discarded()
+
+    def close(self):
+        with self._lock:
+            for key, engines in self._engines.items():
+                self._discarded.extend(engines)
+            self._engines.clear()
+        self._close_discarded()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'images': len(self._engines),
+                'created': self.created,
+                'reused': self.reused,
+                'closed': self.closed
+            }
+
+
+_rendering_engines_pool = None
+_rendering_engines_pool_lock = threading.Lock()
+
+
+def get_rendering_engines_pool():
+    global _rendering_engines_pool
+    if _rendering_engines_pool is None:
+        with _rendering_engines_pool_lock:
+            if _rendering_engines_pool is None:
+                _rendering_engines_pool = RenderingEnginesPool(settings.OME_RE_POOL_MAX_IMAGES,
+                                                               settings.OME_RE_POOL_MAX_PER_IMAGE,
+                                                               settings.OME_RE_POOL_IDLE_TIMEOUT or None)
+                atexit.register(_rendering_engines_pool.close)
+    return _rendering_engines_pool
@@ -0,0 +1,164 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import atexit
+import logging
+import threading
+
+from omero.gateway import BlitzGateway
+
+from ..lru_cache import LRUCache
+from .single_flight import SingleFlight
+from .. import settings
+
+logger = logging.getLogger(__name__)
+
+
+class SessionConnections(object):
+    """
+    Connections joining the OMERO sessions of the requests, keyed by session and group. The connections
+    of the requests are closed by login_required as soon as the view returns, work that goes on after
+    that (pooled rendering engines, prefetching, background renders) must use these ones instead.
+    Connections are closed without closing the session they joined.
+
+    Users keeping a connection beyond a single call acquire it and release it when done: a connection
+    evicted while acquired is closed when its last user releases it.
+    """
+
+    def __init__(self, max_sessions, idle_timeout=None):
+        if max_sessions < 1:
+            raise ValueError('max_sessions must be at least 1')
+        # (session UUID, group ID) -> connection
+        self._connections = LRUCache(max_sessions, idle_timeout=idle_timeout, on_evict=self._evict_connection)
+        self._lock = threading.Lock()
+        # sessions are joined without holding the lock, concurrent joins of the same session are coalesced
+        self._joins = SingleFlight()
+        # id(connection) -> [connection, session key, users, evicted] for every open connection
+        self._open = {}
+        # connections dropped while holding the lock, closed after releasing it
+        self._discarded = []
+        self.joined = 0
+        self.closed = 0
+
+    def _evict_connection(self, key, connection):
+        # called by self._connections, with self._lock held
+        state = self._open[id(connection)]
+        if state[2] > 0:
+            state[3] = True
+        else:
+            del self._open[id(connection)]
+            self._discarded.append((key, connection))
+
+    def _close_discarded(self):
+        with self._lock:
+            discarded, self._discarded = self._discarded, []
+            self.closed += len(discarded)
+        for key, connection in discarded:
+            logger.debug('Closing connection for session %s, group %s', *key)
+            try:
+                connection.close(hard=False)
+            except Exception as e:
+                logger.debug('Error while closing session connection: %s', e)
+
+    def get_session_key(self, connection):
+        ctx = connection.getEventContext()
+        return ctx.sessionUuid, ctx.groupId
+
+    def _join(self, session_key, connection):
+        session_uuid, group_id = session_key
+        session_connection = BlitzGateway(host=connection.host, port=connection.port,
+                                          secure=connection.secure, useragent='OMERO.ome_seadragon')
+        if not session_connection.connect(sUuid=session_uuid):
+            raise RuntimeError('Unable to join session %s' % session_uuid)
+        session_connection.SERVICE_OPTS.setOmeroGroup(group_id)
+        with self._lock:
+            self._open[id(session_connection)] = [session_connection, session_key, 0, False]
+            self._connections.set(session_key, session_connection)
+            self.joined += 1
+        self._close_discarded()
+
+    def _get_connection(self, connection, acquire):
+        session_key = self.get_session_key(connection)
+        while True:
+            with self._lock:
+                session_connection = self._connections.get(session_key)
+                if session_connection is None:
+                    self._connections.purge_expired()
+                elif acquire:
+                    self._open[id(session_connection)][2] += 1
+            self._close_discarded()
+            if session_connection is not None:
+                return session_connection
+            self._joins.do(session_key, lambda: self._join(session_key, connection))
+
+    def get_connection(self, connection):
+        """
+        Return a connection joining the session of connection, which must still be open.
+        """
+        return self._get_connection(connection, False)
+
+    def acquire(self, connection):
+        """
+        Same as get_connection, the returned connection is kept open until it is released.
+        """
+        return self._get_connection(connection, True)
+
+    def release(self, session_connection):
+        with self._lock:
+            state = self._open.get(id(session_connection))
+            if state is None:
+                # already closed by close()
+                return
+            state[2] -= 1
+            if state[2] == 0 and state[3]:
+                del self._open[id(session_connection)]
+                self._discarded.append((state[1], session_connection))
+        self._close_discarded()
+
+    def close(self):
+        with self._lock:
+            self._discarded.extend((key, connection) for connection, key, _, _ in self._open.values())
+            self._open.clear()
+            self._connections.clear()
+        self._close_discarded()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'connections': len(self._connections),
+                'in_use': sum(1 for state in self._open.values() if state[2] > 0),
+                'joined': self.joined,
+                'closed': self.closed
+            }
+
+
+_session_connections = None
+_session_connections_lock = threading.Lock()
+
+
+def get_session_connections():
+    global _session_connections
+    if _session_connections is None:
+        with _session_connections_lock:
+            if _session_connections is None:
+                _session_connections = SessionConnections(settings.SESSION_CONNECTIONS_MAX_SESSIONS,
+                                                          settings.SESSION_CONNECTIONS_IDLE_TIMEOUT or None)
+                atexit.register(_session_connections.close)
+    return _session_connections
@@ -0,0 +1,140 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import logging
+import os
+import threading
+
+import openslide
+
+from ..images_cache import get_images_cache
+from ..lru_cache import LRUCache
+from .slides_cache import get_slides_cache
+from .. import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _get_deepzoom_key(tile_size, overlap, limit_bounds):
+    return '%s|%s|%s' % (tile_size, overlap, limit_bounds)
+
+
+def build_slide_descriptor(slide, path, mtime):
+    try:
+        mpp = (float(slide.properties[openslide.PROPERTY_NAME_MPP_X]) +
+               float(slide.properties[openslide.PROPERTY_NAME_MPP_Y])) / 2
+    except (KeyError, ValueError):
+        mpp = 0
+    return {
+        'path': path,
+        'mtime': mtime,
+        'vendor': slide.properties.get(openslide.PROPERTY_NAME_VENDOR),
+        'dimensions': list(slide.dimensions),
+        'level_count': slide.level_count,
+        'level_dimensions': [list(d) for d in slide.level_dimensions],
+        'level_downsamples': list(slide.level_downsamples),
+        'mpp': mpp,
+        'bounds': [
+            int(slide.properties.get('openslide.bounds-x', 0)),
+            int(slide.properties.get('openslide.bounds-y', 0)),
+            int(slide.properties.get('openslide.bounds-height', 0)),
+            int(slide.properties.get('openslide.bounds-width', 0))
+        ],
+        # DZI geometry for each (tile size, overlap, limit bounds) requested so far
+        'deepzoom': {}
+    }
+
+
+class SlideDescriptors(object):
+    """
+    Geometry and metadata of the slides, computed once and then served from memory (and from the
+    images cache, if a shared cache is given). Descriptors are keyed by path and modification time
+    of the slide, so a replaced slide gets a new descriptor.
+
+    Published descriptors are never modified, since other threads could be reading them: adding the
+    DZI geometry for new DeepZoom parameters replaces the descriptor with an updated copy.
+    """
+
+    def __init__(self, max_entries, shared_cache=None):
+        self._descriptors = LRUCache(max_entries)
+        # serializes the updates of the descriptors
+        self._lock = threading.Lock()
+        self.shared_cache = shared_cache
+
+    def _store(self, key, descriptor):
+        self._descriptors.set(key, descriptor)
+        self._share(key, descriptor)
+
+    def _share(self, key, descriptor):
+        if self.shared_cache:
+            self.shared_cache.metadata_to_cache('SLIDE::%s' % key, descriptor)
+
+    def _get_descriptor(self, path):
+        path = os.path.realpath(path)
+        mtime = os.path.getmtime(path)
+        key = '%s|%s' % (path, mtime)
+        descriptor = self._descriptors.get(key)
+        if descriptor is None and self.shared_cache:
+            descriptor = self.shared_cache.metadata_from_cache('SLIDE::%s' % key)
+            if descriptor is not None:
+                self._descriptors.set(key, descriptor)
+        if descriptor is None:
+            logger.debug('Building descriptor for slide %s', path)
+            with get_slides_cache().slide(path) as slide:
+                descriptor = build_slide_descriptor(slide, path, mtime)
+            self._store(key, descriptor)
+        return key, descriptor
+
+    def get_descriptor(self, path):
+        return self._get_descriptor(path)[1]
+
+    def get_deepzoom_geometry(self, path, tile_size, overlap, limit_bounds):
+        key, descriptor = self._get_descriptor(path)
+        dz_key = _get_deepzoom_key(tile_size, overlap, limit_bounds)
+        dz_geometry = descriptor['deepzoom'].get(dz_key)
+        if dz_geometry is None:
+            with get_slides_cache().deepzoom(path, tile_size, overlap, limit_bounds) as dzg:
+                dz_geometry = {
+                    'width': dzg.level_dimensions[-1][0],
+                    'height': dzg.level_dimensions[-1][1],
+                    'level_count': dzg.level_count,
+                    'level_tiles': [list(t) for t in dzg.level_tiles],
+                    'level_dimensions': [list(d) for d in dzg.level_dimensions]
+                }
+            with self._lock:
+                # keep the geometries added by concurrent requests in the meantime
+                descriptor = self._descriptors.get(key) or descriptor
+                descriptor = dict(descriptor, deepzoom=dict(descriptor['deepzoom'], **{dz_key: dz_geometry}))
+                self._descriptors.set(key, descriptor)
+            self._share(key, descriptor)
+        return dz_geometry
+
+
+_slide_descriptors = None
+_slide_descriptors_lock = threading.Lock()
+
+
+def get_slide_descriptors():
+    global _slide_descriptors
+    if _slide_descriptors is None:
+        with _slide_descriptors_lock:
+            if _slide_descriptors is None:
+                _slide_descriptors = SlideDescriptors(settings.SLIDE_DESCRIPTORS_MAX_ENTRIES,
+                                                      get_images_cache())
+    return _slide_descriptors
@@ -0,0 +1,221 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+from openslide import OpenSlide
+from openslide.deepzoom import DeepZoomGenerator
+
+from ..lru_cache import LRUCache
+from ..metrics import count_slide_handle
+from .single_flight import SingleFlight
+from .. import settings
+
+logger = logging.getLogger(__name__)
+
+
+class _SlideHandle(object):
+
+    def __init__(self, path, mtime):
+        self.slide = OpenSlide(path)
+        self.path = path
+        self.mtime = mtime
+        # (tile_size, overlap, limit_bounds) -> DeepZoomGenerator
+        self.deepzoom_generators = {}
+        self.lock = threading.Lock()
+        # guarded by the cache's lock: requests reading from the slide, whether the cache dropped it and
+        # whether it is going to be closed
+        self.users = 0
+        self.evicted = False
+        self.discarded = False
+
+
+class SlidesCache(object):
+    """
+    Process-wide cache of open OpenSlide handles and of the DeepZoomGenerators built on top of them,
+    keyed by the resolved path of the slide.
+
+    Slides are opened once even if several requests ask for them at the same time, and are used
+    through the slide and deepzoom context managers: an evicted handle is closed as soon as the last
+    request reading from it is done. A handle is re-opened if the modification time of the slide
+    file changes.
+    """
+
+    def __init__(self, max_open, idle_timeout=None):
+        self.max_open = max_open
+        self._handles = LRUCache(max_open, idle_timeout=idle_timeout, on_evict=self._on_evict)
+        self._lock = threading.Lock()
+        self._opens = SingleFlight()
+        # handles dropped while holding the lock, closed after releasing it
+        self._discarded = []
+        self.opens = 0
+        self.closed = 0
+        self.deepzoom_hits = 0
+        self.deepzoom_builds = 0
+
+    def _on_evict(self, path, handle):
+        # called by self._handles, with self._lock held
+        logger.debug('Releasing OpenSlide handle for %s', path)
+        count_slide_handle('evicted')
+        self._evict_handle(handle)
+
+    def _evict_handle(self, handle):
+        # with self._lock held
+        handle.evicted = True
+        if handle.users == 0:
+            self._discard(handle)
+
+    def _discard(self, handle):
+        # with self._lock held
+        handle.discarded = True
+        self._discarded.append(handle)
+
+    def _close_discarded(self):
+        with self._lock:
+            discarded, self._discarded = self._discarded, []
+        for handle in discarded:
+            logger.debug('Closing OpenSlide handle for %s', handle.path)
+            try:
+                handle.slide.close()
+            except Exception as e:
+                logger.debug('Error while closing OpenSlide handle for %s: %s', handle.path, e)
+            with self._lock:
+                self.closed += 1
+
+    def _open(self, path, mtime):
+        logger.debug('Opening slide %s', path)
+        handle = _SlideHandle(path, mtime)
+        count_slide_handle('opened')
+        with self._lock:
+            self.opens += 1
+            # idle handles are only dropped when touched, take the chance to clean them up
+            self._handles.purge_expired()
+            replaced = self._handles.pop(path)
+            if replaced is not None:
+                self._evict_handle(replaced)
+            if self.max_open > 0:
+                self._handles.set(path, handle)
+            else:
+                # the cache is disabled, the handle is closed once used
+                handle.evicted = True
+        self._close_discarded()
+        return handle
+
+    def _acquire(self, path):
+        path = os.path.realpath(path)
+        mtime = os.path.getmtime(path)
+        while True:
+            with self._lock:
+                handle = self._handles.get(path)
+                if handle is not None and handle.mtime == mtime:
+                    handle.users += 1
+                    return handle
+            handle = self._opens.do((path, mtime), lambda: self._open(path, mtime))
+            with self._lock:
+                # a handle opened by a concurrent request could have been closed in the meantime
+                if not handle.discarded:
+                    handle.users += 1
+                    return handle
+
+    def _release(self, handle):
+        with self._lock:
+            handle.users -= 1
+            if handle.evicted and handle.users == 0:
+                self._discard(handle)
+        self._close_discarded()
+
+    @contextmanager
+    def slide(self, path):
+        """
+        Yields the OpenSlide handle of the slide at path, which is kept open until the block exits.
+        """
+        handle = self._acquire(path)
+        try:
+            yield handle.slide
+        finally:
+            self._release(handle)
+
+    @contextmanager
+    def deepzoom(self, path, tile_size, overlap, limit_bounds):
+        """
+        Yields the DeepZoomGenerator of the slide at path, whose handle is kept open until the block exits.
+        """
+        handle = self._acquire(path)
+        try:
+            dz_key = (tile_size, overlap, limit_bounds)
+            with handle.lock:
+                dzg = handle.deepzoom_generators.get(dz_key)
+                if dzg is None:
+                    dzg = DeepZoomGenerator(handle.slide, tile_size=tile_size, overlap=overlap,
+                                            limit_bounds=limit_bounds)
+                    handle.deepzoom_generators[dz_key] = dzg
+                    built = True
+                else:
+                    built = False
+            with self._lock:
+                if built:
+                    self.deepzoom_builds += 1
+                else:
+                    self.deepzoom_hits += 1
+            yield dzg
+        finally:
+            self._release(handle)
+
+    def purge_idle(self):
+        with self._lock:
+            purged = self._handles.purge_expired()
+        self._close_discarded()
+        return purged
+
+    def clear(self):
+        with self._lock:
+            for _, handle in self._handles.items():
+                self._evict_handle(handle)
+            self._handles.clear()
+        self._close_discarded()
+
+    def stats(self):
+        with self._lock:
+            handles_stats = self._handles.stats()
+            return {
+                'open_handles': handles_stats['entries'],
+                'hits': handles_stats['hits'],
+                'opens': self.opens,
+                'evictions': handles_stats['evictions'],
+                'closed': self.closed,
+                'deepzoom_hits': self.deepzoom_hits,
+                'deepzoom_builds': self.deepzoom_builds
+            }
+
+
+_slides_cache = None
+_slides_cache_lock = threading.Lock()
+
+
+def get_slides_cache():
+    global _slides_cache
+    if _slides_cache is None:
+        with _slides_cache_lock:
+            if _slides_cache is None:
+                _slides_cache = SlidesCache(settings.SLIDES_CACHE_MAX_OPEN,
+                                            settings.SLIDES_CACHE_IDLE_TIMEOUT or None)
+    return _slides_cache
@@ -0,0 +1,252 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+A tiles pack stores all the tiles of a DZI pyramid in a single file:
+
+    header      magic (4 bytes), format version (uint16) and size of the metadata (uint32)
+    metadata    JSON encoded DeepZoom configuration, modification time of the slide and number of columns
+                and rows of each level
+    index       for each level, for each row, for each column: tile offset (uint64) and size (uint32)
+    data        the encoded tiles
+
+All the integers are big endian, tiles that could not be rendered have size 0.
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+
+from ..lru_cache import LRUCache
+from .image_formats import get_image_quality, normalize_format
+from .. import settings
+
+logger = logging.getLogger(__name__)
+
+PACK_MAGIC = b'DZTP'
+PACK_VERSION = 1
+_HEADER = struct.Struct('>4sHI')
+_INDEX_ENTRY = struct.Struct('>QI')
+
+
+class InvalidTilesPack(Exception):
+    pass
+
+
+def get_pack_file_name(image_id, original_file_source, tile_size, limit_bounds, image_format):
+    return '%s_%s_%s_%s.%s.tpk' % ('of' if original_file_source else 'img', image_id, tile_size,
+                                   'lb' if limit_bounds else 'nolb', image_format.lower())
+
+
+class _TilesPackLayout(object):
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+        self.levels_base = []
+        count = 0
+        for columns, rows in metadata['levels']:
+            self.levels_base.append(count)
+            count += columns * rows
+        self.tiles_count = count
+
+    def get_index_position(self, level, column, row):
+        try:
+            columns, rows = self.metadata['levels'][level]
+        except IndexError:
+            return None
+        if not (0 <= column < columns and 0 <= row < rows):
+            return None
+        return self.levels_base[level] + row * columns + column
+
+
+class TilesPackWriter(object):
+    """
+    Write a tiles pack, tiles can be added in any order. The pack is written to a temporary file
+    which replaces the destination one when the writer is closed.
+    """
+
+    def __init__(self, path, tile_size, overlap, limit_bounds, image_format, image_quality, levels,
+                 slide_mtime=None):
+        self.path = path
+        self.layout = _TilesPackLayout({
+            'tile_size': tile_size,
+            'overlap': overlap,
+            'limit_bounds': limit_bounds,
+            'format': image_format.lower(),
+            'quality': image_quality,
+            'slide_mtime': slide_mtime,
+            'levels': [list(l) for l in levels]
+        })
+        self._tmp_path = '%s.tmp' % path
+        self._file = open(self._tmp_path, 'wb')
+        metadata = json.dumps(self.layout.metadata).encode('utf-8')
+        self._file.write(_HEADER.pack(PACK_MAGIC, PACK_VERSION, len(metadata)))
+        self._file.write(metadata)
+        self._index_offset = self._file.tell()
+        self._index = [(0, 0)] * self.layout.tiles_count
+        self._file.write(b'\0' * (_INDEX_ENTRY.size * self.layout.tiles_count))
+
+    def add_tile(self, level, column, row, tile_data):
+        position = self.layout.get_index_position(level, column, row)
+        if position is None:
+            raise ValueError('Invalid tile address %d/%d_%d' % (level, column, row))
+        offset = self._file.tell()
+        self._file.write(tile_data)
+        self._index[position] = (offset, len(tile_data))
+
+    def close(self):
+        self._file.seek(self._index_offset)
+        self._file.write(b''.join(_INDEX_ENTRY.pack(*entry) for entry in self._index))
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class TilesPack(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        with open(path, 'rb') as f:
+            try:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file
+                raise InvalidTilesPack('%s is not a valid tiles pack' % path)
+        try:
+            magic, version, metadata_size = _HEADER.unpack_from(self._data, 0)
+        except struct.error:
+            raise InvalidTilesPack('%s is not a valid tiles pack' % path)
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            raise InvalidTilesPack('%s is not a valid tiles pack' % path)
+        self._index_offset = _HEADER.size + metadata_size
+        try:
+            metadata = json.loads(self._data[_HEADER.size:self._index_offset])
+            for key in ('tile_size', 'overlap', 'limit_bounds', 'format', 'quality'):
+                metadata[key]
+            self.layout = _TilesPackLayout(metadata)
+        except (ValueError, TypeError, KeyError) as e:
+            # JSON decoding errors and UnicodeDecodeError are ValueErrors
+            raise InvalidTilesPack('%s has invalid metadata: %s' % (path, e))
+        if len(self._data) < self._index_offset + _INDEX_ENTRY.size * self.layout.tiles_count:
+            raise InvalidTilesPack('%s is truncated' % path)
+
+    @property
+    def metadata(self):
+        return self.layout.metadata
+
+    def matches(self, tile_size, overlap, limit_bounds, image_format, image_quality):
+        return (self.metadata['tile_size'], self.metadata['overlap'], self.metadata['limit_bounds'],
+                self.metadata['format'], self.metadata['quality']) == \
+            (tile_size, overlap, limit_bounds, image_format.lower(), image_quality)
+
+    def built_from(self, slide_path):
+        # like slide descriptors, packs are bound to the modification time of the slide, a pack built
+        # before the slide was replaced is not served
+        try:
+            return self.metadata.get('slide_mtime') == os.path.getmtime(slide_path)
+        except OSError:
+            return False
+
+    def get_tile(self, level, column, row):
+        position = self.layout.get_index_position(level, column, row)
+        if position is None:
+            return None
+        offset, size = _INDEX_ENTRY.unpack_from(self._data, self._index_offset + position * _INDEX_ENTRY.size)
+        if size == 0:
+            return None
+        return self._data[offset:offset + size]
+
+
+class TilesPacksRegistry(object):
+    """
+    Keep the tiles packs found in a folder open and memory mapped, packs are reloaded when their
+    modification time changes.
+    """
+
+    def __init__(self, packs_folder, max_open=64):
+        self.packs_folder = packs_folder
+        self._packs = LRUCache(max_open)
+
+    def get_pack(self, pack_name):
+        path = os.path.join(self.packs_folder, pack_name)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        pack = self._packs.get(pack_name)
+        if pack is None or pack.mtime != mtime:
+            pack = TilesPack(path)
+            self._packs.set(pack_name, pack)
+        return pack
+
+
+_tiles_packs_registry = None
+_tiles_packs_registry_lock = threading.Lock()
+
+
+def get_tiles_packs_registry():
+    global _tiles_packs_registry
+    if _tiles_packs_registry is None:
+        with _tiles_packs_registry_lock:
+            if _tiles_packs_registry is None:
+                _tiles_packs_registry = TilesPacksRegistry(settings.TILES_PACKS_FOLDER)
+    return _tiles_packs_registry
+
+
+# return the requested tile if a pre-rendered pack built from slide_path, the current file of the image, with
+# the current DeepZoom configuration exists
+def get_tile_from_pack(image_id, original_file_source, slide_path, level, column, row, tile_size=None,
+                       limit_bounds=None, image_format=None):
+    if not settings.TILES_PACKS_FOLDER:
+        return None
+    tile_size = tile_size if tile_size is not None else settings.DEEPZOOM_TILE_SIZE
+    limit_bounds = limit_bounds if limit_bounds is not None else settings.DEEPZOOM_LIMIT_BOUNDS
+    image_format = normalize_format(image_format if image_format is not None else settings.DEEPZOOM_FORMAT)
+    pack_name = get_pack_file_name(image_id, original_file_source, tile_size, limit_bounds, image_format)
+    try:
+        pack = get_tiles_packs_registry().get_pack(pack_name)
+    except InvalidTilesPack as itp:
+        logger.error(itp)
+        return None
+    if pack is None:
+        return None
+    if not pack.matches(tile_size, settings.DEEPZOOM_OVERLAP, limit_bounds, image_format,
+                        get_image_quality(image_format)):
+        logger.debug('Tiles pack %s was built with a different configuration, ignoring it', pack_name)
+        return None
+    if not pack.built_from(slide_path):
+        logger.debug('Tiles pack %s was built from a different version of the slide, ignoring it', pack_name)
+        return None
+    return pack.get_tile(level, column, row)
@@ -0,0 +1,92 @@
+import importlib
+import os
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+parent_package = Path(os.path.dirname(os.path.realpath(__file__))).parent.name
+BackgroundRenders = importlib.import_module(f"{parent_package}.slides_manager.background_renders").BackgroundRenders
+
+
+def _wait_for_stats(background_renders, **expected):
+    # detached renders are accounted by a done callback, which can run after result() returned
+    expire = time.time() + 5
+    while time.time() < expire:
+        stats = background_renders.stats()
+        if all(stats[k] == v for k, v in expected.items()):
+            return stats
+        time.sleep(0.01)
+    return background_renders.stats()
+
+
+@pytest.fixture
+def background_renders():
+    renders = BackgroundRenders(workers=1, max_queue_size=1, deadline_workers=2)
+    yield renders
+    renders._executor.shutdown(wait=True)
+    renders._deadline_executor.shutdown(wait=True)
+
+
+def test_start_runs_render_on_a_deadline_worker(background_renders):
+    threads = []
+
+    def render():
+        threads.append(threading.current_thread())
+        return 'tile'
+
+    assert background_renders.start(render).result(timeout=5) == 'tile'
+    assert threads[0] is not threading.current_thread()
+    assert background_renders.stats()['submitted'] == 0
+
+
+def test_start_is_bounded(background_renders):
+    release = threading.Event()
+    futures = [background_renders.start(lambda: release.wait(5)) for _ in range(2)]
+    # all the deadline workers are busy, the caller has to render by itself
+    assert background_renders.start(lambda: None) is None
+    assert background_renders.stats()["saturated"] == 1
+    release.set()
+    for f in futures:
+        f.result(timeout=5)
+    assert background_renders.stats()["deadline_renders"] == 0
+    assert background_renders.start(lambda: "tile").result(timeout=5) == "tile"
+
+
+def test_start_propagates_exceptions(background_renders):
+    def render():
+        raise ValueError('no tile')
+
+    with pytest.raises(ValueError):
+        background_renders.start(render).result(timeout=5)
+
+
+def test_detach_is_bounded(background_renders):
+    release = threading.Event()
+    first = background_renders.start(lambda: release.wait(5))
+    second = background_renders.start(lambda: release.wait(5))
+    assert background_renders.detach(first)
+    assert not background_renders.detach(second)
+    assert background_renders.stats()['queued'] == 1
+    assert background_renders.stats()['rejected'] == 1
+    release.set()
+    first.result(timeout=5)
+    second.result(timeout=5)
+    assert _wait_for_stats(background_renders, queued=0)['queued'] == 0
+
+
+def test_detached_failures_are_counted(background_renders):
+    release = threading.Event()
+
+    def render():
+        release.wait(5)
+        raise ValueError('no tile')
+
+    future = background_renders.start(render)
+    assert background_renders.detach(future)
+    release.set()
+    with pytest.raises(ValueError):
+        future.result(timeout=5)
+    assert _wait_for_stats(background_renders, queued=0) == {'queued': 0, 'deadline_renders': 0, 'submitted': 1,
+                                                             'rejected': 0, 'failed': 1, 'saturated': 0}
@@ -0,0 +1,125 @@
+import importlib
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+import pytest
+
+parent_package = Path(os.path.dirname(os.path.realpath(__file__))).parent.name
+disk_cache = importlib.import_module(f"{parent_package}.images_cache.disk_cache")
+settings = importlib.import_module(f"{parent_package}.settings")
+
+
+@pytest.fixture
+def make_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "IMAGES_CACHE_STALE_TIME", 0, raising=False)
+    monkeypatch.setattr(settings, "IMAGES_CACHE_GENERATION_TTL", 0, raising=False)
+    # tests run evict() explicitly
+    monkeypatch.setattr(disk_cache.DiskCache, "_eviction_loop", lambda self: None)
+    return lambda max_bytes=10 ** 6, expire_time=None: disk_cache.DiskCache(str(tmp_path), max_bytes, expire_time)
+
+
+def _age_entry(cache, key, seconds):
+    file_path = cache._get_file_path(cache._get_key_hash(key))
+    mtime = time.time() - seconds
+    os.utime(file_path, (mtime, mtime))
+
+
+def test_set_get(make_cache):
+    cache = make_cache()
+    assert cache._get("a") is None
+    cache._set("a", b"tile a")
+    cache._set_many([("b", b"tile b"), ("c", "path c")])
+    assert cache._get("a") == b"tile a"
+    assert cache._get_many(["b", "c", "d"]) == [b"tile b", b"path c", None]
+    assert cache.stats() == {"entries": 3, "bytes": 18}
+    # values and index survive a restart
+    assert make_cache()._get("a") == b"tile a"
+
+
+def test_counters(make_cache):
+    cache = make_cache()
+    assert cache.get_generation(1) == 0
+    assert cache.bump_generation(1) == 1
+    assert cache.bump_generation(1) == 2
+    assert cache.get_generation(1) == 2
+    assert cache.get_generation(2) == 0
+
+
+def test_expiry(make_cache):
+    cache = make_cache(expire_time={"seconds": 10})
+    cache._set("a", b"tile a")
+    cache._set("b", b"tile b")
+    _age_entry(cache, "a", 20)
+    assert cache._get("a") is None
+    assert cache._get("b") == b"tile b"
+    # eviction uses the creation time stored in the index
+    with cache._get_index() as index:
+        index.execute("UPDATE entries SET created = ? WHERE key_hash = ?",
+                      (time.time() - 20, cache._get_key_hash("a")))
+    cache.evict()
+    assert cache.stats() == {"entries": 1, "bytes": 6}
+    assert not os.path.exists(cache._get_file_path(cache._get_key_hash("a")))
+
+
+def test_lru_eviction(make_cache):
+    cache = make_cache(max_bytes=1000)
+    for i in range(10):
+        cache._set("k%d" % i, b"x" * 150)
+        time.sleep(0.01)
+    assert cache._get("k0") is not None
+    cache.evict()
+    # least recently used entries are evicted until the cache is 90% full
+    assert cache.stats() == {"entries": 6, "bytes": 900}
+    assert [i for i in range(10) if cache._get("k%d" % i) is not None] == [0, 5, 6, 7, 8, 9]
+
+
+def test_paths(make_cache):
+    cache = make_cache()
+    cache.path_to_cache(1, "img", "/data/a.svs")
+    cache.path_to_cache(1, "of", "/data/a.mrxs", ttl=10)
+    cache.path_to_cache(2, "img", "/data/b.svs", ttl=-10)
+    assert cache.path_from_cache(1, "img") == "/data/a.svs"
+    assert cache.path_from_cache(1, "of") == "/data/a.mrxs"
+    assert cache.path_from_cache(2, "img") is None
+    cache.paths_delete(1)
+    assert cache.path_from_cache(1, "img") is None
+    assert cache.path_from_cache(1, "of") is None
+
+
+def test_index_errors(make_cache, monkeypatch):
+    cache = make_cache()
+    cache._set("a", b"tile a")
+    broken_index = sqlite3.connect(":memory:")
+    broken_index.close()
+    monkeypatch.setattr(cache, "_get_index", lambda: broken_index)
+    # index errors are logged, the cache behaves as if it were empty
+    cache.path_to_cache(1, "img", "/data/a.svs")
+    assert cache.path_from_cache(1, "img") is None
+    cache.paths_delete(1)
+    assert cache._get_counter("counter") is None
+    cache._set("b", b"tile b")
+    assert cache._get("b") == b"tile b"
+    assert cache.stats() == {"entries": None, "bytes": None}
+
+
+def test_unbounded(make_cache):
+    with pytest.raises(ValueError):
+        make_cache(max_bytes=0)
+    cache = make_cache(max_bytes=None)
+    for i in range(10):
+        cache._set("k%d" % i, b"x" * 150)
+    assert not cache._eviction_needed.is_set()
+    cache.evict()
+    assert cache.stats() == {"entries": 10, "bytes": 1500}
+
+
+def test_eviction_trigger(make_cache):
+    cache = make_cache(max_bytes=1000)
+    cache._set("a", b"x" * 50)
+    assert not cache._eviction_needed.is_set()
+    cache._set("b", b"x" * 60)
+    assert cache._eviction_needed.is_set()
+    cache.evict()
+    assert cache._written == 0
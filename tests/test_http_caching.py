@@ -0,0 +1,105 @@
+import importlib
+import os
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+import django
+
+django.setup()
+
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.utils.http import http_date
+
+parent_package = Path(os.path.dirname(os.path.realpath(__file__))).parent.name
+http_caching = importlib.import_module(f"{parent_package}.http_caching")
+settings = importlib.import_module(f"{parent_package}.settings")
+
+
+@pytest.fixture(autouse=True)
+def http_cache_settings(monkeypatch):
+    monkeypatch.setattr(settings, "HTTP_CACHE_ENABLED", True, raising=False)
+    monkeypatch.setattr(settings, "HTTP_CACHE_PUBLIC", False, raising=False)
+
+
+@pytest.fixture
+def validators():
+    return http_caching.HttpValidators("/data/slide.svs", 1600000000.5, 256, "jpeg")
+
+
+def test_etag_depends_on_source_and_render_params(validators):
+    assert validators.etag == http_caching.HttpValidators("/data/slide.svs", 1600000000.5, 256, "jpeg").etag
+    assert validators.etag != http_caching.HttpValidators("/data/slide.svs", 1600000001, 256, "jpeg").etag
+    assert validators.etag != http_caching.HttpValidators("/data/slide.svs", 1600000000.5, 512, "jpeg").etag
+    assert validators.etag.startswith('"') and validators.etag.endswith('"')
+    assert validators.last_modified == 1600000000
+
+
+def test_file_validators(tmp_path, monkeypatch):
+    slide = tmp_path / "slide.svs"
+    slide.write_bytes(b"slide")
+    os.utime(slide, (1600000000, 1600000000))
+    file_validators = http_caching.get_file_validators(str(slide), "tile", 0)
+    assert file_validators.last_modified == 1600000000
+    assert file_validators.etag == http_caching.get_file_validators(str(slide), "tile", 0).etag
+    assert http_caching.get_file_validators(str(tmp_path / "missing.svs"), "tile", 0) is None
+    monkeypatch.setattr(settings, "HTTP_CACHE_ENABLED", False)
+    assert http_caching.get_file_validators(str(slide), "tile", 0) is None
+
+
+def test_not_modified_response(validators):
+    factory = RequestFactory()
+    assert http_caching.get_not_modified_response(factory.get("/"), validators, 60) is None
+    assert http_caching.get_not_modified_response(factory.get("/"), None, 60) is None
+    response = http_caching.get_not_modified_response(factory.get("/", HTTP_IF_NONE_MATCH=validators.etag),
+                                                      validators, 60)
+    assert response.status_code == 304
+    response = http_caching.get_not_modified_response(
+        factory.get("/", HTTP_IF_MODIFIED_SINCE=http_date(validators.last_modified)), validators, 60
+    )
+    assert response.status_code == 304
+    response = http_caching.get_not_modified_response(
+        factory.get("/", HTTP_IF_MODIFIED_SINCE=http_date(validators.last_modified - 1)), validators, 60
+    )
+    assert response is None
+
+
+def test_if_none_match_takes_precedence(validators):
+    factory = RequestFactory()
+    # If-Modified-Since is ignored when If-None-Match is present
+    request = factory.get("/", HTTP_IF_NONE_MATCH='"other"',
+                          HTTP_IF_MODIFIED_SINCE=http_date(validators.last_modified))
+    assert http_caching.get_not_modified_response(request, validators, 60) is None
+    request = factory.get("/", HTTP_IF_NONE_MATCH=validators.etag,
+                          HTTP_IF_MODIFIED_SINCE=http_date(validators.last_modified - 1))
+    assert http_caching.get_not_modified_response(request, validators, 60).status_code == 304
+
+
+def test_cache_headers(validators, monkeypatch):
+    response = http_caching.add_cache_headers(HttpResponse(), validators, 60)
+    assert response["ETag"] == validators.etag
+    assert response["Last-Modified"] == http_date(validators.last_modified)
+    assert set(response["Cache-Control"].split(", ")) == {"private", "max-age=60"}
+    monkeypatch.setattr(settings, "HTTP_CACHE_PUBLIC", True)
+    response = http_caching.add_cache_headers(HttpResponse(), validators, 60)
+    assert set(response["Cache-Control"].split(", ")) == {"public", "max-age=60"}
+    assert not http_caching.add_cache_headers(HttpResponse(status=404), validators, 60).has_header("ETag")
+
+
+def test_not_modified_cache_headers(validators, monkeypatch):
+    factory = RequestFactory()
+    request = factory.get("/", HTTP_IF_NONE_MATCH=validators.etag)
+    response = http_caching.get_not_modified_response(request, validators, 60)
+    assert response.status_code == 304
+    assert response["ETag"] == validators.etag
+    assert set(response["Cache-Control"].split(", ")) == {"private", "max-age=60"}
+    monkeypatch.setattr(settings, "HTTP_CACHE_PUBLIC", True)
+    response = http_caching.get_not_modified_response(request, validators, 120)
+    assert set(response["Cache-Control"].split(", ")) == {"public", "max-age=120"}
+    # a failed precondition is not a cacheable response
+    request = factory.put("/", HTTP_IF_MATCH='"other"')
+    response = http_caching.get_not_modified_response(request, validators, 60)
+    assert response.status_code == 412
+    assert not response.has_header("Cache-Control")
@@ -0,0 +1,67 @@
+import time
+
+import pytest
+
+from lru_cache import LRUCache
+
+
+@pytest.fixture
+def evicted():
+    return []
+
+
+@pytest.fixture
+def cache(evicted):
+    return LRUCache(2, on_evict=lambda k, v: evicted.append(k))
+
+
+def test_lru_eviction(cache, evicted):
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert evicted == ["b"]
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats() == {"entries": 2, "hits": 3, "misses": 1, "evictions": 1}
+
+
+def test_ttl_expiration():
+    cache = LRUCache(10, ttl=0.05)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    time.sleep(0.1)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_idle_timeout():
+    cache = LRUCache(10, idle_timeout=0.05)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    for _ in range(3):
+        time.sleep(0.03)
+        assert cache.get("a") == 1
+    assert cache.purge_expired() == 1
+    assert cache.get("a") == 1
+
+
+def test_disabled_cache():
+    cache = LRUCache(0)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+
+
+def test_max_bytes(evicted):
+    cache = LRUCache(None, max_bytes=10, on_evict=lambda k, v: evicted.append(k))
+    cache.set("a", b"1234")
+    cache.set("b", b"5678")
+    assert cache.get("a") == b"1234"
+    cache.set("c", b"90ab")
+    assert evicted == ["b"]
+    cache.set("d", b"too big for the cache")
+    assert cache.get("d") is None
+    assert cache.stats()["bytes"] == 8
+    cache.pop("a")
+    assert cache.stats()["bytes"] == 4
@@ -0,0 +1,68 @@
+import importlib
+import os
+import random
+from contextlib import contextmanager
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+parent_package = Path(os.path.dirname(os.path.realpath(__file__))).parent.name
+ome_engine = importlib.import_module(f"{parent_package}.slides_manager.ome_engine")
+settings = importlib.import_module(f"{parent_package}.settings")
+
+LEVEL = 11
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    for name, value in (("DEEPZOOM_TILE_SIZE", 256), ("DEEPZOOM_OVERLAP", 1), ("OME_SUPERTILE_SIZE", 4),
+                        ("OME_TILES_BACKEND", "raw"), ("DEEPZOOM_PNG_COMPRESS_LEVEL", 1),
+                        ("DEEPZOOM_RESAMPLING", "lanczos"), ("DEEPZOOM_FAST_RESAMPLING", "bilinear")):
+        monkeypatch.setattr(settings, name, value, raising=False)
+    # OMERO level 1 of a 3000x2000 image, DZI level 11 is rendered from it with a non integer scale factor
+    random.seed(0)
+    level_image = Image.frombytes("RGB", (1500, 1000), bytes(random.getrandbits(8) for _ in range(1500 * 1000 * 3)))
+    geometry = {
+        "image_id": 1,
+        "size_x": 3000,
+        "size_y": 2000,
+        "ome_scales": [1.0, 0.5],
+        "dzi_max_level": 12,
+        "dzi_levels": {LEVEL: {"ome_level": 1, "scale_factor": 1.3}}
+    }
+
+    @contextmanager
+    def get_ome_image(image_id):
+        yield object()
+
+    engine = ome_engine.OmeEngine(1, None)
+    engine._get_geometry = lambda: geometry
+    engine._get_ome_image = get_ome_image
+    engine._render_raw_region = lambda ome_img, ome_level, x, y, w, h: level_image.crop((x, y, x + w, y + h))
+    return engine
+
+
+@pytest.mark.parametrize("column, row, tile_size", [(0, 0, 256), (5, 1, 256), (1, 1, 512)])
+def test_supertile_matches_single_tiles(engine, column, row, tile_size):
+    tiles = engine._render_supertile(LEVEL, column, row, tile_size, "png", None, None)
+    assert len(tiles) > 0
+    for (t_column, t_row), tile in tiles.items():
+        assert tile == engine._render_tile(LEVEL, t_column, t_row, tile_size, "png")
+
+
+def test_tile_regions_are_whole_pixels(engine):
+    geometry = engine._get_geometry()
+    for column in range(8):
+        _, _, region = engine._get_ome_tile_region(geometry, LEVEL, column, 0, 256)
+        assert all(isinstance(v, int) for v in region)
+        assert region[1] + region[3] <= 1000
+
+
+def test_tile_regions_use_requested_tile_size(engine):
+    geometry = engine._get_geometry()
+    # tiles with a size different from DEEPZOOM_TILE_SIZE are placed on their own grid on both axes
+    _, _, region = engine._get_ome_tile_region(geometry, LEVEL, 1, 1, 512)
+    assert region[:2] == (round(512 * 1.3 - 1.3), round(512 * 1.3 - 1.3))
+    _, _, region = engine._get_ome_tile_region(geometry, LEVEL, 1, 1, 256)
+    assert region[:2] == (round(256 * 1.3 - 1.3), round(256 * 1.3 - 1.3))
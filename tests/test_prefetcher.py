@@ -0,0 +1,78 @@
+import importlib
+import os
+import threading
+import time
+from pathlib import Path
+
+parent_package = Path(os.path.dirname(os.path.realpath(__file__))).parent.name
+prefetcher = importlib.import_module(f"{parent_package}.slides_manager.prefetcher")
+
+
+class FakeEngine(object):
+
+    def __init__(self, image_id, release):
+        self.image_id = image_id
+        self.release = release
+        self.rendered = []
+        self.background_engines = 0
+
+    def get_background_engine(self):
+        self.background_engines += 1
+        return self
+
+    def get_tile(self, level, column, row, *args):
+        self.release.wait(5)
+        self.rendered.append((level, column, row))
+        return b"tile", "image/jpeg"
+
+
+def _wait_for_queue(tiles_prefetcher):
+    expire = time.time() + 5
+    while tiles_prefetcher.stats()["queued"] > 0 and time.time() < expire:
+        time.sleep(0.01)
+
+
+def test_tiles_to_prefetch():
+    assert sorted(prefetcher.get_tiles_to_prefetch(5, 3, 4, ring=1, depth=1)) == [
+        (5, 2, 3), (5, 2, 4), (5, 2, 5), (5, 3, 3), (5, 3, 5), (5, 4, 3), (5, 4, 4), (5, 4, 5),
+        (6, 6, 8), (6, 6, 9), (6, 7, 8), (6, 7, 9)
+    ]
+    # no negative addresses at the image borders
+    assert sorted(prefetcher.get_tiles_to_prefetch(5, 0, 0, ring=1, depth=0)) == [(5, 0, 1), (5, 1, 0), (5, 1, 1)]
+    tiles = prefetcher.get_tiles_to_prefetch(5, 0, 0, ring=0, depth=2)
+    assert len(tiles) == 4 + 16
+    assert set(t for t in tiles if t[0] == 7) == set((7, c, r) for c in range(4) for r in range(4))
+
+
+def test_queue_caps():
+    release = threading.Event()
+    tiles_prefetcher = prefetcher.TilesPrefetcher(1, max_queue_size=5, max_per_image=3, ring=1, depth=0)
+    engine_a, engine_b = FakeEngine(1, release), FakeEngine(2, release)
+    tiles_prefetcher.prefetch(engine_a, 5, 3, 3)
+    assert tiles_prefetcher.stats() == {"queued": 3, "scheduled": 3, "skipped": 5, "failed": 0}
+    # already queued tiles are not counted twice
+    tiles_prefetcher.prefetch(engine_a, 5, 3, 3)
+    assert tiles_prefetcher.stats()["scheduled"] == 3
+    tiles_prefetcher.prefetch(engine_b, 5, 3, 3)
+    assert tiles_prefetcher.stats() == {"queued": 5, "scheduled": 5, "skipped": 16, "failed": 0}
+    release.set()
+    _wait_for_queue(tiles_prefetcher)
+    assert len(engine_a.rendered) == 3 and len(engine_b.rendered) == 2
+    # tiles are rendered with a single background engine for each prefetch
+    assert engine_a.background_engines == 1
+    # recently prefetched tiles are skipped without queueing them again
+    tiles_prefetcher.prefetch(engine_a, 5, 3, 3)
+    _wait_for_queue(tiles_prefetcher)
+    assert len(engine_a.rendered) == 3 + 3
+    assert not set(engine_a.rendered[:3]) & set(engine_a.rendered[3:])
+
+
+def test_background_engine_failure():
+    class BrokenEngine(FakeEngine):
+
+        def get_background_engine(self):
+            raise RuntimeError("Unable to join session")
+
+    tiles_prefetcher = prefetcher.TilesPrefetcher(1, max_queue_size=5, max_per_image=3, ring=1, depth=0)
+    tiles_prefetcher.prefetch(BrokenEngine(1, threading.Event()), 5, 3, 3)
+    assert tiles_prefetcher.stats() == {"queued": 0, "scheduled": 0, "skipped": 0, "failed": 0}
@@ -0,0 +1,119 @@
+import importlib
+import os
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+parent_package = Path(os.path.dirname(os.path.realpath(__file__))).parent.name
+session_connections = importlib.import_module(f"{parent_package}.slides_manager.session_connections")
+rendering_engines_pool = importlib.import_module(f"{parent_package}.slides_manager.rendering_engines_pool")
+
+
+class _Gateway(object):
+    # joins of sessions listed in slow_sessions wait for release_joins
+    slow_sessions = set()
+    release_joins = threading.Event()
+    joins = []
+
+    def __init__(self, host, port, secure, useragent):
+        self.SERVICE_OPTS = SimpleNamespace(setOmeroGroup=lambda group_id: None)
+        self.closed = False
+
+    def connect(self, sUuid):
+        _Gateway.joins.append(sUuid)
+        if sUuid in _Gateway.slow_sessions:
+            _Gateway.release_joins.wait(5)
+        return True
+
+    def close(self, hard=True):
+        self.closed = True
+
+    def getObject(self, obj_type, obj_id):
+        return _Image(self, obj_id)
+
+
+class _Image(object):
+
+    def __init__(self, conn, image_id):
+        self.conn = conn
+        self.image_id = image_id
+
+    def getId(self):
+        return self.image_id
+
+    def _closeRE(self):
+        pass
+
+
+def _request_connection(session_uuid, group_id=1):
+    ctx = SimpleNamespace(sessionUuid=session_uuid, groupId=group_id)
+    return SimpleNamespace(host="omero", port=4064, secure=True, getEventContext=lambda: ctx)
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    monkeypatch.setattr(session_connections, "BlitzGateway", _Gateway)
+    _Gateway.slow_sessions = set()
+    _Gateway.release_joins = threading.Event()
+    _Gateway.joins = []
+    connections = session_connections.SessionConnections(max_sessions=2, idle_timeout=0.2)
+    monkeypatch.setattr(session_connections, "_session_connections", connections)
+    return connections
+
+
+def _get_in_thread(connections, conn, results):
+    thread = threading.Thread(target=lambda: results.append(connections.get_connection(conn)))
+    thread.start()
+    return thread
+
+
+def test_joins_of_a_session_are_coalesced(connections):
+    _Gateway.slow_sessions = {"a"}
+    results = []
+    threads = [_get_in_thread(connections, _request_connection("a"), results) for _ in range(4)]
+    # a slow join doesn't block the other sessions
+    assert not connections.get_connection(_request_connection("b")).closed
+    _Gateway.release_joins.set()
+    for t in threads:
+        t.join(5)
+    assert len(results) == 4 and all(r is results[0] for r in results)
+    assert sorted(_Gateway.joins) == ["a", "b"]
+
+
+def test_acquired_connections_are_closed_when_released(connections):
+    conn = _request_connection("a")
+    acquired = connections.acquire(conn)
+    time.sleep(0.3)
+    # the idle connection was evicted, but it is still in use
+    assert connections.get_connection(conn) is not acquired
+    assert not acquired.closed
+    assert connections.stats()["in_use"] == 1
+    connections.release(acquired)
+    assert acquired.closed
+    assert connections.stats()["closed"] == 1
+
+
+def test_evicted_connections_are_closed(connections):
+    first = connections.get_connection(_request_connection("a"))
+    connections.get_connection(_request_connection("b"))
+    connections.get_connection(_request_connection("c"))
+    assert first.closed
+    assert connections.stats() == {"connections": 2, "in_use": 0, "joined": 3, "closed": 1}
+
+
+def test_pooled_engines_keep_their_connections_open(connections):
+    pool = rendering_engines_pool.RenderingEnginesPool(max_images=4, max_per_image=1)
+    conn = _request_connection("a")
+    with pool.image(conn, 1) as image:
+        session_connection = image.conn
+    time.sleep(0.3)
+    # the session connection expired while the engine was idle in the pool
+    connections.get_connection(_request_connection("b"))
+    with pool.image(conn, 1) as image:
+        assert image.conn is session_connection and not session_connection.closed
+    pool.invalidate(1)
+    assert session_connection.closed
+    assert pool.stats() == {"images": 0, "created": 1, "reused": 1, "closed": 1}
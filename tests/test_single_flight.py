@@ -0,0 +1,87 @@
+import importlib
+import os
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+parent_package = Path(os.path.dirname(os.path.realpath(__file__))).parent.name
+SingleFlight = importlib.import_module(f"{parent_package}.slides_manager.single_flight").SingleFlight
+
+
+def _run_concurrently(single_flight, key, fn, callers):
+    results = [None] * callers
+    errors = [None] * callers
+
+    def call(index):
+        try:
+            results[index] = single_flight.do(key, fn)
+        except Exception as e:
+            errors[index] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(callers)]
+    for t in threads:
+        t.start()
+    return threads, results, errors
+
+
+def _wait_for_followers(single_flight, followers):
+    expire = time.time() + 5
+    while single_flight.stats()["coalesced"] < followers and time.time() < expire:
+        time.sleep(0.01)
+
+
+def test_followers_share_leader_result():
+    single_flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    runs = []
+
+    def fn():
+        runs.append(1)
+        started.set()
+        release.wait(5)
+        return "tile"
+
+    leader, results, errors = _run_concurrently(single_flight, "k", fn, 1)
+    started.wait(5)
+    followers, f_results, f_errors = _run_concurrently(single_flight, "k", fn, 3)
+    _wait_for_followers(single_flight, 3)
+    release.set()
+    for t in leader + followers:
+        t.join(5)
+    assert runs == [1]
+    assert results + f_results == ["tile"] * 4
+    assert errors + f_errors == [None] * 4
+    assert single_flight.stats() == {"calls": 1, "coalesced": 3, "in_flight": 0}
+
+
+def test_exception_propagates_to_followers():
+    single_flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def fn():
+        started.set()
+        release.wait(5)
+        raise ValueError("render failed")
+
+    leader, _, errors = _run_concurrently(single_flight, "k", fn, 1)
+    started.wait(5)
+    followers, _, f_errors = _run_concurrently(single_flight, "k", fn, 2)
+    _wait_for_followers(single_flight, 2)
+    release.set()
+    for t in leader + followers:
+        t.join(5)
+    assert all(isinstance(e, ValueError) for e in errors + f_errors)
+
+
+def test_key_released_after_completion():
+    single_flight = SingleFlight()
+    assert single_flight.do("k", lambda: 1) == 1
+    with pytest.raises(ValueError):
+        single_flight.do("k", lambda: int("x"))
+    # a completed call, successful or not, doesn't affect the following ones
+    assert single_flight.do("k", lambda: 2) == 2
+    assert single_flight.stats() == {"calls": 3, "coalesced": 0, "in_flight": 0}
@@ -0,0 +1,44 @@
+import importlib
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+parent_package = Path(os.path.dirname(os.path.realpath(__file__))).parent.name
+slide_descriptor = importlib.import_module(f"{parent_package}.slides_manager.slide_descriptor")
+
+
+class _SlidesCache(object):
+
+    @contextmanager
+    def slide(self, path):
+        yield SimpleNamespace(properties={}, dimensions=(4000, 3000), level_count=1,
+                              level_dimensions=[(4000, 3000)], level_downsamples=[1.0])
+
+    @contextmanager
+    def deepzoom(self, path, tile_size, overlap, limit_bounds):
+        levels = 3
+        yield SimpleNamespace(level_count=levels, level_tiles=[(1, 1)] * levels,
+                              level_dimensions=[(tile_size * (i + 1), tile_size) for i in range(levels)])
+
+
+@pytest.fixture
+def slide(tmp_path, monkeypatch):
+    monkeypatch.setattr(slide_descriptor, "get_slides_cache", _SlidesCache)
+    path = tmp_path / "slide.svs"
+    path.write_bytes(b"slide")
+    return str(path)
+
+
+def test_deepzoom_geometry(slide):
+    descriptors = slide_descriptor.SlideDescriptors(16)
+    descriptor = descriptors.get_descriptor(slide)
+    geometry = descriptors.get_deepzoom_geometry(slide, 256, 1, True)
+    assert (geometry["width"], geometry["height"], geometry["level_count"]) == (768, 256, 3)
+    assert descriptors.get_deepzoom_geometry(slide, 512, 1, True)["width"] == 1536
+    # published descriptors are replaced, not modified
+    assert descriptor["deepzoom"] == {}
+    assert set(descriptors.get_descriptor(slide)["deepzoom"]) == {"256|1|True", "512|1|True"}
+    assert descriptors.get_deepzoom_geometry(slide, 256, 1, True) is geometry
@@ -0,0 +1,122 @@
+import importlib
+import os
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+parent_package = Path(os.path.dirname(os.path.realpath(__file__))).parent.name
+slides_cache = importlib.import_module(f"{parent_package}.slides_manager.slides_cache")
+
+
+class _Slide(object):
+    opened = []
+    # opens of the slides listed in slow_paths wait for release_opens
+    slow_paths = set()
+    release_opens = threading.Event()
+
+    def __init__(self, path):
+        _Slide.opened.append(self)
+        if path in _Slide.slow_paths:
+            _Slide.release_opens.wait(5)
+        self.path = path
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class _DeepZoomGenerator(object):
+
+    def __init__(self, slide, tile_size, overlap, limit_bounds):
+        self.slide = slide
+
+
+@pytest.fixture(autouse=True)
+def fake_openslide(monkeypatch):
+    _Slide.opened = []
+    _Slide.slow_paths = set()
+    _Slide.release_opens.clear()
+    monkeypatch.setattr(slides_cache, "OpenSlide", _Slide)
+    monkeypatch.setattr(slides_cache, "DeepZoomGenerator", _DeepZoomGenerator)
+
+
+@pytest.fixture
+def slides(tmp_path):
+    paths = []
+    for i in range(3):
+        path = tmp_path / ("slide_%d.svs" % i)
+        path.write_bytes(b"slide")
+        paths.append(os.path.realpath(path))
+    return paths
+
+
+def test_handles_are_reused(slides):
+    cache = slides_cache.SlidesCache(2)
+    with cache.slide(slides[0]) as slide:
+        pass
+    with cache.deepzoom(slides[0], 256, 1, True) as dzg:
+        assert dzg.slide is slide
+    with cache.deepzoom(slides[0], 256, 1, True) as other_dzg:
+        assert other_dzg is dzg
+    stats = cache.stats()
+    assert (stats["opens"], stats["deepzoom_builds"], stats["deepzoom_hits"]) == (1, 1, 1)
+
+
+def test_concurrent_opens(slides):
+    cache = slides_cache.SlidesCache(2)
+    _Slide.slow_paths.add(slides[0])
+    results = []
+
+    def read():
+        with cache.slide(slides[0]) as slide:
+            results.append(slide)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for r in readers:
+        r.start()
+    # wait for the readers to queue behind the first open
+    deadline = time.time() + 5
+    while cache._opens.stats()["coalesced"] < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    _Slide.release_opens.set()
+    for r in readers:
+        r.join(5)
+    assert len(_Slide.opened) == 1
+    assert results == _Slide.opened * 4
+
+
+def test_evicted_handles_are_closed(slides):
+    cache = slides_cache.SlidesCache(1)
+    with cache.slide(slides[0]) as first:
+        with cache.slide(slides[1]) as second:
+            # the first slide is still being read
+            assert not first.closed
+        assert not second.closed
+    assert first.closed
+    with cache.slide(slides[2]):
+        pass
+    assert second.closed
+    assert cache.stats()["closed"] == 2
+    cache.clear()
+    assert all(s.closed for s in _Slide.opened)
+
+
+def test_replaced_slides_are_closed(slides):
+    cache = slides_cache.SlidesCache(2)
+    with cache.slide(slides[0]) as old:
+        pass
+    os.utime(slides[0], (0, 0))
+    with cache.slide(slides[0]) as new:
+        assert new is not old
+    assert old.closed and not new.closed
+
+
+def test_disabled_cache(slides):
+    cache = slides_cache.SlidesCache(0)
+    with cache.slide(slides[0]) as first:
+        pass
+    with cache.slide(slides[0]) as second:
+        assert second is not first
+    assert first.closed and second.closed
@@ -0,0 +1,59 @@
+import importlib
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+parent_package = Path(os.path.dirname(os.path.realpath(__file__))).parent.name
+disk_cache = importlib.import_module(f"{parent_package}.images_cache.disk_cache")
+tiered_cache = importlib.import_module(f"{parent_package}.images_cache.tiered_cache")
+settings = importlib.import_module(f"{parent_package}.settings")
+
+
+class _Clock(object):
+
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def make_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "IMAGES_CACHE_STALE_TIME", 50, raising=False)
+    monkeypatch.setattr(settings, "IMAGES_CACHE_GENERATION_TTL", 0, raising=False)
+    monkeypatch.setattr(disk_cache.DiskCache, "_eviction_loop", lambda self: None)
+
+    def make_cache(expire_time, local_ttl=60):
+        remote_cache = disk_cache.DiskCache(str(tmp_path), 10 ** 6, expire_time)
+        return remote_cache, tiered_cache.TieredCache(remote_cache, 10 ** 6, local_ttl)
+
+    return make_cache
+
+
+def test_local_ttl_is_capped_by_expire_time(make_cache):
+    assert make_cache({"seconds": 100})[1].local_cache.ttl == 10
+    assert make_cache({"hours": 1})[1].local_cache.ttl == 60
+    assert make_cache(None)[1].local_cache.ttl == 60
+
+
+def test_promoted_entries_dont_outlive_the_remote_ones(make_cache, clock):
+    remote_cache, cache = make_cache({"seconds": 100})
+    remote_cache._set("TILE::1", b"tile")
+    clock.now += 95
+    assert cache._get_with_staleness("TILE::1") == (b"tile", False)
+    clock.now += 5
+    # served by L1
+    assert cache._get_with_staleness("TILE::1") == (b"tile", False)
+    clock.now += 6
+    # expired in L2 and dropped by L1
+    assert cache._get_with_staleness("TILE::1") == (b"tile", True)
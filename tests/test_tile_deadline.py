@@ -0,0 +1,73 @@
+import importlib
+import inspect
+import os
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+import django
+
+django.setup()
+
+from django.test import RequestFactory
+
+parent_package = Path(os.path.dirname(os.path.realpath(__file__))).parent.name
+views = importlib.import_module(f"{parent_package}.views")
+settings = importlib.import_module(f"{parent_package}.settings")
+
+get_tile = inspect.unwrap(views.get_tile)
+
+
+class _Engine(object):
+
+    def __init__(self, cached_tile):
+        self.cached_tile = cached_tile
+
+    def get_cached_tile(self, *args):
+        return self.cached_tile, "image/jpeg"
+
+    def get_tile(self, *args):
+        return b"rendered", "image/jpeg"
+
+
+class _EnginesFactory(object):
+    cached_tile = None
+
+    def call_tiles_engine(self, image_id, connection, call, original_file_source=False, file_mimetype=None):
+        return call(_Engine(_EnginesFactory.cached_tile))
+
+
+class _SaturatedRenders(object):
+
+    def __init__(self):
+        self.started = 0
+
+    def start(self, render):
+        self.started += 1
+        return None
+
+
+@pytest.fixture
+def background_renders(monkeypatch):
+    for name, value in (("TILES_RENDER_DEADLINE", 100), ("IMAGES_CACHE_ENABLED", True),
+                        ("TILES_PACKS_FOLDER", None), ("HTTP_CACHE_ENABLED", False),
+                        ("DEEPZOOM_FORMAT", "jpeg"), ("DEEPZOOM_NEGOTIATE_FORMAT", False)):
+        monkeypatch.setattr(settings, name, value, raising=False)
+    monkeypatch.setattr(views, "RenderingEngineFactory", _EnginesFactory)
+    renders = _SaturatedRenders()
+    monkeypatch.setattr(views, "get_background_renders", lambda: renders)
+    return renders
+
+
+def test_cached_tiles_skip_the_deadline_workers(background_renders, monkeypatch):
+    monkeypatch.setattr(_EnginesFactory, "cached_tile", b"cached")
+    response = get_tile(RequestFactory().get("/"), "1", "0", "0", "0", "jpeg", conn=object())
+    assert response.content == b"cached"
+    assert background_renders.started == 0
+
+
+def test_tiles_are_rendered_by_the_request_when_deadline_workers_are_busy(background_renders):
+    response = get_tile(RequestFactory().get("/"), "1", "0", "0", "0", "jpeg", conn=object())
+    assert response.content == b"rendered"
+    assert background_renders.started == 1
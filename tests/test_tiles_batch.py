@@ -0,0 +1,48 @@
+import importlib
+import os
+import struct
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+import django
+
+django.setup()
+
+parent_package = Path(os.path.dirname(os.path.realpath(__file__))).parent.name
+views = importlib.import_module(f"{parent_package}.views")
+
+
+def _unpack_tiles(body):
+    (count,) = struct.unpack_from(">I", body, 0)
+    offset = 4
+    tiles = []
+    for _ in range(count):
+        level, column, row, size = struct.unpack_from(">IIII", body, offset)
+        offset += 16
+        tiles.append(((level, column, row), body[offset:offset + size]))
+        offset += size
+    assert offset == len(body)
+    return tiles
+
+
+def test_parse_tiles_list():
+    assert views._parse_tiles_list("12/3_4, 0/0_0,13/10_7") == [(12, 3, 4), (0, 0, 0), (13, 10, 7)]
+
+
+@pytest.mark.parametrize("tiles", ["", "12/3", "12/3_4,", "12/3_-4", "a/3_4", "12_3_4", "12/3_4/5"])
+def test_parse_invalid_tiles_list(tiles):
+    with pytest.raises(ValueError):
+        views._parse_tiles_list(tiles)
+
+
+def test_pack_round_trip():
+    tiles_list = [(12, 3, 4), (12, 3, 5), (13, 6, 8)]
+    tiles = [b"\xff\xd8first", None, b"\xff\xd8third"]
+    assert _unpack_tiles(views._pack_tiles(tiles_list, tiles)) == [
+        ((12, 3, 4), b"\xff\xd8first"),
+        ((12, 3, 5), b""),
+        ((13, 6, 8), b"\xff\xd8third"),
+    ]
+    assert views._pack_tiles([], []) == struct.pack(">I", 0)
@@ -0,0 +1,124 @@
+import importlib
+import os
+import struct
+from pathlib import Path
+
+import pytest
+
+parent_package = Path(os.path.dirname(os.path.realpath(__file__))).parent.name
+tiles_pack = importlib.import_module(f"{parent_package}.slides_manager.tiles_pack")
+settings = importlib.import_module(f"{parent_package}.settings")
+
+LEVELS = [(1, 1), (2, 1), (3, 2)]
+
+
+@pytest.fixture
+def packs_folder(tmp_path, monkeypatch):
+    folder = tmp_path / "packs"
+    folder.mkdir()
+    for name, value in (("TILES_PACKS_FOLDER", str(folder)), ("DEEPZOOM_TILE_SIZE", 256),
+                        ("DEEPZOOM_OVERLAP", 1), ("DEEPZOOM_LIMIT_BOUNDS", True), ("DEEPZOOM_FORMAT", "jpeg"),
+                        ("DEEPZOOM_JPEG_QUALITY", 90)):
+        monkeypatch.setattr(settings, name, value, raising=False)
+    monkeypatch.setattr(tiles_pack, "_tiles_packs_registry", None)
+    return str(folder)
+
+
+@pytest.fixture
+def slide(tmp_path):
+    path = tmp_path / "slide.svs"
+    path.write_bytes(b"slide")
+    return str(path)
+
+
+def _write_pack(folder, image_id, slide, image_quality=90):
+    path = os.path.join(folder, tiles_pack.get_pack_file_name(image_id, False, 256, True, "jpeg"))
+    with tiles_pack.TilesPackWriter(path, 256, 1, True, "jpeg", image_quality, LEVELS,
+                                    os.path.getmtime(slide)) as writer:
+        # tiles can be added in any order, 2/1_1 is left missing
+        for level, (columns, rows) in reversed(list(enumerate(LEVELS))):
+            for row in range(rows):
+                for column in range(columns):
+                    if (level, column, row) != (2, 1, 1):
+                        writer.add_tile(level, column, row, b"tile %d/%d_%d" % (level, column, row))
+    return path
+
+
+def test_pack_round_trip(packs_folder, slide):
+    _write_pack(packs_folder, 1, slide)
+    for level, (columns, rows) in enumerate(LEVELS):
+        for row in range(rows):
+            for column in range(columns):
+                tile = tiles_pack.get_tile_from_pack(1, False, slide, level, column, row)
+                if (level, column, row) == (2, 1, 1):
+                    assert tile is None
+                else:
+                    assert tile == b"tile %d/%d_%d" % (level, column, row)
+    # out of the pyramid
+    assert tiles_pack.get_tile_from_pack(1, False, slide, 2, 3, 0) is None
+    assert tiles_pack.get_tile_from_pack(1, False, slide, 3, 0, 0) is None
+    # no pack for the image
+    assert tiles_pack.get_tile_from_pack(2, False, slide, 0, 0, 0) is None
+    # packs are built for a specific format
+    assert tiles_pack.get_tile_from_pack(1, False, slide, 0, 0, 0, image_format="png") is None
+
+
+def test_pack_config_mismatch(packs_folder, slide, monkeypatch):
+    _write_pack(packs_folder, 1, slide, image_quality=70)
+    assert tiles_pack.get_tile_from_pack(1, False, slide, 0, 0, 0) is None
+    monkeypatch.setattr(settings, "DEEPZOOM_JPEG_QUALITY", 70)
+    assert tiles_pack.get_tile_from_pack(1, False, slide, 0, 0, 0) == b"tile 0/0_0"
+    monkeypatch.setattr(settings, "DEEPZOOM_OVERLAP", 0)
+    assert tiles_pack.get_tile_from_pack(1, False, slide, 0, 0, 0) is None
+
+
+def test_invalid_pack(packs_folder, slide):
+    with open(os.path.join(packs_folder, tiles_pack.get_pack_file_name(1, False, 256, True, "jpeg")), "wb") as f:
+        f.write(b"not a pack")
+    assert tiles_pack.get_tile_from_pack(1, False, slide, 0, 0, 0) is None
+
+
+def test_replaced_slide(packs_folder, slide):
+    _write_pack(packs_folder, 1, slide)
+    assert tiles_pack.get_tile_from_pack(1, False, slide, 0, 0, 0) == b"tile 0/0_0"
+    # the slide was replaced after the pack was built
+    mtime = os.path.getmtime(slide)
+    os.utime(slide, (mtime + 10, mtime + 10))
+    assert tiles_pack.get_tile_from_pack(1, False, slide, 0, 0, 0) is None
+    os.remove(slide)
+    assert tiles_pack.get_tile_from_pack(1, False, slide, 0, 0, 0) is None
+
+
+def _pack_head(metadata):
+    return struct.pack(">4sHI", b"DZTP", 1, len(metadata)) + metadata
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    # truncated metadata
+    _pack_head(b'{"levels": [[1, 1]]}')[:-4],
+    # metadata that isn't UTF-8
+    _pack_head(b"\xff\xfe\xfd\xfc"),
+    # metadata missing the DeepZoom configuration
+    _pack_head(b'{"levels": [[1, 1]]}'),
+])
+def test_corrupted_pack(packs_folder, slide, data):
+    with open(os.path.join(packs_folder, tiles_pack.get_pack_file_name(1, False, 256, True, "jpeg")), "wb") as f:
+        f.write(data)
+    assert tiles_pack.get_tile_from_pack(1, False, slide, 0, 0, 0) is None
+
+
+def test_truncated_pack(packs_folder, slide):
+    path = _write_pack(packs_folder, 1, slide)
+    with open(path, "r+b") as f:
+        f.truncate(40)
+    assert tiles_pack.get_tile_from_pack(1, False, slide, 0, 0, 0) is None
+
+
+def test_writer_rejects_invalid_address(packs_folder):
+    path = os.path.join(packs_folder, "pack.tpk")
+    with pytest.raises(ValueError):
+        with tiles_pack.TilesPackWriter(path, 256, 1, True, "jpeg", 90, LEVELS) as writer:
+            writer.add_tile(1, 2, 0, b"tile")
+    # an aborted pack is not left behind
+    assert os.listdir(packs_folder) == []
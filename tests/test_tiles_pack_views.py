@@ -0,0 +1,76 @@
+import importlib
+import inspect
+import os
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+import django
+
+django.setup()
+
+from django.test import RequestFactory
+
+parent_package = Path(os.path.dirname(os.path.realpath(__file__))).parent.name
+views = importlib.import_module(f"{parent_package}.views")
+paths_cache = importlib.import_module(f"{parent_package}.slides_manager.paths_cache")
+tiles_pack = importlib.import_module(f"{parent_package}.slides_manager.tiles_pack")
+settings = importlib.import_module(f"{parent_package}.settings")
+
+# the views without the login_required decorator, the connection is passed explicitly
+get_tile = inspect.unwrap(views.get_tile)
+get_tiles_batch = inspect.unwrap(views.get_tiles_batch)
+
+
+class _Image(object):
+
+    def getImportedImageFilePaths(self):
+        return {"server_paths": ["slide.svs"]}
+
+
+class _Connection(object):
+
+    def __init__(self, user_id, readable_images):
+        self.user_id = user_id
+        self.readable_images = readable_images
+
+    def getUserId(self):
+        return self.user_id
+
+    def getObject(self, obj_type, obj_id):
+        return _Image() if int(obj_id) in self.readable_images else None
+
+
+@pytest.fixture
+def packs_folder(tmp_path, monkeypatch):
+    for name, value in (("TILES_PACKS_FOLDER", str(tmp_path)), ("DEEPZOOM_TILE_SIZE", 256),
+                        ("DEEPZOOM_OVERLAP", 1), ("DEEPZOOM_LIMIT_BOUNDS", True), ("DEEPZOOM_FORMAT", "jpeg"),
+                        ("DEEPZOOM_JPEG_QUALITY", 90), ("DEEPZOOM_NEGOTIATE_FORMAT", False),
+                        ("HTTP_CACHE_ENABLED", False), ("PRIMARY_TILES_RENDERING_ENGINE", "openslide"),
+                        ("IMGS_REPOSITORY", str(tmp_path)), ("IMGS_FOLDER", "")):
+        monkeypatch.setattr(settings, name, value, raising=False)
+    monkeypatch.setattr(tiles_pack, "_tiles_packs_registry", None)
+    monkeypatch.setattr(paths_cache, "_paths_cache", paths_cache.PathsCache(16))
+    slide = tmp_path / "slide.svs"
+    slide.write_bytes(b"slide")
+    path = os.path.join(tmp_path, tiles_pack.get_pack_file_name(1, False, 256, True, "jpeg"))
+    with tiles_pack.TilesPackWriter(path, 256, 1, True, "jpeg", 90, [(1, 1)], os.path.getmtime(slide)) as writer:
+        writer.add_tile(0, 0, 0, b"tile 0/0_0")
+    return tmp_path
+
+
+def test_pack_served_to_authorized_user(packs_folder):
+    response = get_tile(RequestFactory().get("/"), "1", "0", "0", "0", "jpeg", conn=_Connection(1, {1}))
+    assert response.status_code == 200
+    assert response.content == b"tile 0/0_0"
+
+
+def test_pack_not_served_to_unauthorized_user(packs_folder):
+    # the path resolved for an authorized user is not reused for other users
+    get_tile(RequestFactory().get("/"), "1", "0", "0", "0", "jpeg", conn=_Connection(1, {1}))
+    conn = _Connection(2, set())
+    response = get_tile(RequestFactory().get("/"), "1", "0", "0", "0", "jpeg", conn=conn)
+    assert response.status_code == 404
+    response = get_tiles_batch(RequestFactory().get("/", {"tiles": "0/0_0"}), "1", "jpeg", conn=conn)
+    assert response.status_code == 404
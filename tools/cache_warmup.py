@@ -0,0 +1,249 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from requests import Session
+from concurrent.futures import ThreadPoolExecutor
+import xml.etree.ElementTree as ET
+import threading
+import json
+import math
+import time
+import sys
+import os
+from urllib.parse import urljoin
+import logging
+from argparse import ArgumentParser
+
+
+class RequestsThrottle(object):
+
+    def __init__(self, max_requests_per_second):
+        self.min_interval = 1.0 / max_requests_per_second if max_requests_per_second else 0
+        self.next_request = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.min_interval:
+            return
+        with self.lock:
+            now = time.time()
+            wait_time = self.next_request - now
+            self.next_request = max(now, self.next_request) + self.min_interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class CacheWarmer(object):
+
+    def __init__(self, ome_base_url, max_level, thumbnail_size, tiles_format, batch_size, workers,
+                 max_requests_per_second, state_file=None, log_level='INFO', log_file=None):
+        self.logger = self.get_logger(log_level, log_file)
+        self.ome_base_url = ome_base_url
+        self.max_level = max_level
+        self.thumbnail_size = thumbnail_size
+        self.tiles_format = tiles_format
+        self.batch_size = batch_size
+        self.workers = workers
+        self.throttle = RequestsThrottle(max_requests_per_second)
+        self.state_file = state_file
+        self.state_lock = threading.Lock()
+        self.session = Session()
+        self.completed = 0
+        self.failed = 0
+
+    def get_logger(self, log_level='INFO', log_file=None, mode='a'):
+        LOG_FORMAT = '%(asctime)s|%(levelname)-8s|%(message)s'
+        LOG_DATEFMT = '%Y-%m-%d %H:%M:%S'
+
+        logger = logging.getLogger('cache_warmup')
+        if not isinstance(log_level, int):
+            try:
+                log_level = getattr(logging, log_level)
+            except AttributeError:
+                raise ValueError('Unsupported literal log level: %s' % log_level)
+        logger.setLevel(log_level)
+        logger.handlers = []
+        if log_file:
+            handler = logging.FileHandler(log_file, mode=mode)
+        else:
+            handler = logging.StreamHandler()
+        formatter = logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT)
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+        return logger
+
+    def _get(self, url, params=None):
+        self.throttle.wait()
+        response = self.session.get(urljoin(self.ome_base_url, url), params=params)
+        response.raise_for_status()
+        return response
+
+    def _get_json(self, url, params=None):
+        return self._get(url, params).json()
+
+    # images are (image ID, MIRAX flag) tuples, MIRAX slides are identified by their name
+    def _get_project_images(self, project_id):
+        project = self._get_json('get/project/%s/' % project_id, {'datasets': 'true', 'images': 'true'})
+        return [(img['id'], False) for ds in project['datasets'] for img in ds['images']]
+
+    def _get_dataset_images(self, dataset_id):
+        dataset = self._get_json('get/dataset/%s/' % dataset_id, {'images': 'true'})
+        return [(img['id'], False) for img in dataset['images']]
+
+    def _get_tag_images(self, tag_id):
+        tag = self._get_json('get/tag/%s/' % tag_id, {'images': 'true'})
+        return [(img['id'], False) for img in tag['images']]
+
+    def _get_mirax_images(self):
+        images = self._get_json('get/images/index/')
+        return [(img['name'], True) for img in images if img['img_type'] == 'MIRAX']
+
+    def get_images(self, projects=(), datasets=(), tags=(), mirax=False):
+        images = []
+        for project_id in projects:
+            images.extend(self._get_project_images(project_id))
+        for dataset_id in datasets:
+            images.extend(self._get_dataset_images(dataset_id))
+        for tag_id in tags:
+            images.extend(self._get_tag_images(tag_id))
+        if mirax:
+            images.extend(self._get_mirax_images())
+        # remove duplicates, keeping the original order
+        return list(dict.fromkeys(images))
+
+    def _get_image_key(self, image_id, mirax_image):
+        return '%s:%s' % ('MIRAX' if mirax_image else 'OMERO', image_id)
+
+    def _load_state(self):
+        if self.state_file and os.path.isfile(self.state_file):
+            with open(self.state_file) as f:
+                return set(l.strip() for l in f if l.strip())
+        return set()
+
+    def _save_state(self, image_key):
+        if self.state_file:
+            with self.state_lock:
+                with open(self.state_file, 'a') as f:
+                    f.write('%s\n' % image_key)
+
+    def _get_image_infos(self, base_url, image_id):
+        dzi = ET.fromstring(self._get('%s%s.dzi' % (base_url, image_id)).text)
+        size = dzi[0]
+        return {
+            'tile_size': int(dzi.get('TileSize')),
+            'width': int(size.get('Width')),
+            'height': int(size.get('Height'))
+        }
+
+    def _get_levels_tiles(self, image_infos):
+        max_zoom_level = int(math.ceil(math.log(max(image_infos['width'], image_infos['height']), 2)))
+        tiles = []
+        for level in range(min(self.max_level, max_zoom_level) + 1):
+            scale_factor = math.pow(0.5, max_zoom_level - level)
+            columns = int(math.ceil(math.ceil(image_infos['width'] * scale_factor) / image_infos['tile_size']))
+            rows = int(math.ceil(math.ceil(image_infos['height'] * scale_factor) / image_infos['tile_size']))
+            tiles.extend('%d/%d_%d' % (level, c, r) for c in range(columns) for r in range(rows))
+        return tiles
+
+    def warm_up_image(self, image_id, mirax_image):
+        base_url = 'mirax/deepzoom/get/' if mirax_image else 'deepzoom/get/'
+        self._get('%sthumbnail/%s.dzi' % (base_url, image_id), {'size': self.thumbnail_size})
+        tiles = self._get_levels_tiles(self._get_image_infos(base_url, image_id))
+        for i in range(0, len(tiles), self.batch_size):
+            self._get('%s%s_files/batch.%s' % (base_url, image_id, self.tiles_format),
+                      {'tiles': ','.join(tiles[i:i + self.batch_size])})
+        return len(tiles)
+
+    def _warm_up(self, image, total, start_time):
+        image_id, mirax_image = image
+        try:
+            tiles_count = self.warm_up_image(image_id, mirax_image)
+        except Exception as e:
+            with self.state_lock:
+                self.failed += 1
+            self.logger.error('Unable to warm up cache for image %s: %s', image_id, e)
+            return
+        self._save_state(self._get_image_key(image_id, mirax_image))
+        with self.state_lock:
+            self.completed += 1
+            done = self.completed + self.failed
+        elapsed = time.time() - start_time
+        self.logger.info('Image %s done (%d tiles) -- %d/%d images, elapsed %ds, ETA %ds', image_id, tiles_count,
+                         done, total, elapsed, elapsed / done * (total - done))
+
+    def run(self, projects=(), datasets=(), tags=(), mirax=False):
+        self.logger.info('Collecting images')
+        images = self.get_images(projects, datasets, tags, mirax)
+        completed_images = self._load_state()
+        images_count = len(images)
+        images = [i for i in images if self._get_image_key(*i) not in completed_images]
+        self.logger.info('%d images to process (%d skipped as already completed)', len(images),
+                         images_count - len(images))
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for image in images:
+                executor.submit(self._warm_up, image, len(images), start_time)
+        self.logger.info('Cache warm up completed: %d images processed, %d failed', self.completed, self.failed)
+
+
+def get_parser():
+    parser = ArgumentParser('Pre-render thumbnails and low resolution DeepZoom levels into the images cache')
+    parser.add_argument('--ome-base-url', type=str, required=True,
+                        help='the base URL of the OMERO.web server')
+    parser.add_argument('--project', type=int, action='append', default=[],
+                        help='ID of a project whose images will be processed, can be used more than once')
+    parser.add_argument('--dataset', type=int, action='append', default=[],
+                        help='ID of a dataset whose images will be processed, can be used more than once')
+    parser.add_argument('--tag', type=int, action='append', default=[],
+                        help='ID of a tag whose images will be processed, can be used more than once')
+    parser.add_argument('--mirax', action='store_true',
+                        help='process all the registered MIRAX slides')
+    parser.add_argument('--max-level', type=int, default=10,
+                        help='highest DeepZoom level that will be rendered (default 10)')
+    parser.add_argument('--thumbnail-size', type=int, default=256,
+                        help='size of the thumbnails (default 256)')
+    parser.add_argument('--tiles-format', type=str, default='jpeg',
+                        help='format of the tiles (default jpeg)')
+    parser.add_argument('--batch-size', type=int, default=64,
+                        help='number of tiles requested with a single call, must not exceed the max_tiles '
+                             'setting of the server (default 64)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of images processed at the same time (default 4)')
+    parser.add_argument('--max-rps', type=float, default=0,
+                        help='maximum number of requests per second sent to the server (default no limit)')
+    parser.add_argument('--state-file', type=str, default=None,
+                        help='file used to record completed images, images already listed there are skipped')
+    parser.add_argument('--log-level', type=str, default='INFO',
+                        help='log level (default=INFO)')
+    parser.add_argument('--log-file', type=str, default=None,
+                        help='log file (default=stderr)')
+    return parser
+
+
+def main(argv):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if not (args.project or args.dataset or args.tag or args.mirax):
+        parser.error('at least one of --project, --dataset, --tag or --mirax is required')
+    warmer = CacheWarmer(args.ome_base_url, args.max_level, args.thumbnail_size, args.tiles_format,
+                         args.batch_size, args.workers, args.max_rps, args.state_file, args.log_level, args.log_file)
+    warmer.run(args.project, args.dataset, args.tag, args.mirax)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
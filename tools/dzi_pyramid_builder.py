@@ -0,0 +1,211 @@
+#  Copyright (c) 2019, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from multiprocessing import Pool
+from openslide import OpenSlide
+from openslide.deepzoom import DeepZoomGenerator
+from urllib.parse import urljoin
+from argparse import ArgumentParser
+import requests
+import logging
+import sys
+import os
+
+from ome_seadragon import settings
+from ome_seadragon.slides_manager.image_formats import encode_image, normalize_format
+from ome_seadragon.slides_manager.tiles_pack import TilesPackWriter, get_pack_file_name
+
+
+_dzi_slide = None
+
+_QUALITY_SETTINGS = {
+    'jpeg': 'DEEPZOOM_JPEG_QUALITY',
+    'webp': 'DEEPZOOM_WEBP_QUALITY',
+    'avif': 'DEEPZOOM_AVIF_QUALITY'
+}
+
+
+def get_server_image_quality(image_format):
+    # settings are loaded only within OMERO.web, when they are not the defaults of the server are used
+    setting = _QUALITY_SETTINGS.get(normalize_format(image_format))
+    if setting is None:
+        return None
+    try:
+        return getattr(settings, setting)
+    except AttributeError:
+        for name, default, _, _ in settings.CUSTOM_SETTINGS_MAPPINGS.values():
+            if name == setting:
+                return default
+
+
+def _init_worker(slide_path, deepzoom_config):
+    # each worker opens the slide only once
+    global _dzi_slide
+    _dzi_slide = DeepZoomGenerator(OpenSlide(slide_path), **deepzoom_config)
+
+
+def _render_tile(tile_conf):
+    level, column, row, image_format, image_quality, png_compress_level = tile_conf
+    tile = encode_image(_dzi_slide.get_tile(level, (column, row)), image_format, image_quality, png_compress_level)
+    return level, column, row, tile
+
+
+class DZIPyramidBuilder(object):
+
+    def __init__(self, image_id, mirax_image, ome_base_url, output_folder, slide_path=None,
+                 tile_size=256, overlap=1, limit_bounds=True, image_format='jpeg', image_quality=None,
+                 png_compress_level=6, max_level=None, processes=None, log_level='INFO', log_file=None):
+        self.logger = self.get_logger(log_level, log_file)
+        self.image_id = image_id
+        self.mirax_image = mirax_image
+        self.ome_base_url = ome_base_url
+        self.output_folder = output_folder
+        self.slide_path = slide_path
+        # must match the DeepZoom configuration of the OMERO.web server, see OpenSlideEngine._get_deepzoom_config
+        self.deepzoom_config = {
+            'tile_size': tile_size,
+            'overlap': overlap,
+            'limit_bounds': limit_bounds
+        }
+        self.image_format = normalize_format(image_format)
+        # packs are served only if built with the quality used by the server for their format
+        server_image_quality = get_server_image_quality(self.image_format)
+        if image_quality is None or server_image_quality is None:
+            self.image_quality = server_image_quality
+        else:
+            self.image_quality = image_quality
+            if image_quality != server_image_quality:
+                self.logger.warning('Quality %d differs from the %s quality of the server (%d), the pack won\'t '
+                                    'be served unless the server uses the same one',
+                                    image_quality, self.image_format, server_image_quality)
+        self.png_compress_level = png_compress_level
+        self.max_level = max_level
+        self.processes = processes
+
+    def get_logger(self, log_level='INFO', log_file=None, mode='a'):
+        LOG_FORMAT = '%(asctime)s|%(levelname)-8s|%(message)s'
+        LOG_DATEFMT = '%Y-%m-%d %H:%M:%S'
+
+        logger = logging.getLogger('dzi_pyramid_builder')
+        if not isinstance(log_level, int):
+            try:
+                log_level = getattr(logging, log_level)
+            except AttributeError:
+                raise ValueError('Unsupported literal log level: %s' % log_level)
+        logger.setLevel(log_level)
+        logger.handlers = []
+        if log_file:
+            handler = logging.FileHandler(log_file, mode=mode)
+        else:
+            handler = logging.StreamHandler()
+        formatter = logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT)
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+        return logger
+
+    def _get_slide_path(self):
+        if self.slide_path:
+            return self.slide_path
+        if self.mirax_image:
+            response = requests.get(urljoin(self.ome_base_url, 'file/info/%s/' % self.image_id),
+                                    params={'mimetype': 'mirax/index'})
+            response.raise_for_status()
+            return response.json()['file_path']
+        else:
+            response = requests.get(urljoin(self.ome_base_url, 'test/repository/%s/' % self.image_id))
+            response.raise_for_status()
+            return response.text
+
+    def _get_tiles_list(self, levels):
+        for level, (columns, rows) in enumerate(levels):
+            for row in range(rows):
+                for column in range(columns):
+                    yield level, column, row, self.image_format, self.image_quality, self.png_compress_level
+
+    def run(self):
+        slide_path = self._get_slide_path()
+        self.logger.info('Building DZI pyramid for slide %s', slide_path)
+        levels = DeepZoomGenerator(OpenSlide(slide_path), **self.deepzoom_config).level_tiles
+        if self.max_level is not None:
+            levels_to_render = levels[:self.max_level + 1]
+        else:
+            levels_to_render = levels
+        tiles_count = sum(c * r for c, r in levels_to_render)
+        self.logger.info('%d levels, %d tiles will be rendered', len(levels_to_render), tiles_count)
+        pack_path = os.path.join(
+            self.output_folder,
+            get_pack_file_name(self.image_id, self.mirax_image, self.deepzoom_config['tile_size'],
+                               self.deepzoom_config['limit_bounds'], self.image_format)
+        )
+        with TilesPackWriter(pack_path, self.deepzoom_config['tile_size'], self.deepzoom_config['overlap'],
+                             self.deepzoom_config['limit_bounds'], self.image_format, self.image_quality,
+                             levels, os.path.getmtime(slide_path)) as pack_writer:
+            with Pool(self.processes, _init_worker, (slide_path, self.deepzoom_config)) as pool:
+                for i, (level, column, row, tile) in enumerate(
+                        pool.imap_unordered(_render_tile, self._get_tiles_list(levels_to_render), chunksize=32)):
+                    pack_writer.add_tile(level, column, row, tile)
+                    if (i + 1) % 1000 == 0:
+                        self.logger.info('%d/%d tiles rendered', i + 1, tiles_count)
+        self.logger.info('Tiles pack saved to %s', pack_path)
+
+
+def get_parser():
+    parser = ArgumentParser('Pre-render the DZI pyramid of a slide in a tiles pack served by ome_seadragon')
+    parser.add_argument('--image-id', type=str, required=True,
+                        help='the ID of the image, or the label of the slide if --mirax is used')
+    parser.add_argument('--mirax', action='store_true',
+                        help='Add this flag to render a MIRAX file')
+    parser.add_argument('--ome-base-url', type=str, default=None,
+                        help='the base URL of the OMERO.web server, used to resolve the slide path')
+    parser.add_argument('--slide-path', type=str, default=None,
+                        help='the path of the slide, if given it won\'t be resolved using OMERO.web')
+    parser.add_argument('--output-dir', type=str, required=True,
+                        help='output folder (the omero.web.ome_seadragon.deepzoom.tiles_packs_folder of the server)')
+    parser.add_argument('--tile-size', type=int, default=256, help='tile size (default=256)')
+    parser.add_argument('--overlap', type=int, default=1, help='tiles overlap (default=1)')
+    parser.add_argument('--no-limit-bounds', action='store_true',
+                        help='render the whole slide, not only the non-empty region')
+    parser.add_argument('--format', type=str, default='jpeg', help='tiles format (default=jpeg)')
+    parser.add_argument('--quality', type=int, default=None,
+                        help='JPEG, WebP and AVIF tiles quality (default=the server quality for the format)')
+    parser.add_argument('--png-compress-level', type=int, default=6, help='PNG tiles compression level (default=6)')
+    parser.add_argument('--max-level', type=int, default=None,
+                        help='render only the DZI levels up to this one (default=all levels)')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of rendering processes (default=number of CPUs)')
+    parser.add_argument('--log-level', type=str, default='INFO',
+                        help='log level (default=INFO)')
+    parser.add_argument('--log-file', type=str, default=None,
+                        help='log file (default=stderr)')
+    return parser
+
+
+def main(argv):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if not (args.slide_path or args.ome_base_url):
+        parser.error('one of --slide-path and --ome-base-url is required')
+    builder = DZIPyramidBuilder(args.image_id, args.mirax, args.ome_base_url, args.output_dir,
+                                args.slide_path, args.tile_size, args.overlap, not args.no_limit_bounds,
+                                args.format, args.quality, args.png_compress_level, args.max_level, args.processes,
+                                args.log_level, args.log_file)
+    builder.run()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -29,6 +29,8 @@ urlpatterns = [
     url(r'test/repository/$', views.check_repository, name='ome_seadragon_test_repository'),
     url(r'test/repository/(?P<image_id>[0-9]+)/$', views.check_image_path,
         name='ome_seadragon_test_image_path'),
+    # METRICS
+    url(r'^metrics/$', views.get_metrics, name='ome_seadragon_metrics'),
     # EXAMPLES
     url(r'^examples/viewer/(?P<image_id>[\w\-.]+)/$', views.get_example_viewer,
         name='ome_seadragon_test_viewer'),
@@ -87,9 +89,13 @@ urlpatterns = [
         name='ome_seadragon_image_json_metadata_full'),
     url(r'^deepzoom/get/thumbnail/(?P<image_id>[0-9]+).dzi$', views.get_image_thumbnail,
         name='ome_seadragon_image_thumbnail'),
+    url(r'^deepzoom/get/thumbnails/batch$', views.get_image_thumbnails_batch,
+        name='ome_seadragon_image_thumbnails_batch'),
     url(r'^deepzoom/get/(?P<image_id>[0-9]+)_files/(?P<level>[0-9]+)/'
         r'(?P<column>[0-9]+)_(?P<row>[0-9]+).(?P<tile_format>[\w]+)$',
         views.get_tile, name='ome_seadragon_get_tile'),
+    url(r'^deepzoom/get/(?P<image_id>[0-9]+)_files/batch.(?P<tile_format>[\w]+)$',
+        views.get_tiles_batch, name='ome_seadragon_get_tiles_batch'),
     url(r'^deepzoom/image_mpp/(?P<image_id>[0-9]+).dzi$', views.get_image_mpp,
         name='ome_seadragon_get_image_mpp'),
     url(r'^deepzoom/slide_bounds/(?P<image_id>[0-9]+).dzi$', views.get_slide_bounds,
@@ -123,6 +129,9 @@ urlpatterns = [
         r'(?P<column>[0-9]+)_(?P<row>[0-9]+).(?P<tile_format>[\w]+)$',
         views.get_tile, name='ome_seadragon_get_tile_mrxs',
         kwargs={'fetch_original_file': True, 'file_mimetype': 'mirax/index'}),
+    url(r'^mirax/deepzoom/get/(?P<image_id>[\w\-.]+)_files/batch.(?P<tile_format>[\w]+)$',
+        views.get_tiles_batch, name='ome_seadragon_get_tiles_batch_mrxs',
+        kwargs={'fetch_original_file': True, 'file_mimetype': 'mirax/index'}),
     url(r'^mirax/deepzoom/image_mpp/(?P<image_id>[\w\-.]+).dzi$', views.get_image_mpp,
         name='ome_seadragon_get_image_mpp_mrxs',
         kwargs={'fetch_original_file': True, 'file_mimetype': 'mirax/index'}),
@@ -20,6 +20,9 @@
 import logging
 import math
 import os
+import re
+import struct
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from distutils.util import strtobool
 
 from . import settings
@@ -28,12 +31,23 @@ from .dzi_adapter.errors import InvalidAttribute, InvalidColorPalette
 from .dzi_adapter.shapes import DBScanClusterizer
 from .dzi_adapter.shapes import get_dataset as get_ds
 from .dzi_adapter.shapes import get_shape_converter, shapes_to_json
+from .http_caching import (add_cache_headers, get_file_validators, get_image_validators,
+                           get_not_modified_response)
+from .images_cache import invalidate_cached_images
+from .metrics import count_array_request, export_metrics, is_metrics_enabled
 from .ome_data import (datasets_files, mirax_files, original_files,
                        projects_datasets, tags_data)
 from .ome_data.mirax_files import InvalidMiraxFile, InvalidMiraxFolder
 from .ome_data.original_files import (DuplicatedEntryError, get_original_file,
                                       get_original_file_by_id)
+from .server_timing import bind_timings, get_current_timings, session_checked, timed_stage, timed_view
 from .slides_manager import RenderingEngineFactory
+from .slides_manager.background_renders import get_background_renders
+from .slides_manager.image_formats import (UnsupportedImageFormat, get_content_type, get_image_format,
+                                           get_image_quality)
+from .slides_manager.ome_engine import get_thumbnails_set
+from .slides_manager.paths_cache import get_image_path, invalidate_image_paths
+from .slides_manager.tiles_pack import get_tile_from_pack
 
 try:
     import simplejson as json
@@ -43,15 +57,28 @@ except ImportError:
 from django.http import (HttpResponse, HttpResponseBadRequest,
                          HttpResponseNotFound, HttpResponseServerError)
 from django.shortcuts import render
+from omeroweb.decorators import ConnCleaningHttpResponse
 from omeroweb.webclient.decorators import login_required
 
 logger = logging.getLogger(__name__)
 
 
+def _timed_login_required(**kwargs):
+    # the time spent by login_required checking the OMERO session is reported as the 'session' stage
+    return lambda view: timed_view(login_required(**kwargs)(session_checked(view)))
+
+
 def check_app(request):
     return HttpResponse("ome_seadragon working!")
 
 
+def get_metrics(request):
+    if not is_metrics_enabled():
+        return HttpResponseNotFound('Metrics are not enabled')
+    metrics, content_type = export_metrics()
+    return HttpResponse(metrics, content_type=content_type)
+
+
 def check_repository(request):
     if settings.IMGS_REPOSITORY:
         return HttpResponse(settings.IMGS_REPOSITORY)
@@ -72,7 +99,7 @@ def start_connection(request, conn=None, **kwargs):
 
 @login_required()
 def check_image_path(request, image_id, conn=None, **kwargs):
-    rendering_engine = RenderingEngineFactory().get_tiles_rendering_engine(image_id, conn)
+    rendering_engine = RenderingEngineFactory().get_primary_tiles_rendering_engine(image_id, conn)
     return HttpResponse(rendering_engine._get_image_path())
 
 
@@ -277,7 +304,18 @@ def find_annotations(request, conn=None, **kwargs):
     return HttpResponse(json.dumps(annotations), content_type='application/json')
 
 
-@login_required()
+# values that affect DeepZoom descriptors and tiles, used to compute their validators
+def _get_deepzoom_params(tile_size=None, limit_bounds=None):
+    return (
+        settings.PRIMARY_TILES_RENDERING_ENGINE,
+        tile_size if tile_size is not None else settings.DEEPZOOM_TILE_SIZE,
+        limit_bounds if limit_bounds is not None else settings.DEEPZOOM_LIMIT_BOUNDS,
+        settings.DEEPZOOM_OVERLAP,
+        settings.DEEPZOOM_FORMAT
+    )
+
+
+@_timed_login_required()
 def get_image_dzi(request, image_id, fetch_original_file=False, file_mimetype=None, conn=None, **kwargs):
     try:
         tile_size = int(request.GET.get('tile_size'))
@@ -287,98 +325,183 @@ def get_image_dzi(request, image_id, fetch_original_file=False, file_mimetype=No
         limit_bounds = bool(strtobool(request.GET.get('limit_bounds')))
     except AttributeError:
         limit_bounds = None
-    rf = RenderingEngineFactory()
-    rendering_engine = rf.get_primary_tiles_rendering_engine(image_id, conn)
-    try:
-        dzi_metadata = rendering_engine.get_dzi_description(fetch_original_file, file_mimetype,
-                                                            tile_size, limit_bounds)
-    except Exception as e:
-        rendering_engine = rf.get_secondary_tiles_rendering_engine(image_id, conn)
-        if rendering_engine:
-            dzi_metadata = rendering_engine.get_dzi_description(fetch_original_file, file_mimetype,
-                                                                tile_size, limit_bounds)
-        else:
-            raise e
+    validators = get_image_validators(conn, image_id, fetch_original_file, file_mimetype,
+                                      'dzi', *_get_deepzoom_params(tile_size, limit_bounds))
+    not_modified = get_not_modified_response(request, validators, settings.HTTP_CACHE_DESCRIPTORS_MAX_AGE)
+    if not_modified is not None:
+        return not_modified
+    dzi_metadata = RenderingEngineFactory().call_tiles_engine(
+        image_id, conn,
+        lambda engine: engine.get_dzi_description(fetch_original_file, file_mimetype, tile_size, limit_bounds),
+        fetch_original_file, file_mimetype
+    )
     if dzi_metadata:
-        return HttpResponse(dzi_metadata, content_type='application/xml')
+        return add_cache_headers(HttpResponse(dzi_metadata, content_type='application/xml'),
+                                 validators, settings.HTTP_CACHE_DESCRIPTORS_MAX_AGE)
     else:
         return HttpResponseNotFound('No image with ID %s' % image_id)
 
 
-@login_required()
+@_timed_login_required()
 def get_image_json(request, image_id, fetch_original_file=False, file_mimetype=None, conn=None, **kwargs):
     try:
         tile_size = int(request.GET.get('tile_size'))
     except TypeError:
         tile_size = None
-    rf = RenderingEngineFactory()
-    rendering_engine = rf.get_primary_tiles_rendering_engine(image_id, conn)
     resource_path = request.build_absolute_uri('%s_files/' % image_id)
-    try:
-        json_metadata = rendering_engine.get_json_description(resource_path, fetch_original_file,
-                                                              file_mimetype, tile_size)
-    except Exception as e:
-        rendering_engine = rf.get_secondary_tiles_rendering_engine(image_id, conn)
-        if rendering_engine:
-            json_metadata = rendering_engine.get_json_description(resource_path, fetch_original_file,
-                                                                  file_mimetype, tile_size)
-        else:
-            raise e
+    validators = get_image_validators(conn, image_id, fetch_original_file, file_mimetype,
+                                      'json', resource_path, *_get_deepzoom_params(tile_size))
+    not_modified = get_not_modified_response(request, validators, settings.HTTP_CACHE_DESCRIPTORS_MAX_AGE)
+    if not_modified is not None:
+        return not_modified
+    json_metadata = RenderingEngineFactory().call_tiles_engine(
+        image_id, conn,
+        lambda engine: engine.get_json_description(resource_path, fetch_original_file, file_mimetype, tile_size),
+        fetch_original_file, file_mimetype
+    )
     if json_metadata:
-        return HttpResponse(json.dumps(json_metadata), content_type='application/json')
+        return add_cache_headers(HttpResponse(json.dumps(json_metadata), content_type='application/json'),
+                                 validators, settings.HTTP_CACHE_DESCRIPTORS_MAX_AGE)
     else:
         return HttpResponseNotFound('No image with ID %s' % image_id)
 
 
-@login_required()
+@_timed_login_required()
 def get_image_metadata(request, image_id, fetch_original_file=False, file_mimetype=None, conn=None, **kwargs):
     try:
         tile_size = int(request.GET.get('tile_size'))
     except TypeError:
         tile_size = None
-    rf = RenderingEngineFactory()
-    rendering_engine = rf.get_primary_tiles_rendering_engine(image_id, conn)
     resource_path = request.build_absolute_uri('%s_files/' % image_id)
-    try:
-        img_metadata = rendering_engine.get_image_description(resource_path, fetch_original_file,
-                                                              file_mimetype, tile_size)
-    except Exception as e:
-        rendering_engine = rf.get_secondary_tiles_rendering_engine(image_id, conn)
-        if rendering_engine:
-            img_metadata = rendering_engine.get_image_description(resource_path, fetch_original_file,
-                                                                  file_mimetype, tile_size)
-        else:
-            raise e
+    validators = get_image_validators(conn, image_id, fetch_original_file, file_mimetype,
+                                      'metadata', resource_path, *_get_deepzoom_params(tile_size))
+    not_modified = get_not_modified_response(request, validators, settings.HTTP_CACHE_DESCRIPTORS_MAX_AGE)
+    if not_modified is not None:
+        return not_modified
+    img_metadata = RenderingEngineFactory().call_tiles_engine(
+        image_id, conn,
+        lambda engine: engine.get_image_description(resource_path, fetch_original_file, file_mimetype, tile_size),
+        fetch_original_file, file_mimetype
+    )
     if img_metadata:
-        return HttpResponse(json.dumps(img_metadata), content_type='application/json')
+        return add_cache_headers(HttpResponse(json.dumps(img_metadata), content_type='application/json'),
+                                 validators, settings.HTTP_CACHE_DESCRIPTORS_MAX_AGE)
     else:
         return HttpResponseNotFound('No image with ID %s' % image_id)
 
 
-@login_required()
+def _vary_on_accept(response):
+    # when format negotiation is enabled the same URL can be served with different image formats
+    if settings.DEEPZOOM_NEGOTIATE_FORMAT:
+        response['Vary'] = 'Accept'
+    return response
+
+
+@_timed_login_required()
 def get_image_thumbnail(request, image_id, fetch_original_file=False,
                         file_mimetype=None, conn=None, **kwargs):
-    rf = RenderingEngineFactory()
-    rendering_engine = rf.get_primary_thumbnails_rendering_engine(image_id, conn)
     try:
-        thumbnail, image_format = rendering_engine.get_thumbnail(int(request.GET.get('size')),
-                                                                 fetch_original_file, file_mimetype)
-    except Exception as e:
-        rendering_engine = rf.get_secondary_thumbnails_rendering_engine(image_id, conn)
-        if rendering_engine:
-            thumbnail, image_format = rendering_engine.get_thumbnail(int(request.GET.get('size')),
-                                                                     fetch_original_file, file_mimetype)
-        else:
-            raise e
+        image_format = get_image_format(request.GET.get('format'), request.META.get('HTTP_ACCEPT'))
+    except UnsupportedImageFormat as uif:
+        return HttpResponseBadRequest('{0}'.format(uif))
+    validators = get_image_validators(conn, image_id, fetch_original_file, file_mimetype,
+                                      'thumbnail', settings.PRIMARY_THUMBNAILS_RENDERING_ENGINE,
+                                      request.GET.get('size'), image_format, get_image_quality(image_format))
+    not_modified = get_not_modified_response(request, validators, settings.HTTP_CACHE_THUMBNAILS_MAX_AGE)
+    if not_modified is not None:
+        return _vary_on_accept(not_modified)
+    thumbnail, content_type = RenderingEngineFactory().call_thumbnails_engine(
+        image_id, conn,
+        lambda engine: engine.get_thumbnail(int(request.GET.get('size')), fetch_original_file, file_mimetype,
+                                            image_format),
+        fetch_original_file, file_mimetype
+    )
     if thumbnail:
-        response = HttpResponse(content_type="image/%s" % image_format)
-        thumbnail.save(response, image_format)
-        return response
+        return add_cache_headers(_vary_on_accept(HttpResponse(thumbnail, content_type=content_type)),
+                                 validators, settings.HTTP_CACHE_THUMBNAILS_MAX_AGE)
     else:
         return HttpResponseServerError('Unable to load thumbnail')
 
 
-@login_required()
+def _pack_thumbnails(image_ids, thumbnails):
+    # the response body starts with the number of thumbnails (unsigned 32 bit int, big endian), followed by
+    # one frame for each image, in the requested order, made of IMAGE_ID (unsigned 64 bit int, big endian),
+    # SIZE (unsigned 32 bit int, big endian) and SIZE bytes of image data; missing thumbnails have SIZE 0
+    frames = [struct.pack('>I', len(image_ids))]
+    for image_id in image_ids:
+        thumbnail = thumbnails.get(image_id) or b''
+        frames.append(struct.pack('>QI', image_id, len(thumbnail)))
+        frames.append(thumbnail)
+    return b''.join(frames)
+
+
+@_timed_login_required()
+def get_image_thumbnails_batch(request, conn=None, **kwargs):
+    try:
+        image_ids = [int(i) for i in request.GET.get('ids', '').split(',')]
+        size = int(request.GET.get('size'))
+    except (ValueError, TypeError):
+        return HttpResponseBadRequest('A comma separated list of image IDs and a size are required')
+    if len(image_ids) > settings.THUMBNAILS_BATCH_MAX_IMAGES:
+        return HttpResponseBadRequest('Too many images requested, max is %d' %
+                                      settings.THUMBNAILS_BATCH_MAX_IMAGES)
+    try:
+        image_format = get_image_format(request.GET.get('format'), request.META.get('HTTP_ACCEPT'))
+    except UnsupportedImageFormat as uif:
+        return HttpResponseBadRequest('{0}'.format(uif))
+    if settings.PRIMARY_THUMBNAILS_RENDERING_ENGINE == 'omero':
+        thumbnails = get_thumbnails_set(conn, image_ids, size, image_format)
+    else:
+        thumbnails = {}
+    # thumbnails that couldn't be retrieved in bulk go through the rendering engines, one by one
+    rf = RenderingEngineFactory()
+    for image_id in image_ids:
+        if image_id in thumbnails:
+            continue
+        try:
+            thumbnails[image_id] = rf.call_thumbnails_engine(
+                image_id, conn, lambda engine: engine.get_thumbnail(size, image_format=image_format)[0]
+            )
+        except Exception as e:
+            logger.error(e)
+    response = HttpResponse(_pack_thumbnails(image_ids, thumbnails), content_type='application/octet-stream')
+    response['X-Thumbnails-Content-Type'] = get_content_type(image_format)
+    return _vary_on_accept(response)
+
+
+def _close_connection(conn):
+    try:
+        conn.close(hard=False)
+    except Exception as e:
+        logger.warning('Failed to close connection: %s', e)
+
+
+def _get_tile_preview_response(preview, content_type, conn, render):
+    # the background render is still using the connection, close it when the render is done
+    # instead of when the request ends
+    render.add_done_callback(lambda r: _close_connection(conn))
+    response = ConnCleaningHttpResponse([preview], content_type=content_type)
+    response.conn = None
+    response['Cache-Control'] = 'no-store'
+    return _vary_on_accept(response)
+
+
+def _get_tiles_from_pack(conn, image_id, fetch_original_file, file_mimetype, tiles_list, tile_size, limit_bounds,
+                         image_format):
+    # tiles packs are read straight from disk, resolving the image through the user's connection first is
+    # what checks that the user can access it; None is returned if the image can't be found
+    if not settings.TILES_PACKS_FOLDER:
+        return [None] * len(tiles_list)
+    image_path = get_image_path(conn, image_id, fetch_original_file, file_mimetype)
+    if image_path is None:
+        return None
+    return [get_tile_from_pack(image_id, fetch_original_file, image_path, level, column, row, tile_size,
+                               limit_bounds, image_format)
+            for level, column, row in tiles_list]
+
+
+# connections are closed by the decorator unless a ConnCleaningHttpResponse is returned
+@_timed_login_required(doConnectionCleanup=False)
 def get_tile(request, image_id, level, column, row, tile_format,
              fetch_original_file=False, file_mimetype=None, conn=None, **kwargs):
     try:
@@ -389,62 +512,172 @@ def get_tile(request, image_id, level, column, row, tile_format,
         limit_bounds = bool(strtobool(request.GET.get('limit_bounds')))
     except AttributeError:
         limit_bounds = None
-    if tile_format != settings.DEEPZOOM_FORMAT:
-        return HttpResponseServerError("Format %s not supported by the server" % tile_format)
-    rf = RenderingEngineFactory()
-    rendering_engine = rf.get_primary_tiles_rendering_engine(image_id, conn)
     try:
-        tile, image_format = rendering_engine.get_tile(int(level), int(column), int(row), fetch_original_file,
-                                                       file_mimetype, tile_size, limit_bounds)
-    except Exception as e:
-        logger.error(e)
-        rendering_engine = rf.get_secondary_tiles_rendering_engine(image_id, conn)
-        if rendering_engine:
-            tile, image_format = rendering_engine.get_tile(int(level), int(column), int(row), fetch_original_file,
-                                                           file_mimetype, tile_size, limit_bounds)
-        else:
-            raise e
+        image_format = get_image_format(tile_format, request.META.get('HTTP_ACCEPT'))
+    except UnsupportedImageFormat as uif:
+        return HttpResponseBadRequest('{0}'.format(uif))
+    validators = get_image_validators(conn, image_id, fetch_original_file, file_mimetype,
+                                      'tile', level, column, row, image_format, get_image_quality(image_format),
+                                      *_get_deepzoom_params(tile_size, limit_bounds))
+    not_modified = get_not_modified_response(request, validators, settings.HTTP_CACHE_TILES_MAX_AGE)
+    if not_modified is not None:
+        return _vary_on_accept(not_modified)
+    packed_tiles = _get_tiles_from_pack(conn, image_id, fetch_original_file, file_mimetype,
+                                        [(int(level), int(column), int(row))], tile_size, limit_bounds, image_format)
+    if packed_tiles is None:
+        return HttpResponseNotFound('No image with ID %s' % image_id)
+    tile = packed_tiles[0]
+    if tile is not None:
+        return add_cache_headers(_vary_on_accept(HttpResponse(tile, content_type=get_content_type(image_format))),
+                                 validators, settings.HTTP_CACHE_TILES_MAX_AGE)
+    rendering_engines = []
+
+    def render_tile(engine):
+        rendering_engines.append(engine)
+        return engine.get_tile(int(level), int(column), int(row), fetch_original_file, file_mimetype,
+                               tile_size, limit_bounds, image_format)
+
+    timings = get_current_timings()
+
+    def render():
+        with bind_timings(timings):
+            return RenderingEngineFactory().call_tiles_engine(image_id, conn, render_tile,
+                                                              fetch_original_file, file_mimetype)
+
+    if settings.TILES_RENDER_DEADLINE and settings.IMAGES_CACHE_ENABLED:
+        # cached tiles are returned right away, the others are rendered by the deadline workers (or by the
+        # request if they are all busy); a render that misses the deadline is detached and saves the tile
+        # to the images cache while a preview is served
+        tile, content_type = RenderingEngineFactory().call_tiles_engine(
+            image_id, conn,
+            lambda engine: engine.get_cached_tile(int(level), int(column), int(row), fetch_original_file,
+                                                  file_mimetype, tile_size, limit_bounds, image_format),
+            fetch_original_file, file_mimetype
+        )
+        render_future = get_background_renders().start(render) if tile is None else None
+    else:
+        render_future = None
+    if render_future is not None:
+        try:
+            tile, content_type = render_future.result(timeout=settings.TILES_RENDER_DEADLINE / 1000.0)
+        except FutureTimeoutError:
+            logger.debug('Render deadline expired for tile %s/%s_%s of image %s', level, column, row, image_id)
+            preview = None
+            if rendering_engines:
+                preview, content_type = rendering_engines[-1].get_tile_preview(int(level), int(column), int(row),
+                                                                               tile_size, limit_bounds,
+                                                                               image_format)
+            if preview is not None and get_background_renders().detach(render_future):
+                return _get_tile_preview_response(preview, content_type, conn, render_future)
+            tile, content_type = render_future.result()
+    elif tile is None:
+        tile, content_type = render()
     if tile:
-        response = HttpResponse(content_type='image/%s' % image_format)
-        tile.save(response, image_format)
-        return response
+        return add_cache_headers(_vary_on_accept(HttpResponse(tile, content_type=content_type)),
+                                 validators, settings.HTTP_CACHE_TILES_MAX_AGE)
     else:
         return HttpResponseNotFound('No tile can be found')
 
 
-@login_required()
-def get_image_mpp(request, image_id, fetch_original_file=False, file_mimetype=None, conn=None, **kwargs):
-    rf = RenderingEngineFactory()
-    rendering_engine = rf.get_primary_tiles_rendering_engine(image_id, conn)
+def _parse_tiles_list(tiles):
+    # tiles are passed as a comma separated list of LEVEL/COLUMN_ROW elements
+    tiles_list = []
+    for t in tiles.split(','):
+        match = re.match(r'^(?P<level>[0-9]+)/(?P<column>[0-9]+)_(?P<row>[0-9]+)$', t.strip())
+        if match is None:
+            raise ValueError('Invalid tile address %s' % t)
+        tiles_list.append((int(match.group('level')), int(match.group('column')), int(match.group('row'))))
+    return tiles_list
+
+
+def _pack_tiles(tiles_list, tiles):
+    # the response body starts with the number of tiles (unsigned 32 bit int, big endian), followed by
+    # one frame for each tile, in the requested order, made of LEVEL, COLUMN, ROW and SIZE (unsigned 32 bit
+    # ints, big endian) and SIZE bytes of image data; tiles that can't be found have SIZE 0
+    frames = [struct.pack('>I', len(tiles_list))]
+    for (level, column, row), tile in zip(tiles_list, tiles):
+        tile = tile or b''
+        frames.append(struct.pack('>IIII', level, column, row, len(tile)))
+        frames.append(tile)
+    return b''.join(frames)
+
+
+@_timed_login_required()
+def get_tiles_batch(request, image_id, tile_format, fetch_original_file=False, file_mimetype=None,
+                    conn=None, **kwargs):
     try:
-        image_mpp = rendering_engine.get_openseadragon_config(fetch_original_file, file_mimetype)['mpp']
-    except Exception as e:
-        rendering_engine = rf.get_secondary_tiles_rendering_engine(image_id, conn)
-        if rendering_engine:
-            image_mpp = rendering_engine.get_openseadragon_config(fetch_original_file, file_mimetype)['mpp']
-        else:
-            raise e
+        tile_size = int(request.GET.get('tile_size'))
+    except TypeError:
+        tile_size = None
+    try:
+        limit_bounds = bool(strtobool(request.GET.get('limit_bounds')))
+    except AttributeError:
+        limit_bounds = None
+    try:
+        image_format = get_image_format(tile_format, request.META.get('HTTP_ACCEPT'))
+    except UnsupportedImageFormat as uif:
+        return HttpResponseBadRequest('{0}'.format(uif))
+    try:
+        tiles_list = _parse_tiles_list(request.GET.get('tiles', ''))
+    except ValueError as ve:
+        return HttpResponseBadRequest('{0}'.format(ve))
+    if len(tiles_list) > settings.TILES_BATCH_MAX_TILES:
+        return HttpResponseBadRequest('Too many tiles requested, max is %d' % settings.TILES_BATCH_MAX_TILES)
+    validators = get_image_validators(conn, image_id, fetch_original_file, file_mimetype,
+                                      'tiles', tiles_list, image_format, get_image_quality(image_format),
+                                      *_get_deepzoom_params(tile_size, limit_bounds))
+    not_modified = get_not_modified_response(request, validators, settings.HTTP_CACHE_TILES_MAX_AGE)
+    if not_modified is not None:
+        return _vary_on_accept(not_modified)
+    tiles = _get_tiles_from_pack(conn, image_id, fetch_original_file, file_mimetype, tiles_list, tile_size,
+                                 limit_bounds, image_format)
+    if tiles is None:
+        return HttpResponseNotFound('No image with ID %s' % image_id)
+    # render the tiles that are not available in a pre-rendered tiles pack
+    missing_tiles = [i for i, t in enumerate(tiles) if t is None]
+    if missing_tiles:
+        rendered_tiles = RenderingEngineFactory().call_tiles_engine(
+            image_id, conn,
+            lambda engine: engine.get_tiles([tiles_list[i] for i in missing_tiles], fetch_original_file,
+                                            file_mimetype, tile_size, limit_bounds, image_format),
+            fetch_original_file, file_mimetype
+        )
+        for i, (tile, _) in zip(missing_tiles, rendered_tiles):
+            tiles[i] = tile
+    response = HttpResponse(_pack_tiles(tiles_list, tiles),
+                            content_type='application/octet-stream')
+    response['X-Tiles-Content-Type'] = get_content_type(image_format)
+    return add_cache_headers(_vary_on_accept(response), validators, settings.HTTP_CACHE_TILES_MAX_AGE)
+
+
+@_timed_login_required()
+def get_image_mpp(request, image_id, fetch_original_file=False, file_mimetype=None, conn=None, **kwargs):
+    image_mpp = RenderingEngineFactory().call_tiles_engine(
+        image_id, conn,
+        lambda engine: engine.get_openseadragon_config(fetch_original_file, file_mimetype)['mpp'],
+        fetch_original_file, file_mimetype
+    )
     return HttpResponse(json.dumps({'image_mpp': image_mpp}), content_type='application/json')
 
 
-@login_required()
+@_timed_login_required()
 def get_slide_bounds(request, image_id, fetch_original_file=False, file_mimetype=None, conn=None, **kwargs):
-    rf = RenderingEngineFactory()
-    rendering_engine = rf.get_primary_tiles_rendering_engine(image_id, conn)
-    try:
-        slide_bounds = rendering_engine.get_slide_bounds(fetch_original_file, file_mimetype)
-    except Exception as e:
-        rendering_engine = rf.get_secondary_tiles_rendering_engine(image_id, conn)
-        if rendering_engine:
-            slide_bounds = rendering_engine.get_slide_bounds(fetch_original_file, file_mimetype)
-        else:
-            raise e
+    slide_bounds = RenderingEngineFactory().call_tiles_engine(
+        image_id, conn,
+        lambda engine: engine.get_slide_bounds(fetch_original_file, file_mimetype),
+        fetch_original_file, file_mimetype
+    )
     if slide_bounds:
         return HttpResponse(json.dumps(slide_bounds), content_type='application/json')
     else:
         return HttpResponseNotFound('No image with ID %s' % image_id)
 
 
+def _invalidate_image(image_id):
+    invalidate_image_paths(image_id)
+    invalidate_cached_images(image_id)
+
+
 @login_required()
 def register_original_file(request, conn=None, **kwargs):
     error_on_duplicated = bool(strtobool(request.GET.get('error_on_duplicated', default='false')))
@@ -460,6 +693,7 @@ def register_original_file(request, conn=None, **kwargs):
                                                                   int(request.GET.get('size', default=-1)),
                                                                   request.GET.get('sha1', default='UNKNOWN'),
                                                                   error_on_duplicated)
+        _invalidate_image(fname)
         return HttpResponse(json.dumps({'omero_id': file_id, 'file_created': file_created}),
                             content_type='application/json')
     except DuplicatedEntryError as dee:
@@ -483,6 +717,7 @@ def register_mirax_slide(request, conn=None, **kwargs):
                                                                                           'mirax/datafolder',
                                                                                           -1, 'UNKNOWN',
                                                                                           error_on_duplicated)
+                _invalidate_image(sname)
                 return HttpResponse(
                 json.dumps({
                     'mirax_index_omero_id': mirax_file_id,
@@ -494,6 +729,7 @@ def register_mirax_slide(request, conn=None, **kwargs):
                 )
             except DuplicatedEntryError as dee:
                 original_files.delete_original_files(conn, sname, 'mirax/index')
+                _invalidate_image(sname)
                 return HttpResponseServerError('{0}'.format(dee))
         except DuplicatedEntryError as dee:
             return HttpResponseServerError('{0}'.format(dee))
@@ -593,6 +829,7 @@ def delete_original_file(request, file_name, conn=None, **kwargs):
     if fmtype is None:
         return HttpResponseServerError('Missing mandatory mimetype value to complete the request')
     status, count = original_files.delete_original_files(conn, file_name, fmtype)
+    _invalidate_image(file_name)
     return HttpResponse(json.dumps({'success': status, 'deleted_count': count}),
                         content_type='application/json')
 
@@ -600,10 +837,18 @@ def delete_original_file(request, file_name, conn=None, **kwargs):
 @login_required()
 def delete_original_files(request, file_name, conn=None, **kwargs):
     status, count = original_files.delete_original_files(conn, file_name)
+    _invalidate_image(file_name)
     return HttpResponse(json.dumps({'success': status, 'deleted_count': count}),
                         content_type='application/json')
 
 
+def _get_dataset_validators(original_file, *render_params):
+    if original_file and original_file.mimetype == 'dataset-folder/tiledb':
+        return get_file_validators(os.path.join(settings.DATASETS_REPOSITORY, original_file.name), *render_params)
+    else:
+        return None
+
+
 def _get_dataset_dzi_description(original_file):
     if original_file and original_file.mimetype == 'dataset-folder/tiledb':
         dzi_adapter = DZIAdapterFactory('TILEDB').get_adapter(original_file.name)
@@ -611,50 +856,70 @@ def _get_dataset_dzi_description(original_file):
     else:
         return None
 
-@login_required()
+@_timed_login_required()
 def get_array_dataset_dzi_by_label(request, dataset_label, conn=None, **kwargs):
     try:
-        original_file = get_original_file(conn, dataset_label)
+        with timed_stage('original_file'):
+            original_file = get_original_file(conn, dataset_label)
     except DuplicatedEntryError as de_err:
         return HttpResponseServerError(str(de_err))
+    validators = _get_dataset_validators(original_file, 'dzi')
+    not_modified = get_not_modified_response(request, validators, settings.HTTP_CACHE_DESCRIPTORS_MAX_AGE)
+    if not_modified is not None:
+        return not_modified
     dzi_metadata = _get_dataset_dzi_description(original_file)
     if dzi_metadata is not None:
-        return HttpResponse(dzi_metadata, content_type='application/xml')
+        return add_cache_headers(HttpResponse(dzi_metadata, content_type='application/xml'),
+                                 validators, settings.HTTP_CACHE_DESCRIPTORS_MAX_AGE)
     else:
         return HttpResponseNotFound(f'There is not a valid array dataset with label {dataset_label}')
 
 
-@login_required()
+@_timed_login_required()
 def get_array_dataset_dzi_by_id(request, dataset_id, conn=None, **kwargs):
-    original_file = get_original_file_by_id(conn, dataset_id)
+    with timed_stage('original_file'):
+        original_file = get_original_file_by_id(conn, dataset_id)
+    validators = _get_dataset_validators(original_file, 'dzi')
+    not_modified = get_not_modified_response(request, validators, settings.HTTP_CACHE_DESCRIPTORS_MAX_AGE)
+    if not_modified is not None:
+        return not_modified
     dzi_metadata = _get_dataset_dzi_description(original_file)
     if dzi_metadata is not None:
-        return HttpResponse(dzi_metadata, content_type='application/xml')
+        return add_cache_headers(HttpResponse(dzi_metadata, content_type='application/xml'),
+                                 validators, settings.HTTP_CACHE_DESCRIPTORS_MAX_AGE)
     else:
         return HttpResponseNotFound(f'There is not a valid array dataset with ID {dataset_id}')
 
 
 def _get_tile_from_dataset(original_file, level, row, column, color_palette, threshold):
     if original_file and original_file.mimetype == 'dataset-folder/tiledb':
-        dzi_adapter = DZIAdapterFactory('TILEDB').get_adapter(original_file.name)
-        return dzi_adapter.get_tile(level, int(row), int(column), color_palette, threshold)
+        with timed_stage('array_tile'):
+            dzi_adapter = DZIAdapterFactory('TILEDB').get_adapter(original_file.name)
+            return dzi_adapter.get_tile(level, int(row), int(column), color_palette, threshold)
     else:
         return None
 
 
-@login_required()
+@_timed_login_required()
 def get_array_dataset_tile_by_label(request, dataset_label, level, row, column, conn=None, **kwargs):
+    count_array_request('tiles')
     color_palette = request.GET.get('palette')
     threshold = request.GET.get('threshold')
     if color_palette is None:
         return HttpResponseBadRequest('Missing mandatory palette value to complete the request')
     try:
-        original_file = get_original_file(conn, dataset_label)
+        with timed_stage('original_file'):
+            original_file = get_original_file(conn, dataset_label)
+        validators = _get_dataset_validators(original_file, 'tile', level, row, column, color_palette, threshold)
+        not_modified = get_not_modified_response(request, validators, settings.HTTP_CACHE_ARRAYS_MAX_AGE)
+        if not_modified is not None:
+            return not_modified
         tile = _get_tile_from_dataset(original_file, level, row, column, color_palette, threshold)
         if tile:
             response = HttpResponse(content_type='image/png')
-            tile.save(response, 'png')
-            return response
+            with timed_stage('encode'):
+                tile.save(response, 'png')
+            return add_cache_headers(response, validators, settings.HTTP_CACHE_ARRAYS_MAX_AGE)
         else:
             return HttpResponseNotFound(f'There is not a valid array dataset with label {dataset_label}')
     except DuplicatedEntryError as de_err:
@@ -665,19 +930,26 @@ def get_array_dataset_tile_by_label(request, dataset_label, level, row, column,
         return HttpResponseBadRequest(a_error)
 
 
-@login_required()
+@_timed_login_required()
 def get_array_dataset_tile_by_id(request, dataset_id, level, row, column, conn=None, **kwargs):
+    count_array_request('tiles')
     color_palette = request.GET.get('palette')
     threshold = request.GET.get('threshold')
     if color_palette is None:
         return HttpResponseBadRequest('Missing mandatory palette value to complete the request')
     try:
-        original_file = get_original_file_by_id(conn, dataset_id)
+        with timed_stage('original_file'):
+            original_file = get_original_file_by_id(conn, dataset_id)
+        validators = _get_dataset_validators(original_file, 'tile', level, row, column, color_palette, threshold)
+        not_modified = get_not_modified_response(request, validators, settings.HTTP_CACHE_ARRAYS_MAX_AGE)
+        if not_modified is not None:
+            return not_modified
         tile = _get_tile_from_dataset(original_file, level, row, column, color_palette, threshold)
         if tile:
             response = HttpResponse(content_type='image/png')
-            tile.save(response, 'png')
-            return response
+            with timed_stage('encode'):
+                tile.save(response, 'png')
+            return add_cache_headers(response, validators, settings.HTTP_CACHE_ARRAYS_MAX_AGE)
         else:
             return HttpResponseNotFound(f'There is not a valid array dataset with ID {dataset_id}')
     except InvalidColorPalette as cp_error:
@@ -686,18 +958,21 @@ def get_array_dataset_tile_by_id(request, dataset_id, level, row, column, conn=N
         return HttpResponseBadRequest(a_error)
 
 
-@login_required()
+@_timed_login_required()
 def get_array_dataset_shapes(request, dataset_id, conn=None, **kwargs):
+    count_array_request('shapes')
     threshold = float(request.GET.get("threshold", 0.6))
     cluster_min_distance = float(request.GET.get("cluster_min_distance", 0))
     cluster_min_area = float(request.GET.get("cluster_min_area", 1))
     shape_mode = request.GET.get("shape_mode", "contour")
 
-    original_file = get_original_file_by_id(conn, dataset_id)
+    with timed_stage('original_file'):
+        original_file = get_original_file_by_id(conn, dataset_id)
     logger.info("retrieving shapes for dataset %s", original_file.name)
     dataset = get_ds(os.path.join(settings.DATASETS_REPOSITORY, original_file.name))
     shape_converter = get_shape_converter(shape_mode)
-    shapes = shape_converter.convert(dataset, threshold * 100)
+    with timed_stage('shapes'):
+        shapes = shape_converter.convert(dataset, threshold * 100)
     if cluster_min_distance:
         diagonal = math.sqrt(2) * dataset.zoom_factor()
         clusterizer = DBScanClusterizer(cluster_min_distance * diagonal)